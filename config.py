@@ -506,6 +506,11 @@ definitions = {
         ] + [
         ("fastLeaves", "fast leaves", True),
         ("roughGraphics", "rough graphics", False),
+        ("greedyMeshing", "greedy meshing", False),
+        ("useVertexBuffers", "use vertex buffers", False),
+        ("cacheMeshes", "cache meshes", False),
+        ("meshCacheSize", "mesh cache size", 256),
+        ("meshProcesses", "mesh processes", 0),
         ("showChunkRedraw", "show chunk redraw", True),
         ("drawSky", "draw sky", True),
         ("drawFog", "draw fog", True),
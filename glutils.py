@@ -18,6 +18,7 @@ glutils.py
 Pythonesque wrappers around certain OpenGL functions.
 """
 
+import bisect
 from OpenGL import GL
 import numpy
 from contextlib import contextmanager
@@ -164,6 +165,77 @@ class DisplayList(object):
             GL.glCallLists(self._list)
 
 
+class VertexBufferPool(object):
+    """
+    Vertex data for many vertex arrays, kept in a few large vertex buffer objects. Each array is copied into a range
+    of one of the buffers, taken from that buffer's free ranges, so arrays can be added and freed without touching
+    the others. upload returns the (buffer, offset) of the range; free gives it back.
+    """
+    bufferBytes = 32 << 20
+    alignment = 96  # one quad of 24 byte vertices
+
+    def __init__(self):
+        self.buffers = []  # GL buffer names
+        self.freeRanges = []  # for each buffer, a sorted list of (offset, size)
+        self.usedBytes = 0
+
+    @classmethod
+    def supported(cls):
+        return bool(GL.glGenBuffers) and bool(GL.glMultiDrawArrays)
+
+    def allocate(self, size):
+        size = -(-size // self.alignment) * self.alignment
+        self.usedBytes += size
+        for index, ranges in enumerate(self.freeRanges):
+            for i, (offset, freeSize) in enumerate(ranges):
+                if freeSize >= size:
+                    if freeSize == size:
+                        del ranges[i]
+                    else:
+                        ranges[i] = (offset + size, freeSize - size)
+                    return index, offset
+
+        bufferSize = max(self.bufferBytes, size)
+        self.buffers.append(self.createBuffer(bufferSize))
+        self.freeRanges.append([(size, bufferSize - size)] if bufferSize > size else [])
+        return len(self.buffers) - 1, 0
+
+    def free(self, (index, offset), size):
+        size = -(-size // self.alignment) * self.alignment
+        self.usedBytes -= size
+        ranges = self.freeRanges[index]
+        i = bisect.bisect(ranges, (offset, size))
+        # Joined with the free ranges on either side
+        if i < len(ranges) and ranges[i][0] == offset + size:
+            size += ranges.pop(i)[1]
+        if i and sum(ranges[i - 1]) == offset:
+            offset, size = ranges[i - 1][0], ranges[i - 1][1] + size
+            i -= 1
+            del ranges[i]
+        ranges.insert(i, (offset, size))
+
+    def upload(self, array):
+        location = index, offset = self.allocate(array.nbytes)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[index])
+        GL.glBufferSubData(GL.GL_ARRAY_BUFFER, offset, array.nbytes, array)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        return location
+
+    def createBuffer(self, size):
+        buf = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buf)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, size, None, GL.GL_DYNAMIC_DRAW)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        return buf
+
+    def delete(self):
+        if self.buffers:
+            GL.glDeleteBuffers(len(self.buffers), numpy.array(self.buffers, 'uint32'))
+        self.buffers = []
+        self.freeRanges = []
+        self.usedBytes = 0
+
+
 class Texture(object):
     allTextures = []
     defaultFilter = GL.GL_NEAREST
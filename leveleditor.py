@@ -3037,6 +3037,7 @@ class LevelEditor(GLViewport):
 
             if self.renderer:
                 self.renderer.addDebugInfo(self.addDebugString)
+            self.level.addDebugInfo(self.addDebugString)
 
     def doWorkUnit(self, onMenu=False):
         if len(self.workers):
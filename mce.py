@@ -3,8 +3,12 @@ import pymclevel.mclevelbase
 import pymclevel.mclevel
 import pymclevel.materials
 import pymclevel.infiniteworld
+import pymclevel.block_analysis
+import pymclevel.heightmap_import
 import sys
 import os
+import collections
+import multiprocessing
 from pymclevel.box import BoundingBox, Vector
 import numpy
 from numpy import zeros, bincount
@@ -51,7 +55,7 @@ class mce(object):
        {commandPrefix}import <filename> <destPoint> [noair] [nowater]
 
        {commandPrefix}createChest <point> <item> [ <count> ]
-       {commandPrefix}analyze
+       {commandPrefix}analyze [ regions ] [ heights ] [ csv | json <filename> ]
 
     Player commands:
        {commandPrefix}player [ <player> [ <point> ] ]
@@ -448,29 +452,50 @@ class mce(object):
         self.level.copyBlocksFrom(chest, chest.bounds, point)
         self.needsSave = True
 
+    analyzeProcesses = multiprocessing.cpu_count()
+
     def _analyze(self, command):
         """
-        analyze
+    analyze [ regions ] [ heights ] [ csv | json <filename> ]
 
-        Counts all of the block types in every chunk of the world.
-        """
-        blockCounts = zeros((65536,), 'uint64')
+    Counts all of the block types in every chunk of the world. Region files
+    are counted in parallel by several processes.
 
-        print "Analyzing {0} chunks...".format(self.level.chunkCount)
-        # for input to bincount, create an array of uint16s by
-        # shifting the data left and adding the blocks
-
-        for i, cPos in enumerate(self.level.allChunks, 1):
-            ch = self.level.getChunk(*cPos)
-            btypes = numpy.array(ch.Data.ravel(), dtype='uint16')
-            btypes <<= 12
-            btypes += ch.Blocks.ravel()
-            counts = bincount(btypes)
+    With regions, also counts the blocks of each region file. With heights,
+    also counts each block ID at each Y level. With csv or json, writes
+    all of the counts to the named file instead of printing the totals.
+    """
+        byRegion = byHeight = False
+        outputFormat = filename = None
+        while command:
+            word = command.pop(0).lower()
+            if word == "regions":
+                byRegion = True
+            elif word == "heights":
+                byHeight = True
+            elif word in ("csv", "json") and command:
+                outputFormat, filename = word, command.pop(0)
+            else:
+                self.printUsage("analyze")
+                return
 
-            blockCounts[:counts.shape[0]] += counts
-            if i % 100 == 0:
-                logging.info("Chunk {0}...".format(i))
+        print "Analyzing {0} chunks...".format(self.level.chunkCount)
+        analysis = pymclevel.block_analysis.BlockCounts(self.level.Height, byRegion, byHeight)
+        for done, total, info in pymclevel.block_analysis.analyzeBlocksIter(self.level, analysis,
+                                                                            self.analyzeProcesses):
+            if done % 100 == 0:
+                logging.info("{0}/{1}...".format(done, total))
+
+        if outputFormat is not None:
+            with open(filename, "wb") as f:
+                if outputFormat == "csv":
+                    analysis.writeCSV(f, self.level.materials)
+                else:
+                    analysis.writeJSON(f, self.level.materials)
+            print "Wrote block counts to {0}".format(filename)
+            return
 
+        blockCounts = analysis.totals
         for blockID in range(materials.id_limit):
             for data in range(16):
                 i = (data << 12) + blockID
@@ -480,6 +505,11 @@ class mce(object):
                     print "{idstring:9} {name:30}: {count:<10}".format(
                         idstring=idstring, name=self.level.materials.blockWithID(blockID, data).name,
                         count=blockCounts[i])
+        unknownStates = sorted((materials.BlockstateAPI.stringifyBlockstate(name, collections.OrderedDict(properties)),
+                                total) for (name, properties), (total, regionTotals, perY)
+                               in analysis.unknownStates.iteritems())
+        for name, total in unknownStates:
+            print "{idstring:9} {name:30}: {count:<10}".format(idstring="(?)", name=name, count=total)
 
         self.needsSave = True
 
@@ -645,25 +675,8 @@ class mce(object):
         assert level.version
 
         def getFreeSectors(rf):
-            runs = []
-            start = None
-            count = 0
-            for i, free in enumerate(rf.freeSectors):
-                if free:
-                    if start is None:
-                        start = i
-                        count = 1
-                    else:
-                        count += 1
-                else:
-                    if start is None:
-                        pass
-                    else:
-                        runs.append((start, count))
-                        start = None
-                        count = 0
-
-            return runs
+            starts, lengths = rf.freeRuns()
+            return zip(starts, lengths)
 
         def printFreeSectors(runs):
 
@@ -924,7 +937,7 @@ class mce(object):
     prune <box>
 
     Removes all chunks not contained in the specified region. Useful for enforcing a finite map size.
-    Chunks are deleted from disk immediately.
+    Chunks are deleted from disk immediately. Region files left mostly empty are compacted.
     """
         if len(command) == 0:
             self.printUsage("prune")
@@ -932,13 +945,19 @@ class mce(object):
 
         box = self.readBox(command)
 
-        i = 0
-        for cx, cz in list(self.level.allChunks):
-            if cx < box.mincx or cx >= box.maxcx or cz < box.mincz or cz >= box.maxcz:
-                self.level.deleteChunk(cx, cz)
-                i += 1
+        pruned = [(cx, cz) for cx, cz in self.level.allChunks
+                  if cx < box.mincx or cx >= box.maxcx or cz < box.mincz or cz >= box.maxcz]
+        if isinstance(self.level, mclevel.MCInfdevOldLevel):
+            freedBytes = self.level.deleteChunks(pruned, compact=True)
+            print "Pruned {0} chunks, freed {1} KiB.".format(len(pruned), freedBytes >> 10)
+            return
+
+        for cx, cz in pruned:
+            self.level.deleteChunk(cx, cz)
 
-        print "Pruned {0} chunks.".format(i)
+        print "Pruned {0} chunks.".format(len(pruned))
+
+    relightProcesses = multiprocessing.cpu_count()
 
     def _relight(self, command):
         """
@@ -949,12 +968,21 @@ class mce(object):
     """
         if len(command):
             box = self.readBox(command)
+            if self.level.incrementalLighting:
+                self.level.relightBoxes([box])
+                print "Relit {0} blocks.".format(box.volume)
+                self.needsSave = True
+                return
             chunks = itertools.product(range(box.mincx, box.maxcx), range(box.mincz, box.maxcz))
 
         else:
             chunks = self.level.allChunks
 
-        self.level.generateLights(chunks)
+        self.level.lightingProcesses = self.relightProcesses
+        try:
+            self.level.generateLights(chunks)
+        finally:
+            del self.level.lightingProcesses
 
         print "Relit 0 chunks."
         self.needsSave = True
@@ -1143,12 +1171,16 @@ class mce(object):
     The game will fill the terrain with trees and mineral deposits the next
     time you play the level.
 
+    Binary PGM images (including 16-bit ones) are read from disk a strip at
+    a time, so they can be far bigger than memory. Other formats are loaded
+    whole.
+
     Please please please try out a small test image before using a big source.
     Using the levels tool to get a good heightmap is an art, not a science.
     A smaller map lets you experiment and get it right before having to blow
     all night generating the really big map.
 
-    Requires the PIL library.
+    Requires the PIL library for formats other than PGM.
     """
         if len(command) == 0:
             self.printUsage("heightmap")
@@ -1158,61 +1190,16 @@ class mce(object):
                 "This will destroy a large portion of the map and may take a long time.  Did you really want to do this?"
         ).lower() in ("yes", "y", "1", "true"):
 
-            from PIL import Image
             import datetime
 
             filename = command.pop(0)
-
-            imgobj = Image.open(filename)
-
-            greyimg = imgobj.convert("L")  # luminance
-            del imgobj
-
-            width, height = greyimg.size
-
-            water_level = 64
-
-            xchunks = (height + 15) / 16
-            zchunks = (width + 15) / 16
+            image = pymclevel.heightmap_import.HeightmapImage(filename)
+            width, height = image.width, image.height
 
             start = datetime.datetime.now()
-            for cx in range(xchunks):
-                for cz in range(zchunks):
-                    try:
-                        self.level.createChunk(cx, cz)
-                    except:
-                        pass
-                    c = self.level.getChunk(cx, cz)
-
-                    imgarray = numpy.asarray(greyimg.crop((cz * 16, cx * 16, cz * 16 + 16, cx * 16 + 16)))
-                    imgarray /= 2  # scale to 0-127
-
-                    for x in range(16):
-                        for z in range(16):
-                            if z + (cz * 16) < width - 1 and x + (cx * 16) < height - 1:
-                                # world dimension X goes north-south
-                                # first array axis goes up-down
-
-                                h = imgarray[x, z]
-
-                                c.Blocks[x, z, h + 1:] = 0  # air
-                                c.Blocks[x, z, h:h + 1] = 2  # grass
-                                c.Blocks[x, z, h - 4:h] = 3  # dirt
-                                c.Blocks[x, z, :h - 4] = 1  # rock
-
-                                if h < water_level:
-                                    c.Blocks[x, z, h + 1:water_level] = 9  # water
-                                if h < water_level + 2:
-                                    c.Blocks[x, z, h - 2:h + 1] = 12  # sand if it's near water level
-
-                                c.Blocks[x, z, 0] = 7  # bedrock
-
-                    c.chunkChanged()
-                    c.TerrainPopulated = False
-                    # the quick lighting from chunkChanged has already lit this simple terrain completely
-                    c.needsLighting = False
-
-                logging.info("%s Just did chunk %d,%d" % (datetime.datetime.now().strftime("[%H:%M:%S]"), cx, cz))
+            for done, total, info in pymclevel.heightmap_import.importHeightmapIter(self.level, image):
+                if done % 1024 == 0:
+                    logging.info("%s Chunk %d of %d" % (datetime.datetime.now().strftime("[%H:%M:%S]"), done, total))
 
             logging.info("Done with mapping!")
             self.needsSave = True
@@ -1221,7 +1208,7 @@ class mce(object):
 
             spawnz = width / 2
             spawnx = height / 2
-            spawny = greyimg.getpixel((spawnx, spawnz))
+            spawny = int(image.rows(spawnx, spawnx + 1)[0, spawnz]) * (self.level.Height / 2) / (image.maxValue + 1)
             logging.info("You probably want to change your spawn point. I suggest {0}".format((spawnx, spawny, spawnz)))
 
     def _execute(self, command):
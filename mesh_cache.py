@@ -0,0 +1,182 @@
+"""
+On-disk cache of the geometry of chunk sections.
+
+The geometry of a section is stored under a key made from everything it is computed from (see
+ChunkCalculator.meshCacheKeys), so sections that have not changed since they were last drawn, in this session or an
+earlier one, are read back instead of computed again. Each entry is a file in the Meshes folder of the MCEdit cache
+folder, holding the compressed vertex arrays of each block renderer class. When the files grow past the size limit,
+the least recently used entries are deleted. The folder is scanned, and entries are written and deleted, by a
+background thread, so that drawing doesn't wait for the disk.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import Queue
+import threading
+import zlib
+
+import numpy
+
+import directories
+
+log = logging.getLogger(__name__)
+
+
+class MeshCache(object):
+    version = 1  # part of every key; raise it when the same blocks give different geometry
+
+    _shared = None
+
+    def __init__(self, path, sizeLimit=256 << 20):
+        self.path = path
+        self.sizeLimit = sizeLimit
+        self.entries = OrderedDict()  # key -> file size, least recently used first; filled in by the scan
+        self.size = 0
+        self.scanned = False
+
+        self._lock = threading.Lock()  # guards entries, size, scanned and _writing
+        self._writing = {}  # key -> geometry given to put that is not written yet
+        self._tasks = Queue.Queue()
+        self._tasks.put((self._scan, ()))
+        thread = threading.Thread(target=self._work, name="MeshCache")
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def shared(cls, sizeLimit):
+        """ The cache in the MCEdit cache folder, limited to sizeLimit bytes. """
+        if cls._shared is None:
+            cls._shared = cls(os.path.join(directories.getCacheDir(), u"Meshes"), sizeLimit)
+        elif cls._shared.sizeLimit != sizeLimit:
+            cls._shared.sizeLimit = sizeLimit
+            cls._shared._tasks.put((cls._shared.evict, ()))
+        return cls._shared
+
+    def filename(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """ Returns the geometry stored under key as a list of (className, vertexArrays, textureTiles), or None. """
+        with self._lock:
+            geometry = self._writing.get(key)
+            if geometry is not None:
+                return geometry
+            # Until the folder is scanned, the entry's file is looked for.
+            if self.scanned and key not in self.entries:
+                return None
+
+        filename = self.filename(key)
+        try:
+            with open(filename, "rb") as f:
+                header, data = zlib.decompress(f.read()).split("\n", 1)
+            geometry = []
+            vertices = numpy.frombuffer(data, 'float32').reshape(-1, 4, 6).copy()
+            start = 0
+            for className, lengths, textureTiles in json.loads(header):
+                vertexArrays = []
+                for length in lengths:
+                    vertexArrays.append(vertices[start:start + length])
+                    start += length
+                if textureTiles is not None:
+                    textureTiles = [tuple(tile) for tile in textureTiles]
+                geometry.append((str(className), vertexArrays, textureTiles))
+            os.utime(filename, None)
+        except (EnvironmentError, ValueError, zlib.error) as e:
+            if isinstance(e, EnvironmentError) and not os.path.exists(filename):
+                return None
+            log.warning(u"Discarded mesh cache entry {0}: {1!r}".format(key, e))
+            self._tasks.put((self.discard, (key,)))
+            return None
+
+        with self._lock:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key)
+        return geometry
+
+    def put(self, key, geometry):
+        """ Stores geometry, a list of (className, vertexArrays, textureTiles), under key. It is written in the
+        background; get returns it until then. """
+        with self._lock:
+            self._writing[key] = geometry
+        self._tasks.put((self._write, (key, geometry)))
+
+    def flush(self):
+        """ Waits until the scan and every entry given to put so far are done. """
+        self._tasks.join()
+
+    def _work(self):
+        while True:
+            func, args = self._tasks.get()
+            try:
+                func(*args)
+            except Exception as e:
+                log.warning(u"Mesh cache error: {0!r}".format(e))
+            finally:
+                self._tasks.task_done()
+
+    def _scan(self):
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            names = os.listdir(self.path)
+        except EnvironmentError as e:
+            log.warning(u"Mesh cache folder {0} is not usable: {1!r}".format(self.path, e))
+            names = []
+
+        files = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        with self._lock:
+            for mtime, name, size in sorted(files):
+                self.entries[name] = size
+                self.size += size
+            self.scanned = True
+        self.evict()
+
+    def _write(self, key, geometry):
+        header = []
+        vertices = []
+        for className, vertexArrays, textureTiles in geometry:
+            header.append((className, [len(a) for a in vertexArrays], textureTiles))
+            vertices.extend(numpy.ascontiguousarray(a, 'float32').tostring() for a in vertexArrays)
+        data = zlib.compress(json.dumps(header) + "\n" + "".join(vertices), 1)
+
+        self.discard(key)
+        try:
+            with open(self.filename(key), "wb") as f:
+                f.write(data)
+        except EnvironmentError as e:
+            log.warning(u"Could not write mesh cache entry {0}: {1!r}".format(key, e))
+        else:
+            with self._lock:
+                self.entries[key] = len(data)
+                self.size += len(data)
+        finally:
+            with self._lock:
+                if self._writing.get(key) is geometry:
+                    del self._writing[key]
+        self.evict()
+
+    def discard(self, key):
+        with self._lock:
+            if key not in self.entries:
+                return
+            self.size -= self.entries.pop(key)
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        while True:
+            with self._lock:
+                if self.size <= self.sizeLimit or not self.entries:
+                    return
+                key = next(iter(self.entries))
+            self.discard(key)
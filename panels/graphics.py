@@ -20,6 +20,11 @@ class GraphicsPanel(Dialog):
             config.settings.vertexBufferLimit: config.settings.vertexBufferLimit.get(),
             config.settings.fastLeaves: config.settings.fastLeaves.get(),
             config.settings.roughGraphics: config.settings.roughGraphics.get(),
+            config.settings.greedyMeshing: config.settings.greedyMeshing.get(),
+            config.settings.useVertexBuffers: config.settings.useVertexBuffers.get(),
+            config.settings.cacheMeshes: config.settings.cacheMeshes.get(),
+            config.settings.meshCacheSize: config.settings.meshCacheSize.get(),
+            config.settings.meshProcesses: config.settings.meshProcesses.get(),
             config.settings.enableMouseLag: config.settings.enableMouseLag.get(),
             config.settings.maxViewDistance: config.settings.maxViewDistance.get()
         }
@@ -43,6 +48,25 @@ class GraphicsPanel(Dialog):
                                                 ref=config.settings.roughGraphics,
                                                 tooltipText="All blocks are drawn the same way (overrides 'Fast Leaves')")
 
+        greedyMeshingRow = albow.CheckBoxLabel("Greedy Meshing",
+                                                ref=config.settings.greedyMeshing,
+                                                tooltipText="Neighboring block faces that look the same are drawn together, using less video memory")
+
+        useVertexBuffersRow = albow.CheckBoxLabel("Use Vertex Buffers",
+                                                ref=config.settings.useVertexBuffers,
+                                                tooltipText="Chunks are kept in vertex buffer objects instead of display lists, so edits upload only what changed")
+
+        cacheMeshesRow = albow.CheckBoxLabel("Cache Meshes",
+                                                ref=config.settings.cacheMeshes,
+                                                tooltipText="Chunk geometry is kept on disk and read back when the same blocks are drawn again")
+
+        self.meshCacheSizeRow = albow.IntInputRow("Mesh Cache Size (MB): ",
+                                                ref=config.settings.meshCacheSize, width=100, min=0)
+
+        self.meshProcessesRow = albow.IntInputRow("Mesh Processes: ",
+                                                ref=config.settings.meshProcesses, width=100, min=0,
+                                                tooltipText="Worker processes that compute chunk geometry. Not used on Windows and OS X")
+
         enableMouseLagRow = albow.CheckBoxLabel("Enable Mouse Lag",
                                                 ref=config.settings.enableMouseLag,
                                                 tooltipText="Enable choppy mouse movement for faster loading.")
@@ -66,11 +90,16 @@ class GraphicsPanel(Dialog):
 
         settingsColumn = albow.Column((fastLeavesRow,
                                        roughGraphicsRow,
+                                       greedyMeshingRow,
+                                       useVertexBuffersRow,
+                                       cacheMeshesRow,
                                        enableMouseLagRow,
                                        #                                  texturePackRow,
                                        self.fieldOfViewRow,
                                        self.targetFPSRow,
                                        self.bufferLimitRow,
+                                       self.meshCacheSizeRow,
+                                       self.meshProcessesRow,
                                        self.maxView,
                                        playerSkins,
                                        self.resourcePackButton,
@@ -157,6 +186,8 @@ class GraphicsPanel(Dialog):
         self.fieldOfViewRow.subwidgets[1].editing = False
         self.targetFPSRow.subwidgets[1].editing = False
         self.bufferLimitRow.subwidgets[1].editing = False
+        self.meshCacheSizeRow.subwidgets[1].editing = False
+        self.meshProcessesRow.subwidgets[1].editing = False
         self.maxView.subwidgets[1].editing = False
 
     def dispatch_key(self, name, evt):
@@ -0,0 +1,321 @@
+"""
+Block counting for whole levels.
+
+Counts are kept by (data << 12) + blockID, the key mce's analyze has always used. Anvil levels are counted straight
+from their region files: the work is split by region, and worker processes read each region's chunks, parse their
+NBT and count the Blocks/Add/Data arrays (or the Palette/BlockStates of 1.13+ sections) of every section, without
+building chunk objects or decoding lights and entities. Chunks that were changed but not saved, and the chunks of
+other kinds of level, are counted through getChunk.
+"""
+
+import collections
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import struct
+
+from numpy import add, arange, array, bincount, concatenate, empty, flatnonzero, zeros
+
+from infiniteworld import MCInfdevOldLevel, unpackBlockStates
+from materials import BlockstateAPI
+from mclevelbase import ChunkMalformed, ChunkNotPresent, exhaust
+import nbt
+from regionfile import MCRegionFile, readRegionOffsets
+
+log = logging.getLogger(__name__)
+
+# Section block indices are y * 256 + z * 16 + x; this is the y of each, shifted past the block ID
+_sectionYKeys = (arange(4096, dtype='uint16') >> 8) << 12
+
+# Chunks counted together in one bincount
+_CHUNK_BATCH = 64
+
+
+class BlockCounts(object):
+    """
+    The block counts of a level. totals is indexed by (data << 12) + blockID. If asked for, regions maps (rx, rz) to
+    a dict of the non-zero counts of that region by the same key, and heights is indexed [y, blockID]. 1.13+
+    Blockstates that have no ID are counted by name in unknownStates, which maps (name, properties) to
+    [total, {(rx, rz): count}, counts by y].
+    """
+
+    def __init__(self, height, byRegion=False, byHeight=False):
+        self.height = height
+        self.chunkCount = 0
+        self.totals = zeros(65536, 'int64')
+        self.regions = {} if byRegion else None
+        self.heights = zeros((height, 4096), 'int64') if byHeight else None
+        self.unknownStates = {}
+
+    def addRegion(self, regionCoords, keys, counts):
+        add.at(self.totals, keys, counts)
+        if self.regions is not None:
+            regionCounts = self.regions.setdefault(regionCoords, {})
+            for key, count in itertools.izip(keys.tolist(), counts.tolist()):
+                regionCounts[key] = regionCounts.get(key, 0) + count
+
+    def addUnknownState(self, regionCoords, state, total, perY):
+        stateCounts = self.unknownStates.get(state)
+        if stateCounts is None:
+            stateCounts = self.unknownStates[state] = [0, {}, zeros(self.height, 'int64')]
+        stateCounts[0] += total
+        if self.regions is not None:
+            stateCounts[1][regionCoords] = stateCounts[1].get(regionCoords, 0) + total
+        if self.heights is not None:
+            stateCounts[2] += perY
+
+    def addChunk(self, chunk):
+        Blocks = chunk.Blocks.astype('uint16')
+        keys = bincount(((chunk.Data.astype('uint16') << 12) | Blocks).ravel())
+        nonzero = flatnonzero(keys)
+        cx, cz = chunk.chunkPosition
+        self.addRegion((cx >> 5, cz >> 5), nonzero, keys[nonzero])
+
+        if self.heights is not None:
+            height = min(self.height, Blocks.shape[2])
+            yKeys = (arange(height) << 12).astype('int64') | Blocks[:, :, :height]
+            self.heights[:height] += bincount(yKeys.ravel(), minlength=height * 4096).reshape(height, 4096)
+
+    def rows(self, materials):
+        """
+        Yields (regionX, regionZ, y, blockID, data, name, count) for every non-zero count. Totals have no region
+        and no y, region counts have no y, and counts by height have no region and no data. Unknown Blockstates
+        have no blockID and no data, and are named by their Blockstate string.
+        """
+        def name(blockID, data=0):
+            return materials.blockWithID(int(blockID), int(data)).name
+
+        unknownStates = sorted((BlockstateAPI.stringifyBlockstate(stateName, collections.OrderedDict(properties)),
+                                stateCounts) for (stateName, properties), stateCounts in self.unknownStates.iteritems())
+
+        for key in flatnonzero(self.totals):
+            yield None, None, None, key & 0xfff, key >> 12, name(key & 0xfff, key >> 12), self.totals[key]
+        for stateName, (total, regionTotals, perY) in unknownStates:
+            yield None, None, None, None, None, stateName, total
+
+        for (rx, rz), regionCounts in sorted((self.regions or {}).iteritems()):
+            for key, count in sorted(regionCounts.iteritems()):
+                yield rx, rz, None, key & 0xfff, key >> 12, name(key & 0xfff, key >> 12), count
+            for stateName, (total, regionTotals, perY) in unknownStates:
+                if (rx, rz) in regionTotals:
+                    yield rx, rz, None, None, None, stateName, regionTotals[rx, rz]
+
+        if self.heights is not None:
+            for y, blockID in zip(*self.heights.nonzero()):
+                yield None, None, y, blockID, None, name(blockID), self.heights[y, blockID]
+            for stateName, (total, regionTotals, perY) in unknownStates:
+                for y in flatnonzero(perY):
+                    yield None, None, y, None, None, stateName, perY[y]
+
+    def writeCSV(self, f, materials):
+        writer = csv.writer(f)
+        writer.writerow(("region_x", "region_z", "y", "id", "data", "name", "count"))
+        for row in self.rows(materials):
+            writer.writerow(["" if value is None else unicode(value).encode("utf-8") for value in row])
+
+    def writeJSON(self, f, materials):
+        result = {"chunks": self.chunkCount, "blocks": [], "regions": {}, "heights": {}}
+        for rx, rz, y, blockID, data, name, count in self.rows(materials):
+            entry = {"name": name, "count": int(count)}
+            if blockID is not None:
+                entry["id"] = int(blockID)
+            if data is not None:
+                entry["data"] = int(data)
+            if rx is not None:
+                result["regions"].setdefault("{0},{1}".format(rx, rz), []).append(entry)
+            elif y is not None:
+                result["heights"].setdefault(str(y), []).append(entry)
+            else:
+                result["blocks"].append(entry)
+        json.dump(result, f, indent=1, sort_keys=True)
+
+
+def analyzeBlocks(level, processes=1, byRegion=False, byHeight=False):
+    counts = BlockCounts(level.Height, byRegion, byHeight)
+    exhaust(analyzeBlocksIter(level, counts, processes))
+    return counts
+
+
+def analyzeBlocksIter(level, counts, processes=1):
+    """ Counts the blocks of every chunk of level into counts, a BlockCounts, using processes worker processes for
+    the region files of Anvil levels. Yields (done, total, info) progress tuples like generateLightsIter. """
+
+    chunkPositions = set(level.allChunks)
+    counts.chunkCount += len(chunkPositions)
+
+    regions = collections.defaultdict(list)
+    if isinstance(level, MCInfdevOldLevel):
+        # Chunks that differ from what is in the world folder are counted from memory.
+        level.finishChunkEvictions(wait=True)
+        changed = set(cPos for cPos, chunkData in level._loadedChunkData.iteritems() if chunkData.dirty)
+        if not level.readonly:
+            changed.update(level.unsavedWorkFolder.listChunks())
+
+        worldFolder = level.worldFolder
+        for cx, cz in chunkPositions:
+            if (cx, cz) not in changed and worldFolder.containsChunk(cx, cz):
+                regions[cx >> 5, cz >> 5].append((cx, cz))
+        for regionChunks in regions.itervalues():
+            chunkPositions.difference_update(regionChunks)
+
+    tasks = [(level.worldFolder.getRegionFilename(rx, rz), (rx, rz), regionChunks, level.Height,
+              counts.heights is not None)
+             for (rx, rz), regionChunks in regions.iteritems()]
+    total = len(tasks) + len(chunkPositions)
+    progressInfo = u"Analyzing {0} chunks in {1} regions with {2} processes".format(counts.chunkCount, len(tasks),
+                                                                                    processes)
+    log.info(progressInfo)
+
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_countRegion, tasks)
+    else:
+        pool = None
+        results = itertools.imap(_countRegion, tasks)
+
+    done = 0
+    try:
+        for regionCoords, keys, values, heightKeys, heightValues, states, unreadChunks in results:
+            counts.addRegion(regionCoords, keys, values)
+            if counts.heights is not None:
+                counts.heights.ravel()[heightKeys] += heightValues
+            _addStates(level, counts, regionCoords, states)
+            chunkPositions.update(unreadChunks)
+
+            done += 1
+            yield done, total, progressInfo
+
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    for cPos in chunkPositions:
+        try:
+            counts.addChunk(level.getChunk(*cPos))
+        except (ChunkMalformed, ChunkNotPresent) as e:
+            log.warning(u"Skipped chunk {0}: {1}".format(cPos, e))
+        done += 1
+        yield done, total, progressInfo
+
+
+def _addStates(level, counts, regionCoords, states):
+    # Adds the counts of 1.13+ Blockstates, each keyed by (name, properties) as in BlockstateAPI.paletteToIDs.
+    # Blockstates that have no ID are counted by name.
+    if not states:
+        return
+
+    states = states.items()
+    palette = nbt.TAG_List()
+    for (name, properties), stateCounts in states:
+        entry = nbt.TAG_Compound()
+        entry["Name"] = nbt.TAG_String(name)
+        if properties:
+            entry["Properties"] = nbt.TAG_Compound([nbt.TAG_String(v, k) for k, v in properties])
+        palette.append(entry)
+    ids, data, known = level.materials.blockstate_api.paletteToIDs(palette)
+
+    keys = (data.astype('int64') << 12) | ids
+    totals = array([total for state, (total, perY) in states], 'int64')
+    counts.addRegion(regionCoords, keys[known], totals[known])
+    for blockID, isKnown, (state, (total, perY)) in zip(ids, known, states):
+        if not isKnown:
+            counts.addUnknownState(regionCoords, state, total, perY)
+        elif counts.heights is not None:
+            counts.heights[:, blockID] += perY
+
+
+def _unpackNibbles(packed):
+    unpacked = empty(len(packed) * 2, 'uint16')
+    unpacked[::2] = packed & 0xf
+    unpacked[1::2] = packed >> 4
+    return unpacked
+
+
+def _countRegion((path, regionCoords, chunkPositions, height, byHeight)):
+    # Runs in a worker process. Reads the region file directly, so that nothing is written to it, and returns the
+    # non-zero counts, the Blockstate counts, and the chunks that could not be read for the parent to count.
+    counts = zeros(65536, 'int64')
+    heights = zeros((height, 4096), 'int64') if byHeight else None
+    states = {}
+    unreadChunks = []
+
+    keys = []
+    yKeys = collections.defaultdict(list)
+
+    def flush():
+        if keys:
+            counts[:] += bincount(concatenate(keys), minlength=65536)
+            del keys[:]
+        for sy, sectionKeys in yKeys.iteritems():
+            heights[sy * 16:sy * 16 + 16] += bincount(concatenate(sectionKeys), minlength=65536).reshape(16, 4096)
+        yKeys.clear()
+
+    offsets = readRegionOffsets(path)
+
+    def offset((cx, cz)):
+        return offsets[(cx & 0x1f) + (cz & 0x1f) * 32]
+
+    with open(path, "rb") as f:
+        for i, cPos in enumerate(sorted(chunkPositions, key=offset), 1):
+            try:
+                f.seek((offset(cPos) >> 8) * MCRegionFile.SECTOR_BYTES)
+                data = f.read((offset(cPos) & 0xff) * MCRegionFile.SECTOR_BYTES)
+                length, format = struct.unpack_from(">IB", data)
+                sections = nbt.load(buf=MCRegionFile.decompress(data[5:length + 4], format))["Level"]["Sections"]
+                sections = [(s["Y"].value, s) for s in sections]
+            except Exception:
+                unreadChunks.append(cPos)
+                continue
+
+            # Sections that are not saved are all air; sections outside of the level's height are not counted.
+            missing = set(xrange(height >> 4))
+            for sy, section in sections:
+                if sy not in missing:
+                    continue
+                if "Blocks" in section or "BlockStates" in section and "Palette" in section:
+                    missing.discard(sy)
+
+                if "Blocks" in section:
+                    Blocks = section["Blocks"].value.astype('uint16')
+                    if "Add" in section:
+                        Blocks |= _unpackNibbles(section["Add"].value) << 8
+                    if "Data" in section:
+                        keys.append(Blocks | (_unpackNibbles(section["Data"].value) << 12))
+                    else:
+                        keys.append(Blocks)
+                    if byHeight:
+                        yKeys[sy].append(Blocks | _sectionYKeys)
+
+                elif "BlockStates" in section and "Palette" in section:
+                    palette = section["Palette"]
+                    bits = max(4, (len(palette) - 1).bit_length())
+                    indices, padded = unpackBlockStates(section["BlockStates"].value, bits)
+                    perY = bincount((_sectionYKeys >> 12) * len(palette) + indices.astype('uint16'),
+                                    minlength=16 * len(palette)).reshape(16, len(palette))
+                    for j, entry in enumerate(palette):
+                        properties = entry["Properties"].value if "Properties" in entry else ()
+                        key = entry["Name"].value, tuple(sorted((prop.name, prop.value) for prop in properties))
+                        stateCounts = states.get(key)
+                        if stateCounts is None:
+                            stateCounts = states[key] = [0, zeros(height, 'int64')]
+                        stateCounts[0] += int(perY[:, j].sum())
+                        stateCounts[1][sy * 16:sy * 16 + 16] += perY[:, j]
+
+            counts[0] += 4096 * len(missing)
+            if byHeight:
+                for sy in missing:
+                    heights[sy * 16:sy * 16 + 16, 0] += 256
+
+            if i % _CHUNK_BATCH == 0:
+                flush()
+
+    flush()
+    nonzero = flatnonzero(counts)
+    heightKeys = flatnonzero(heights) if byHeight else nonzero[:0]
+    heightValues = heights.ravel()[heightKeys] if byHeight else counts[:0]
+    return regionCoords, nonzero, counts[nonzero], heightKeys, heightValues, states, unreadChunks
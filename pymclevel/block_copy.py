@@ -46,6 +46,104 @@ def adjustCopyParameters(destLevel, sourceLevel, sourceBox, destinationPoint):
     return actualSourceBox, actualDestPoint
 
 
+def chunkAlignedCopy(destLevel, sourceLevel, sourceBox, destinationPoint, blocksToCopy):
+    """ Returns True if the copy moves whole chunk columns between two Anvil levels with the same materials, so the
+    chunks' sections can be copied without converting or masking any blocks. """
+    from infiniteworld import MCInfdevOldLevel
+
+    if blocksToCopy is not None or destLevel.materials is not sourceLevel.materials:
+        return False
+    if not (isinstance(destLevel, MCInfdevOldLevel) and isinstance(sourceLevel, MCInfdevOldLevel)):
+        return False
+    if destLevel.Height != sourceLevel.Height or sourceBox.miny != 0 or sourceBox.height < sourceLevel.Height:
+        return False
+    # Sections keep their height, so only copies that move blocks across, not up or down, are aligned.
+    if destinationPoint[1] != 0:
+        return False
+    return not any(c & 0xf for c in (sourceBox.minx, sourceBox.minz, sourceBox.maxx, sourceBox.maxz,
+                                     destinationPoint[0], destinationPoint[2]))
+
+
+def copyChunkColumnsIter(destLevel, sourceLevel, destBox, copyOffset, entities=True, create=False, biomes=False,
+                         staticCommands=False, moveSpawnerPos=False, regenerateUUID=False, first=False,
+                         cancelCommandBlockOffset=False):
+    """ copyBlocksFromIter for chunk aligned copies. Each destination chunk gets the sections, light and height
+    map of its source chunk as they are stored, and only the entities, tile entities and tile ticks are rewritten
+    for the new position. Chunks that stay at the same position in another level are copied as compressed bytes
+    when neither level is using them. """
+    dcx, dcz = copyOffset[0] >> 4, copyOffset[2] >> 4
+    rawCopy = (dcx == dcz == 0 and destLevel is not sourceLevel and not sourceLevel.readonly and entities and biomes
+               and not regenerateUUID)
+    chunkCount = destBox.chunkCount
+    i = e = t = tt = 0
+
+    for destCpos in destBox.chunkPositions:
+        cx, cz = destCpos
+        srcCpos = cx - dcx, cz - dcz
+        if not sourceLevel.containsChunk(*srcCpos):
+            continue
+
+        if not destLevel.containsChunk(*destCpos):
+            if not create:
+                continue
+            destLevel.createChunk(*destCpos)
+        elif rawCopy and destCpos not in destLevel._loadedChunks and destCpos not in sourceLevel._loadedChunks:
+            destLevel.copyChunkFrom(sourceLevel, cx, cz)
+            i += 1
+            yield (i, chunkCount)
+            continue
+
+        i += 1
+        yield (i, chunkCount)
+        if i % 100 == 0:
+            log.info("Chunk {0}...".format(i))
+
+        sourceChunk = sourceLevel.getChunk(*srcCpos)
+        destChunk = destLevel.getChunk(*destCpos)
+        destChunk.chunkData.copySectionsFrom(sourceChunk.chunkData)
+        destChunk.HeightMap[:] = sourceChunk.HeightMap
+        if biomes:
+            destChunk.Biomes[:] = sourceChunk.Biomes
+
+        if entities:
+            destChunk.removeEntitiesInBox(destChunk.bounds)
+            ents = sourceChunk.getEntitiesInBox(sourceChunk.bounds)
+            e += len(ents)
+            for entityTag in ents:
+                destLevel.addEntity(Entity.copyWithOffset(entityTag, copyOffset, regenerateUUID))
+
+        destChunk.removeTileEntitiesInBox(destChunk.bounds)
+        tileEntities = sourceChunk.getTileEntitiesInBox(sourceChunk.bounds)
+        t += len(tileEntities)
+        for tileEntityTag in tileEntities:
+            destLevel.addTileEntity(TileEntity.copyWithOffset(tileEntityTag, copyOffset, staticCommands,
+                                                              moveSpawnerPos, first, cancelCommandBlockOffset))
+
+        destChunk.removeTileTicksInBox(destChunk.bounds)
+        tileTicksList = sourceChunk.getTileTicksInBox(sourceChunk.bounds)
+        tt += len(tileTicksList)
+        for tileTick in tileTicksList:
+            eTag = deepcopy(tileTick)
+            eTag['x'].value = tileTick['x'].value + copyOffset[0]
+            eTag['y'].value = tileTick['y'].value + copyOffset[1]
+            eTag['z'].value = tileTick['z'].value + copyOffset[2]
+            destLevel.addTileTick(eTag)
+
+        destChunk.dirty = True
+        destChunk.needsLighting = not destLevel.incrementalLighting
+
+    if i and destLevel.incrementalLighting:
+        # Light was copied along with the blocks. It is only wrong within reach of the copy's sides, where it came
+        # from the source level's neighbouring chunks.
+        x, z = destBox.minx, destBox.minz
+        w, h, l = destBox.size
+        for box in (BoundingBox((x, 0, z), (w, h, 1)), BoundingBox((x, 0, z + l - 1), (w, h, 1)),
+                    BoundingBox((x, 0, z), (1, h, l)), BoundingBox((x + w - 1, 0, z), (1, h, l))):
+            destLevel.markLightingDirty(box)
+
+    log.info("Copied {0} entities and {1} tile entities and {2} tile ticks".format(e, t, tt))
+
+
 def copyBlocksFromIter(destLevel, sourceLevel, sourceBox, destinationPoint, blocksToCopy=None, entities=True,
                        create=False, biomes=False, tileTicks=True, staticCommands=False, moveSpawnerPos=False, regenerateUUID=False, first=False, cancelCommandBlockOffset=False):
     """ copy blocks between two infinite levels by looping through the
@@ -69,6 +167,14 @@ def copyBlocksFromIter(destLevel, sourceLevel, sourceBox, destinationPoint, bloc
 
     copyOffset = [d - s for s, d in zip(sourceBox.origin, destinationPoint)]
 
+    if chunkAlignedCopy(destLevel, sourceLevel, sourceBox, destinationPoint, blocksToCopy):
+        for status in copyChunkColumnsIter(destLevel, sourceLevel, destBox, copyOffset, entities, create, biomes,
+                                           staticCommands, moveSpawnerPos, regenerateUUID, first,
+                                           cancelCommandBlockOffset):
+            yield status
+        log.info("Duration: {0}".format(datetime.now() - startTime))
+        return
+
     # Visit each chunk in the destination area.
     # Get the region of the source area corresponding to that chunk
     #   Visit each chunk of the region of the source area
@@ -160,7 +266,10 @@ def copyBlocksFromIter(destLevel, sourceLevel, sourceBox, destinationPoint, bloc
             if biomes and hasattr(destChunk, 'Biomes') and hasattr(sourceChunk, 'Biomes'):
                 destChunk.Biomes[destSlices[:2]] = sourceChunk.Biomes[sourceSlices[:2]]
 
-        destChunk.chunkChanged()
+        destChunk.chunkChanged(not destLevel.incrementalLighting)
+
+    if i and destLevel.incrementalLighting:
+        destLevel.markLightingDirty(destBox)
 
     log.info("Duration: {0}".format(datetime.now() - startTime))
     log.info("Copied {0} entities and {1} tile entities and {2} tile ticks".format(e, t, tt))
@@ -23,6 +23,8 @@ def fillBlocks(level, box, blockInfo, blocksToReplace=(), noData=False):
 
 
 def fillBlocksIter(level, box, blockInfo, blocksToReplace=(), noData=False):
+    # Lighting is only relit around a given box; filling the whole level relights whole chunks.
+    relightBox = box is not None and level.incrementalLighting
     if box is None:
         chunkIterator = level.getAllChunkSlices()
         box = level.bounds
@@ -75,6 +77,7 @@ def fillBlocksIter(level, box, blockInfo, blocksToReplace=(), noData=False):
     i = 0
     skipped = 0
     replaced = 0
+    lightingChanged = False
 
     for (chunk, slices, point) in chunkIterator:
         i += 1
@@ -124,7 +127,14 @@ def fillBlocksIter(level, box, blockInfo, blocksToReplace=(), noData=False):
             chunk.addTileEntity(tileEntityObject)
             blocksList.remove(tileEntityObject)
         
-        chunk.chunkChanged(needsLighting)
+        if relightBox:
+            chunk.chunkChanged(False)
+            lightingChanged = lightingChanged or needsLighting
+        else:
+            chunk.chunkChanged(needsLighting)
+
+    if lightingChanged:
+        level.markLightingDirty(box)
 
     if len(blocksToReplace):
         log.info(u"Replace: Skipped {0} chunks, replaced {1} blocks".format(skipped, replaced))
@@ -0,0 +1,357 @@
+"""
+Incremental relighting for chunked levels.
+
+Light loses at least one level for every block it passes, so light that passes through an edited box cannot reach
+more than 14 blocks past it. Relighting after an edit only has to recompute that reach. Skylight is the exception
+going down: it falls through a column without losing strength, so its reach goes down to the bottom of the world.
+
+The light in the reach is reset to the light the blocks emit (block light) or the light that falls straight down
+from the sky (skylight). Then it is spread again from the reset blocks and from the unchanged blocks around them.
+Spreading works on 16x16x16 sections. A queue holds the sections that may still receive light. Each section is
+relaxed until its light no longer changes, and the neighbors it pushed light into are queued.
+
+Lighting many chunks from scratch is split into square tiles of chunks, which are lit in worker processes. Each
+tile is lit together with a one chunk border of its neighbors. The border is wider than the reach of light, so the
+light computed for the tile itself is exact and the tiles need no fixing up where they meet.
+"""
+
+import collections
+import itertools
+import logging
+import multiprocessing
+
+from numpy import clip, cumsum, maximum, minimum, arange, zeros
+
+from box import BoundingBox
+from level import extractHeights
+from mclevelbase import ChunkMalformed, ChunkNotPresent, exhaust
+
+log = logging.getLogger(__name__)
+
+LIGHT_REACH = 14
+
+
+def relightBoxes(level, boxes):
+    return exhaust(relightBoxesIter(level, boxes))
+
+
+def relightBoxesIter(level, boxes):
+    """ Relights the blocks around each box in boxes, assuming the light outside of their reach is already correct.
+    Yields (done, total, info) progress tuples like generateLightsIter. """
+
+    boxes = list(boxes)
+    if not boxes:
+        return
+
+    chunks = _ChunkGetter(level)
+    height = level.Height
+    if level.dimNo in (-1, 1):
+        lights = ("BlockLight",)
+    else:
+        lights = ("BlockLight", "SkyLight")
+
+    for light in lights:
+        sections = set()
+        for box in boxes:
+            reach = lightReach(box, light, height)
+            if not reach.volume:
+                continue
+
+            for cPos in reach.chunkPositions:
+                chunk = chunks[cPos]
+                if chunk is None:
+                    continue
+                _, slices = chunk.getChunkSlicesForBox(reach)
+                _resetLight(level, chunk, light, slices)
+                chunk.dirty = True
+
+                cx, cz = cPos
+                for sy in xrange(reach.miny >> 4, ((reach.maxy - 1) >> 4) + 1):
+                    sections.add((cx, sy, cz))
+
+        progressInfo = u"{0}: spreading through {1} sections".format(light, len(sections))
+        log.info(progressInfo)
+        for done, total in _spreadLight(level, chunks, light, sections):
+            yield done, total, progressInfo
+
+
+def lightReach(box, light, height):
+    """ Returns the box of blocks whose light may change when the blocks in box change. """
+    reach = box.expand(LIGHT_REACH)
+    miny = 0 if light == "SkyLight" else max(reach.miny, 0)
+    maxy = min(reach.maxy, height)
+    return BoundingBox((reach.minx, miny, reach.minz), (reach.width, max(maxy - miny, 0), reach.length))
+
+
+class _ChunkGetter(dict):
+    """ Keeps the chunks touched by a relight loaded, and remembers which ones are missing. """
+
+    def __init__(self, level):
+        super(_ChunkGetter, self).__init__()
+        self.level = level
+
+    def __missing__(self, cPos):
+        try:
+            chunk = self.level.getChunk(*cPos)
+        except (ChunkNotPresent, ChunkMalformed):
+            chunk = None
+        self[cPos] = chunk
+        return chunk
+
+
+def _resetLight(level, chunk, light, slices):
+    xs, zs, ys = slices
+    blocks = chunk.Blocks[xs, zs]
+    if light == "BlockLight":
+        chunk.BlockLight[slices] = level.materials.lightEmission[blocks[:, :, ys]]
+    else:
+        chunk.SkyLight[slices] = directSkyLight(level.materials.lightAbsorption, blocks)[:, :, ys]
+
+
+def directSkyLight(lightAbsorption, blocks):
+    """ Returns the skylight that falls straight down into each block of blocks, which is indexed [x, z, y] and
+    holds whole columns. Above the highest light absorbing block it is 15. Below it, each block takes away its light
+    absorption, or 1 for transparent blocks; this matches LightedChunk.genFastLights. """
+    absorption = lightAbsorption[blocks]
+    heights = extractHeights(absorption)
+
+    # absorbedBelow[..., y] is the total absorption of the blocks from y to the top of the column.
+    absorbedBelow = cumsum(maximum(absorption, 1)[..., ::-1], axis=2, dtype='int32')[..., ::-1]
+    columnTop = zeros(absorbedBelow.shape[:2] + (absorbedBelow.shape[2] + 1,), 'int32')
+    columnTop[..., :-1] = absorbedBelow
+    x, z = arange(heights.shape[0])[:, None], arange(heights.shape[1])[None, :]
+    absorbedAboveHeight = columnTop[x, z, heights]
+
+    # Above the height, the subtraction goes negative and the light is clipped to 15.
+    return clip(15 - (absorbedBelow - absorbedAboveHeight[..., None]), 0, 15).astype('uint8')
+
+
+def _spreadLight(level, chunks, light, sections):
+    height = level.Height
+    absorption = clip(level.materials.lightAbsorption, 1, 15).astype('int16')
+
+    queue = collections.deque(sorted(sections))
+    queued = set(queue)
+    done = 0
+
+    while queue:
+        section = queue.popleft()
+        queued.discard(section)
+        cx, sy, cz = section
+
+        changedFaces = _relaxSection(chunks, light, absorption, cx, sy, cz, height)
+        for neighbor in changedFaces:
+            ncx, nsy, ncz = neighbor
+            if neighbor not in queued and chunks[ncx, ncz] is not None:
+                queue.append(neighbor)
+                queued.add(neighbor)
+
+        done += 1
+        yield done, done + len(queue)
+
+
+def _relaxSection(chunks, light, absorption, cx, sy, cz, height):
+    """ Spreads light inside one section, taking in the light at its faces, until it no longer changes. Returns the
+    neighboring sections across the faces where the light changed. """
+    chunk = chunks[cx, cz]
+    y0 = sy << 4
+    y1 = min(y0 + 16, height)
+    h = y1 - y0
+    chunkLight = getattr(chunk, light)
+
+    # Light of the section with one block of its neighbors' light on each face. Corners and edges are unused.
+    padded = zeros((18, 18, h + 2), 'int16')
+    inner = padded[1:-1, 1:-1, 1:-1]
+    inner[:] = chunkLight[:, :, y0:y1]
+    before = inner.copy()
+
+    for (dx, dz), dest, source in (((-1, 0), (0, slice(1, -1)), (15, slice(None))),
+                                   ((1, 0), (17, slice(1, -1)), (0, slice(None))),
+                                   ((0, -1), (slice(1, -1), 0), (slice(None), 15)),
+                                   ((0, 1), (slice(1, -1), 17), (slice(None), 0))):
+        neighbor = chunks[cx + dx, cz + dz]
+        if neighbor is not None:
+            padded[dest + (slice(1, -1),)] = getattr(neighbor, light)[source + (slice(y0, y1),)]
+    if y0 > 0:
+        padded[1:-1, 1:-1, 0] = chunkLight[:, :, y0 - 1]
+    if y1 < height:
+        padded[1:-1, 1:-1, -1] = chunkLight[:, :, y1]
+
+    relaxLight(padded, absorption[chunk.Blocks[:, :, y0:y1]])
+
+    changed = inner != before
+    if not changed.any():
+        return ()
+
+    chunkLight[:, :, y0:y1] = minimum(inner, 15)
+    chunk.dirty = True
+
+    faces = []
+    if changed[0].any():
+        faces.append((cx - 1, sy, cz))
+    if changed[15].any():
+        faces.append((cx + 1, sy, cz))
+    if changed[:, 0].any():
+        faces.append((cx, sy, cz - 1))
+    if changed[:, 15].any():
+        faces.append((cx, sy, cz + 1))
+    if y0 > 0 and changed[:, :, 0].any():
+        faces.append((cx, sy - 1, cz))
+    if y1 < height and changed[:, :, -1].any():
+        faces.append((cx, sy + 1, cz))
+    return faces
+
+
+def relaxLight(padded, absorption):
+    """ Spreads light through padded until it no longer changes. padded holds light values as signed integers with
+    one extra block on each side, which is read but never changed. absorption is the light absorption of the inner
+    blocks, at least 1 each. Each step moves light one block, so this takes at most 15 steps. """
+    inner = padded[1:-1, 1:-1, 1:-1]
+    while True:
+        incoming = maximum(padded[:-2, 1:-1, 1:-1], padded[2:, 1:-1, 1:-1])
+        maximum(incoming, padded[1:-1, :-2, 1:-1], incoming)
+        maximum(incoming, padded[1:-1, 2:, 1:-1], incoming)
+        maximum(incoming, padded[1:-1, 1:-1, :-2], incoming)
+        maximum(incoming, padded[1:-1, 1:-1, 2:], incoming)
+        incoming -= absorption
+        if not (incoming > inner).any():
+            return
+        maximum(inner, incoming, inner)
+
+
+def lightChunksParallel(level, chunkPositions, processes, tileSize=8):
+    return exhaust(lightChunksParallelIter(level, chunkPositions, processes, tileSize))
+
+
+def lightChunksParallelIter(level, chunkPositions, processes, tileSize=8):
+    """ Lights the given chunks and the chunks around them from scratch using processes worker processes. Chunks are
+    lit in tiles of tileSize by tileSize chunks; tileSize should divide 32 so tiles do not straddle region files.
+    Yields (done, total, info) progress tuples like generateLightsIter. """
+
+    positions = set()
+    for cx, cz in chunkPositions:
+        for dx, dz in itertools.product((-1, 0, 1), (-1, 0, 1)):
+            if (cx + dx, cz + dz) not in positions and level.containsChunk(cx + dx, cz + dz):
+                positions.add((cx + dx, cz + dz))
+
+    tiles = collections.defaultdict(list)
+    for cx, cz in positions:
+        tiles[cx // tileSize, cz // tileSize].append((cx, cz))
+    tileOrder = sorted(tiles, key=lambda (tx, tz): ((tx * tileSize) >> 5, (tz * tileSize) >> 5, tx, tz))
+
+    if level.dimNo in (-1, 1):
+        lights = ("BlockLight",)
+    else:
+        lights = ("BlockLight", "SkyLight")
+
+    progressInfo = u"Lighting {0} chunks in {1} tiles with {2} processes".format(len(positions), len(tiles),
+                                                                                 processes)
+    log.info(progressInfo)
+
+    pool = multiprocessing.Pool(processes, _initLightWorker,
+                                (level.materials.lightEmission, level.materials.lightAbsorption, lights))
+    try:
+        # Keep a few tiles queued for each worker while the chunks of the next tiles are read.
+        pending = collections.deque()
+        remaining = iter(tileOrder)
+        done = 0
+        while done < len(tiles):
+            for tile in itertools.islice(remaining, processes * 2 - len(pending)):
+                pending.append((tile, pool.apply_async(_lightTile, (_readTile(level, tile, tileSize),))))
+
+            tile, result = pending.popleft()
+            tileLights = result.get()
+            if tileLights is None:
+                log.warning(u"None of the chunks of lighting tile {0} could be read; it is left unlit".format(tile))
+            else:
+                _writeTile(level, tile, tileSize, tiles[tile], lights, tileLights)
+            done += 1
+            yield done, len(tiles), progressInfo
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _readTile(level, (tx, tz), tileSize):
+    # The tile's blocks and the blocks of the chunks around it, and which of those chunks exist. None if none of
+    # them could be read.
+    size = tileSize + 2
+    x0, z0 = tx * tileSize - 1, tz * tileSize - 1
+    tilePositions = list(itertools.product(xrange(x0, x0 + size), xrange(z0, z0 + size)))
+    level.prefetchChunks(tilePositions)
+
+    blocks = None
+    present = zeros((size, size), bool)
+    for cx, cz in tilePositions:
+        try:
+            chunk = level.getChunk(cx, cz)
+        except (ChunkNotPresent, ChunkMalformed):
+            continue
+        if blocks is None:
+            blocks = zeros((size * 16, size * 16, level.Height), chunk.Blocks.dtype)
+        i, j = cx - x0, cz - z0
+        blocks[i * 16:(i + 1) * 16, j * 16:(j + 1) * 16] = chunk.Blocks
+        present[i, j] = True
+    if blocks is None:
+        return None
+
+    # Light does not change above the reach of the highest block; leave that out.
+    filled = blocks.any(0).any(0).nonzero()[0]
+    top = filled[-1] + 1 if len(filled) else 0
+    return blocks[:, :, :min(top + LIGHT_REACH + 1, level.Height)].copy(), present
+
+
+def _writeTile(level, (tx, tz), tileSize, positions, lights, tileLights):
+    x0, z0 = tx * tileSize, tz * tileSize
+    for cx, cz in positions:
+        try:
+            chunk = level.getChunk(cx, cz)
+        except (ChunkNotPresent, ChunkMalformed):
+            continue
+        i, j = cx - x0, cz - z0
+        for light, tileLight in zip(lights, tileLights):
+            chunkLight = getattr(chunk, light)
+            chunkLight[:, :, :tileLight.shape[2]] = tileLight[i * 16:(i + 1) * 16, j * 16:(j + 1) * 16]
+            chunkLight[:, :, tileLight.shape[2]:] = 15 if light == "SkyLight" else 0
+        if "SkyLight" not in lights:
+            chunk.SkyLight[:] = 0
+        chunk.dirty = True
+        chunk.needsLighting = False
+
+
+_lightWorkerTables = None
+
+
+def _initLightWorker(lightEmission, lightAbsorption, lights):
+    global _lightWorkerTables
+    _lightWorkerTables = lightEmission, lightAbsorption, lights
+
+
+def _lightTile(tile):
+    # Runs in a worker process. Returns the light arrays for the tile without its border, or None for a tile that
+    # _readTile could not read.
+    if tile is None:
+        return None
+    blocks, present = tile
+    lightEmission, lightAbsorption, lights = _lightWorkerTables
+    missing = ~present.repeat(16, 0).repeat(16, 1)
+
+    absorption = clip(lightAbsorption, 1, 15).astype('int16')[blocks]
+    absorption[missing] = 15
+
+    tileLights = []
+    for light in lights:
+        padded = zeros(tuple(n + 2 for n in blocks.shape), 'int16')
+        inner = padded[1:-1, 1:-1, 1:-1]
+        if light == "BlockLight":
+            inner[:] = lightEmission[blocks]
+        else:
+            inner[:] = directSkyLight(lightAbsorption, blocks)
+        inner[missing] = 0
+
+        relaxLight(padded, absorption)
+        tileLights.append(minimum(inner[16:-16, 16:-16], 15).astype('uint8'))
+
+    return tileLights
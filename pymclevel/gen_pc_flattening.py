@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Generates pc_flattening.json, the 1.13+ (flattened) Blockstates of the Java Edition blocks, from the pre-1.13
+Blockstates in pc_blockstates.json.
+
+Each ID/Data pair of pc_blockstates.json is renamed the way the 1.13 world upgrade renames it, and its properties are
+translated to the 1.13 ones. Properties that are not stored in the Data value (fence connections, stair shapes and
+the like) are left out, so that a 1.13 Blockstate matches its pair whatever their values are. The first Blockstate
+written for a pair is the one the pair is saved as; Blockstates that 1.13 added for an existing pair (bed colors,
+potted plants, skull types and so on) come after.
+
+Run it from the pymclevel folder after pc_blockstates.json changes::
+
+    python gen_pc_flattening.py
+"""
+import json
+import os
+from collections import OrderedDict
+
+COLORS = ["white", "orange", "magenta", "light_blue", "yellow", "lime", "pink", "gray", "light_gray", "cyan",
+          "purple", "blue", "brown", "green", "red", "black"]
+
+WOODS = ["oak", "spruce", "birch", "jungle", "acacia", "dark_oak"]
+
+# Plain renames
+RENAMED = {
+    "grass": "grass_block",
+    "flowing_water": "water",
+    "flowing_lava": "lava",
+    "noteblock": "note_block",
+    "golden_rail": "powered_rail",
+    "web": "cobweb",
+    "deadbush": "dead_bush",
+    "piston_extension": "moving_piston",
+    "yellow_flower": "dandelion",
+    "brick_block": "bricks",
+    "mob_spawner": "spawner",
+    "standing_sign": "sign",
+    "wooden_door": "oak_door",
+    "stone_stairs": "cobblestone_stairs",
+    "wooden_pressure_plate": "oak_pressure_plate",
+    "snow_layer": "snow",
+    "snow": "snow_block",
+    "reeds": "sugar_cane",
+    "fence": "oak_fence",
+    "pumpkin": "carved_pumpkin",
+    "lit_pumpkin": "jack_o_lantern",
+    "portal": "nether_portal",
+    "trapdoor": "oak_trapdoor",
+    "melon_block": "melon",
+    "fence_gate": "oak_fence_gate",
+    "waterlily": "lily_pad",
+    "nether_brick": "nether_bricks",
+    "wooden_button": "oak_button",
+    "quartz_ore": "nether_quartz_ore",
+    "slime": "slime_block",
+    "hardened_clay": "terracotta",
+    "end_bricks": "end_stone_bricks",
+    "magma": "magma_block",
+    "red_nether_brick": "red_nether_bricks",
+    "standing_banner": "white_banner",
+    "wall_banner": "white_wall_banner",
+    "bed": "red_bed",
+}
+
+# Blocks whose 1.13 name is taken from a property, which is left out
+VARIANT_NAMES = {
+    ("stone", "variant"): {"stone": "stone", "granite": "granite", "smooth_granite": "polished_granite",
+                           "diorite": "diorite", "smooth_diorite": "polished_diorite", "andesite": "andesite",
+                           "smooth_andesite": "polished_andesite"},
+    ("dirt", "variant"): {"dirt": "dirt", "coarse_dirt": "coarse_dirt", "podzol": "podzol"},
+    ("planks", "variant"): dict((w, w + "_planks") for w in WOODS),
+    ("sapling", "type"): dict((w, w + "_sapling") for w in WOODS),
+    ("sand", "variant"): {"sand": "sand", "red_sand": "red_sand"},
+    ("sandstone", "type"): {"sandstone": "sandstone", "chiseled_sandstone": "chiseled_sandstone",
+                            "smooth_sandstone": "cut_sandstone"},
+    ("red_sandstone", "type"): {"red_sandstone": "red_sandstone", "chiseled_red_sandstone": "chiseled_red_sandstone",
+                                "smooth_red_sandstone": "cut_red_sandstone"},
+    ("tallgrass", "type"): {"dead_bush": "dead_bush", "tall_grass": "grass", "fern": "fern"},
+    ("red_flower", "type"): {"poppy": "poppy", "blue_orchid": "blue_orchid", "allium": "allium",
+                             "houstonia": "azure_bluet", "red_tulip": "red_tulip", "orange_tulip": "orange_tulip",
+                             "white_tulip": "white_tulip", "pink_tulip": "pink_tulip", "oxeye_daisy": "oxeye_daisy"},
+    ("yellow_flower", "type"): {"dandelion": "dandelion"},
+    ("monster_egg", "variant"): {"stone": "infested_stone", "cobblestone": "infested_cobblestone",
+                                 "stone_brick": "infested_stone_bricks", "mossy_brick": "infested_mossy_stone_bricks",
+                                 "cracked_brick": "infested_cracked_stone_bricks",
+                                 "chiseled_brick": "infested_chiseled_stone_bricks"},
+    ("stonebrick", "variant"): {"stonebrick": "stone_bricks", "mossy_stonebrick": "mossy_stone_bricks",
+                                "cracked_stonebrick": "cracked_stone_bricks",
+                                "chiseled_stonebrick": "chiseled_stone_bricks"},
+    ("prismarine", "variant"): {"prismarine": "prismarine", "prismarine_bricks": "prismarine_bricks",
+                                "dark_prismarine": "dark_prismarine"},
+    ("cobblestone_wall", "variant"): {"cobblestone": "cobblestone_wall", "mossy_cobblestone": "mossy_cobblestone_wall"},
+    ("anvil", "damage"): {"0": "anvil", "1": "chipped_anvil", "2": "damaged_anvil"},
+    ("double_plant", "variant"): {"sunflower": "sunflower", "syringa": "lilac", "double_grass": "tall_grass",
+                                  "double_fern": "large_fern", "double_rose": "rose_bush", "paeonia": "peony"},
+}
+for _block in ("wool", "carpet", "stained_glass", "stained_glass_pane", "stained_hardened_clay"):
+    _suffix = "terracotta" if _block == "stained_hardened_clay" else _block
+    VARIANT_NAMES[_block, "color"] = dict((c if c != "light_gray" else "silver", c + "_" + _suffix) for c in COLORS)
+
+# Renamed properties
+RENAMED_PROPERTIES = {
+    "tnt": {"explode": "unstable"},
+    "stone_slab": {"half": "type"},
+    "stone_slab2": {"half": "type"},
+    "wooden_slab": {"half": "type"},
+    "purpur_slab": {"half": "type"},
+}
+
+# Properties that have no 1.13 counterpart, on top of the ones that aren't stored in the Data value
+DROPPED_PROPERTIES = {
+    "leaves": ("check_decay",),
+    "leaves2": ("check_decay",),
+    "flower_pot": ("contents", "legacy_data"),
+    "skull": ("nodrop",),
+}
+
+# Blockstates that 1.13 added for pairs that already have one. They are loaded as the pairs of the Blockstate they
+# are copied from, and are written after all the others.
+COPIES = [("cave_air", "air"), ("void_air", "air"), ("shulker_box", "purple_shulker_box")]
+COPIES.extend(("potted_" + plant, "flower_pot") for plant in
+              ["oak_sapling", "spruce_sapling", "birch_sapling", "jungle_sapling", "acacia_sapling",
+               "dark_oak_sapling", "fern", "dandelion", "poppy", "blue_orchid", "allium", "azure_bluet", "red_tulip",
+               "orange_tulip", "white_tulip", "pink_tulip", "oxeye_daisy", "red_mushroom", "brown_mushroom",
+               "dead_bush", "cactus"])
+COPIES.extend((color + "_bed", "red_bed") for color in COLORS if color != "red")
+COPIES.extend((color + "_banner", "white_banner") for color in COLORS if color != "white")
+COPIES.extend((color + "_wall_banner", "white_wall_banner") for color in COLORS if color != "white")
+for _skull in ("wither_skeleton_skull", "zombie_head", "player_head", "creeper_head", "dragon_head"):
+    COPIES.append((_skull, "skeleton_skull"))
+    COPIES.append((_skull.replace("_skull", "_wall_skull").replace("_head", "_wall_head"), "skeleton_wall_skull"))
+
+# Blockstates that 1.13 added for one pair; they are written after all the others
+ADDED = [("pumpkin", 86, 0, {}), ("attached_pumpkin_stem", 104, 7, {}), ("attached_melon_stem", 105, 7, {})]
+
+# 1.12 blocks that pc_blockstates.json doesn't describe
+FACINGS = ["down", "up", "north", "south", "west", "east"]
+SUPPLEMENT = []
+for _data in range(14):
+    if _data & 7 < 6:
+        SUPPLEMENT.append(("observer", 218, _data, {"facing": FACINGS[_data & 7],
+                                                    "powered": "true" if _data & 8 else "false"}))
+for _i, _color in enumerate(COLORS):
+    SUPPLEMENT.extend((_color + "_shulker_box", 219 + _i, _data, {"facing": _facing})
+                      for _data, _facing in enumerate(FACINGS))
+for _i, _color in enumerate(COLORS):
+    SUPPLEMENT.extend((_color + "_glazed_terracotta", 235 + _i, _data, {"facing": _facing})
+                      for _data, _facing in enumerate(["south", "west", "north", "east"]))
+SUPPLEMENT.extend((_color + "_concrete", 251, _i, {}) for _i, _color in enumerate(COLORS))
+SUPPLEMENT.extend((_color + "_concrete_powder", 252, _i, {}) for _i, _color in enumerate(COLORS))
+
+# Blocks that share their 1.13 Blockstates with another block are done after it, so that its pairs are the ones
+# the Blockstates are loaded as
+ORDER = {"flowing_water": 9.5, "flowing_lava": 11.5, "tallgrass": 32.5}
+
+
+def _fixedEntries(name, entries):
+    # pc_blockstates.json lists some blocks with the wrong Data values
+    if name == "brewing_stand":
+        return [dict(entry, **{"<data>": sum(1 << i for i in range(3) if entry["has_bottle_%d" % i] == "true")})
+                for entry in entries]
+    if name in ("daylight_detector", "daylight_detector_inverted"):
+        return [dict(entry, **{"<data>": int(entry["power"])}) for entry in entries]
+    return entries
+
+
+def _storedProperties(name, entries):
+    # The properties that are stored in the Data value: those that don't have the same value for all of them. Doors
+    # and tall plants keep some properties in one half and the rest in the other.
+    if name.endswith("_door"):
+        return lambda entry: (("facing", "half", "open") if entry["half"] == "lower" else ("half", "hinge", "powered"))
+    if name == "double_plant":
+        return lambda entry: ("half", "variant") if entry["half"] == "lower" else ("half",)
+    stored = set(key for key in entries[0] if key != "<data>" and len(set(entry[key] for entry in entries)) > 1)
+    stored.difference_update(DROPPED_PROPERTIES.get(name, ()))
+    # Variants are kept even if a block only has one, as they give its 1.13 name
+    stored.update(key for block, key in VARIANT_NAMES if block == name)
+    stored.update(key for key in ("variant",) if key in entries[0])
+    return lambda entry: stored
+
+
+def flatten(name, properties):
+    """
+    Returns the list of 1.13 (<name>, <properties>) Blockstates that a pre-1.13 Blockstate became; the first one is
+    the one it is saved as.
+    """
+    props = dict(properties)
+    for key, newKey in RENAMED_PROPERTIES.get(name, {}).items():
+        if key in props:
+            props[newKey] = props.pop(key)
+
+    if name == "double_plant" and props["half"] == "upper":
+        # The upper half doesn't tell which plant it belongs to
+        return [(plant, props) for plant in ["sunflower", "lilac", "tall_grass", "large_fern", "rose_bush", "peony"]]
+    for (block, key), names in VARIANT_NAMES.items():
+        if block == name:
+            return [(names[props.pop(key)], props)]
+
+    if name in ("log", "log2"):
+        wood = props.pop("variant")
+        if props["axis"] == "none":
+            return [(wood + "_wood", {})]
+        return [(wood + "_log", props)]
+    if name in ("leaves", "leaves2"):
+        return [(props.pop("variant") + "_leaves", {"persistent": "true" if props["decayable"] == "false" else "false"})]
+    if name == "sponge":
+        return [("wet_sponge" if props["wet"] == "true" else "sponge", {})]
+    if name == "quartz_block":
+        variant = props.pop("variant")
+        if variant.startswith("lines_"):
+            return [("quartz_pillar", {"axis": variant[-1]})]
+        return [("chiseled_quartz_block" if variant == "chiseled" else "quartz_block", {})]
+
+    if name in ("stone_slab", "double_stone_slab", "stone_slab2", "double_stone_slab2", "wooden_slab",
+                "double_wooden_slab", "purpur_slab", "purpur_double_slab"):
+        variant = props.pop("variant")
+        seamless = props.pop("seamless", "false")
+        material = {"stone": "stone", "wood_old": "petrified_oak", "stone_brick": "stone_brick", "default": "purpur"
+                    }.get(variant, variant)
+        if "double" not in name:
+            return [(material + "_slab", props)]
+        if seamless == "true" and variant in ("stone", "sandstone", "quartz", "red_sandstone"):
+            return [("smooth_" + variant, {})]
+        return [(material + "_slab", {"type": "double"})]
+
+    if name in ("torch", "redstone_torch", "unlit_redstone_torch"):
+        torch = "torch" if name == "torch" else "redstone_torch"
+        lit = {} if name == "torch" else {"lit": "true" if name == "redstone_torch" else "false"}
+        if props["facing"] == "up":
+            return [(torch, lit)]
+        return [(torch.replace("torch", "wall_torch"), dict(lit, facing=props["facing"]))]
+    if name == "lever":
+        face, facing = {"down_x": ("ceiling", "west"), "down_z": ("ceiling", "north"), "up_x": ("floor", "west"),
+                        "up_z": ("floor", "north")}.get(props["facing"], ("wall", props["facing"]))
+        return [(name, dict(props, face=face, facing=facing))]
+    if name in ("stone_button", "wooden_button"):
+        face, facing = {"down": ("ceiling", "north"), "up": ("floor", "north")}.get(props["facing"],
+                                                                                  ("wall", props["facing"]))
+        return [(RENAMED.get(name, name), dict(props, face=face, facing=facing))]
+    if name == "skull":
+        if props["facing"] == "down":
+            return []
+        if props["facing"] == "up":
+            return [("skeleton_skull", {})]
+        return [("skeleton_wall_skull", props)]
+    if name in ("brown_mushroom_block", "red_mushroom_block"):
+        variant = props.pop("variant")
+        if variant in ("stem", "all_stem"):
+            ends = "true" if variant == "all_stem" else "false"
+            return [("mushroom_stem", {"up": ends, "down": ends, "north": "true", "east": "true", "south": "true",
+                                       "west": "true"})]
+        sides = {"all_inside": "", "all_outside": "up down north east south west", "center": "up"}.get(
+            variant, "up " + variant.replace("_", " "))
+        return [(name, dict((side, "true" if side in sides.split() else "false") for side in
+                            ("up", "down", "north", "east", "south", "west")))]
+
+    if name in ("furnace", "lit_furnace"):
+        return [("furnace", dict(props, lit="true" if name == "lit_furnace" else "false"))]
+    if name in ("redstone_ore", "lit_redstone_ore", "redstone_lamp", "lit_redstone_lamp"):
+        return [(name.replace("lit_", ""), {"lit": "true" if name.startswith("lit_") else "false"})]
+    if name in ("unpowered_repeater", "powered_repeater"):
+        return [("repeater", dict(props, powered="true" if name.startswith("powered") else "false"))]
+    if name in ("unpowered_comparator", "powered_comparator"):
+        return [("comparator", props)]
+    if name in ("daylight_detector", "daylight_detector_inverted"):
+        return [("daylight_detector", dict(props, inverted="true" if name.endswith("inverted") else "false"))]
+
+    return [(RENAMED.get(name, name), props)]
+
+
+def generate(blockstates):
+    """
+    Returns the flattening table, in the format of pc_flattening.json, for the pre-1.13 Blockstates of
+    pc_blockstates.json
+    """
+    states = []  # (name, ID, data, properties), in the order they are written
+    alternatives = []
+    definitions = sorted(blockstates["minecraft"].items(), key=lambda item: ORDER.get(item[0], item[1]["id"]))
+    for name, definition in definitions:
+        entries = _fixedEntries(name, definition["properties"]) or [{"<data>": 0}]
+        stored = _storedProperties(name, entries)
+        for entry in sorted(entries, key=lambda e: e["<data>"]):
+            properties = dict((key, entry[key]) for key in stored(entry))
+            for i, (newName, newProperties) in enumerate(flatten(name, properties)):
+                (alternatives if i else states).append((newName, definition["id"], entry["<data>"], newProperties))
+    states.extend(SUPPLEMENT)
+    states.extend(alternatives)
+    for newName, name in COPIES:
+        states.extend((newName, bid, data, properties) for stateName, bid, data, properties in list(states)
+                      if stateName == name)
+    states.extend(ADDED)
+
+    # A Blockstate is only listed again for another pair if no Blockstate before it is saved for that pair
+    table = OrderedDict()
+    written = set()
+    pairs = set()
+    for name, bid, data, properties in states:
+        key = name, tuple(sorted(properties.items()))
+        if key in written and (bid, data) in pairs:
+            continue
+        written.add(key)
+        pairs.add((bid, data))
+        entry = OrderedDict([("<id>", bid), ("<data>", data)])
+        entry.update(key[1])
+        table.setdefault(name, []).append(entry)
+
+    result = OrderedDict()
+    for name, entries in table.items():
+        bid = entries[0]["<id>"]
+        for entry in entries:
+            if entry["<id>"] == bid:
+                del entry["<id>"]
+        result[name] = OrderedDict([("id", bid), ("properties", entries)])
+    return OrderedDict([("minecraft", result)])
+
+
+def main():
+    folder = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(folder, "pc_blockstates.json")) as f:
+        blockstates = json.load(f)
+    table = generate(blockstates)
+    with open(os.path.join(folder, "pc_flattening.json"), "w") as f:
+        f.write(json.dumps(table, indent=4, separators=(",", ": ")) + "\n")
+
+
+if __name__ == "__main__":
+    main()
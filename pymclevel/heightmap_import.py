@@ -0,0 +1,133 @@
+"""
+Terrain import from greyscale heightmap images.
+
+Every column of the terrain is determined by its height alone, so the blocks, skylight and HeightMap value of a
+column are computed once for each height and chunks are filled by looking their heights up in those tables. The
+image is read in strips of one region (512 rows) at a time. Binary PGM images are memory mapped, so only the strip
+being imported is read from disk; other formats are decoded by PIL into one greyscale copy of the image. Chunks go
+through the level's chunk cache, which writes them to its work folder in the background once it is full.
+"""
+
+from contextlib import contextmanager
+import logging
+import re
+
+from numpy import arange, asarray, clip, maximum, memmap, select, where
+
+from infiniteworld import MCInfdevOldLevel
+from mclevelbase import exhaust
+
+log = logging.getLogger(__name__)
+
+
+class HeightmapImage(object):
+    """
+    A greyscale heightmap. rows(start, stop) returns those rows as an array indexed [row, column]. maxValue is the
+    brightest possible value.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            header = f.read(512)
+
+        match = re.match(r"P5(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)\s", header)
+        if match:
+            self.width, self.height, self.maxValue = map(int, match.groups())
+            self._pixels = memmap(filename, '>u2' if self.maxValue > 255 else 'uint8', 'r', match.end(),
+                                  (self.height, self.width))
+        else:
+            from PIL import Image
+
+            image = Image.open(filename).convert("L")  # luminance
+            self.width, self.height = image.size
+            self.maxValue = 255
+            self._pixels = asarray(image)
+
+    def rows(self, start, stop):
+        return asarray(self._pixels[start:stop])
+
+
+def heightmapColumns(level, heightLimit, waterLevel=64):
+    """
+    Returns the blocks of the column for each height below heightLimit, indexed [height, y], with the column's
+    skylight and HeightMap value. Columns are stone with four blocks of dirt and a block of grass on top, or sand if
+    they are within a block of the water level, covered with water up to the water level.
+    """
+    materials = level.materials
+    y = arange(level.Height)
+    h = arange(heightLimit)[:, None]
+
+    blocks = select([y == 0,
+                     (h < waterLevel + 2) & (y >= h - 2) & (y <= h),
+                     (y > h) & (y < waterLevel),
+                     y == h,
+                     (y >= h - 4) & (y < h),
+                     y < h - 4],
+                    [materials.Bedrock.ID, materials.Sand.ID, materials.Water.ID, materials.Grass.ID,
+                     materials.Dirt.ID, materials.Stone.ID]).astype('uint16')
+
+    # The same light genFastLights gives: full light above the highest block that absorbs any, then one level less
+    # for each block below it, or more for blocks that absorb more.
+    absorption = materials.lightAbsorption[blocks]
+    top = level.Height - (absorption > 0)[:, ::-1].argmax(1)
+    top[~(absorption > 0).any(1)] = 0
+    absorption = where(y < top[:, None], maximum(absorption, 1), 0).astype(int)
+    skyLight = clip(15 - absorption[:, ::-1].cumsum(1)[:, ::-1], 0, 15).astype('uint8')
+    if level.dimNo in (-1, 1):
+        skyLight[:] = 0
+
+    return blocks, skyLight, top
+
+
+def importHeightmap(level, image, waterLevel=64):
+    return exhaust(importHeightmapIter(level, image, waterLevel))
+
+
+def importHeightmapIter(level, image, waterLevel=64):
+    """ Imports image, a HeightmapImage, as terrain starting at chunk 0, 0. Image rows run along X and columns
+    along Z. Brightness is scaled to heights from 0 to half of the level's height. Yields (done, total, info)
+    progress tuples like generateLightsIter. """
+
+    heightLimit = level.Height / 2
+    blockColumns, skyColumns, topColumns = heightmapColumns(level, heightLimit, waterLevel)
+
+    xchunks = (image.height + 15) / 16
+    zchunks = (image.width + 15) / 16
+    progressInfo = u"Importing a {0}x{1} heightmap".format(image.height, image.width)
+    log.info(progressInfo)
+
+    # Chunks evicted from the cache while a strip is imported have their region headers written once, at its end.
+    anvil = isinstance(level, MCInfdevOldLevel) and not level.readonly
+
+    done = 0
+    for rx in xrange((xchunks + 31) / 32):
+        # One region's rows of the image at a time
+        strip = image.rows(rx * 512, rx * 512 + 512).astype('uint32')
+        strip = (strip * heightLimit / (image.maxValue + 1)).astype('intp')
+
+        with level.unsavedWorkFolder.batch() if anvil else _noBatch():
+            for cx in xrange(rx * 32, min(rx * 32 + 32, xchunks)):
+                for cz in xrange(zchunks):
+                    tile = strip[(cx & 0x1f) * 16:(cx & 0x1f) * 16 + 16, cz * 16:cz * 16 + 16]
+                    w, l = tile.shape
+
+                    if not level.containsChunk(cx, cz):
+                        level.createChunk(cx, cz)
+                    chunk = level.getChunk(cx, cz)
+                    chunk.Blocks[:w, :l] = blockColumns[tile]
+                    chunk.Data[:w, :l] = 0
+                    chunk.SkyLight[:w, :l] = skyColumns[tile]
+                    chunk.HeightMap[:l, :w] = topColumns[tile].T
+                    chunk.TerrainPopulated = False
+                    chunk.dirty = True
+
+                    done += 1
+                    yield done, xchunks * zchunks, progressInfo
+
+            if anvil:
+                level.finishChunkEvictions(wait=True)
+
+
+@contextmanager
+def _noBatch():
+    yield
@@ -5,10 +5,14 @@ Created on Jul 22, 2011
 '''
 import collections
 
+from contextlib import contextmanager
 from datetime import datetime
+import hashlib
 import itertools
 from logging import getLogger
 from math import floor
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import random
 import shutil
@@ -20,14 +24,15 @@ import zlib
 import sys
 
 from box import BoundingBox
+import directories
 from entity import Entity, TileEntity, TileTick
 from faces import FaceXDecreasing, FaceXIncreasing, FaceZDecreasing, FaceZIncreasing
 from level import LightedChunk, EntityLevel, computeChunkHeightMap, MCLevel, ChunkBase
 from materials import alphaMaterials
 from mclevelbase import ChunkMalformed, ChunkNotPresent, ChunkAccessDenied,ChunkConcurrentException,exhaust, PlayerNotFound
 import nbt
-from numpy import array, clip, maximum, zeros, asarray, unpackbits, arange
-from regionfile import MCRegionFile
+from numpy import array, clip, maximum, zeros, asarray, arange, bitwise_or, unique
+from regionfile import MCRegionFile, RegionChunkIndex, readRegionOffsets
 import logging
 from uuid import UUID
 import id_definitions
@@ -45,6 +50,22 @@ class SessionLockLost(IOError):
     pass
 
 
+_chunkLoadPool = None
+
+
+def chunkLoadPool():
+    """ Threads used to inflate and parse chunks ahead of time. zlib releases the GIL while it inflates, so this
+    scales with the number of cores even though the NBT parsing itself does not. """
+    global _chunkLoadPool
+    if _chunkLoadPool is None:
+        _chunkLoadPool = ThreadPool(max(1, multiprocessing.cpu_count()))
+    return _chunkLoadPool
+
+
+def _compressChunkData(chunkData):
+    return MCRegionFile.compress(chunkData.savedTagData())
+
+
 def ZeroChunk(height=512):
     z = _zeros.get(height)
     if z is None:
@@ -82,6 +103,62 @@ def packNibbleArray(unpackedData):
     return array(packedData[:, :, :, 1])
 
 
+_blockStatesLayouts = {}
+
+
+def _blockStatesLayout(bits, count, longCount=None, padded=False):
+    # Returns whether the layout is padded, the long and bit offset of each value in a BlockStates array, the
+    # values whose bits run on into the next long, and the number of longs. Values either run on from one long into
+    # the next (1.13 to 1.15), or don't cross longs and leave the top bits unused (1.16+). The two layouts are the
+    # same when bits divides 64. If longCount is given, the layout is the one it matches.
+    valuesPerLong = 64 // bits
+    runOnCount = -(-count * bits // 64)
+    paddedCount = -(-count // valuesPerLong)
+    if longCount is not None:
+        if longCount not in (runOnCount, paddedCount):
+            raise ValueError("BlockStates has {0} longs, expected {1} or {2}".format(longCount, runOnCount, paddedCount))
+        padded = longCount != runOnCount
+
+    key = bits, count, padded
+    layout = _blockStatesLayouts.get(key)
+    if layout is None:
+        index = arange(count, dtype='uint64')
+        if padded:
+            word, offset = index // valuesPerLong, (index % valuesPerLong) * bits
+            spill = zeros(0, 'intp')
+            longCount = paddedCount
+        else:
+            bitIndex = index * bits
+            word, offset = bitIndex >> 6, bitIndex & 63
+            spill = (offset + bits > 64).nonzero()[0]
+            longCount = runOnCount
+        layout = _blockStatesLayouts[key] = padded, word.astype('intp'), offset, spill, longCount
+    return layout
+
+
+def unpackBlockStates(longArray, bits, count=4096):
+    """ Unpacks count values of the given number of bits from a BlockStates long array. Returns the values and
+    whether the array used the 1.16+ padded layout. """
+    longs = asarray(longArray).astype('>i8').view('>u8').astype('uint64')
+    padded, word, offset, spill, _ = _blockStatesLayout(bits, count, len(longs))
+
+    values = longs[word] >> offset
+    values[spill] |= longs[word[spill] + 1] << (64 - offset[spill])
+    values &= (1 << bits) - 1
+    return values, padded
+
+
+def packBlockStates(values, bits, padded=False):
+    """ Packs values of the given number of bits into a BlockStates long array, the inverse of unpackBlockStates. """
+    values = asarray(values, 'uint64')
+    padded, word, offset, spill, longCount = _blockStatesLayout(bits, len(values), padded=padded)
+
+    longs = zeros(longCount, 'uint64')
+    bitwise_or.at(longs, word, values << offset)
+    bitwise_or.at(longs, word[spill] + 1, values[spill] >> (64 - offset[spill]))
+    return longs.view('int64').astype('>i8')
+
+
 def sanitizeBlocks(chunk):
     # change grass to dirt where needed so Minecraft doesn't flip out and die
     grass = chunk.Blocks == chunk.materials.Grass.ID
@@ -109,17 +186,33 @@ class AnvilChunkData(object):
      not keep references to a whole lot of chunks or else it will run out of memory.
     """
 
+    # dtype and fill value of each block and light array. Blocks in sections that aren't stored hold the fill value.
+    arrayTypes = {
+        "Blocks": ('uint16', 0),
+        "Data": ('uint8', 0),
+        "BlockLight": ('uint8', 0),
+        "SkyLight": ('uint8', 15),
+    }
+
     def __init__(self, world, chunkPosition, root_tag=None, create=False):
         self.chunkPosition = chunkPosition
         self.world = world
         self.root_tag = root_tag
         self.dirty = False
 
-        self.Blocks = zeros((16, 16, world.Height), 'uint16')
-        self.Data = zeros((16, 16, world.Height), 'uint8')
-        self.BlockLight = zeros((16, 16, world.Height), 'uint8')
-        self.SkyLight = zeros((16, 16, world.Height), 'uint8')
-        self.SkyLight[:] = 15
+        # The block and light arrays are kept as 16x16x16 sections indexed [x,z,y], leaving out the sections that
+        # only hold the array's fill value. A full height array is put together the first time the array is used.
+        # Sections read from the file stay packed as they were saved until they are used.
+        self._packed = dict((name, {}) for name in self.arrayTypes)
+        self._sections = dict((name, {}) for name in self.arrayTypes)
+        self._arrays = {}
+
+        # None if the chunk's sections have Blocks and Data arrays. Otherwise they have a block Palette and a
+        # BlockStates array (1.13+), and this tells whether BlockStates uses the padded layout of 1.16+.
+        self._blockStatesPadded = None
+        # sy -> (Palette, BlockStates, palette indices, and the ID and data of each palette entry) of each 1.13+
+        # section as it was loaded or last saved
+        self._blockStates = {}
 
         if create:
             self._create()
@@ -154,79 +247,269 @@ class AnvilChunkData(object):
 
         self.dirty = True
 
-    def _get_blocks_and_data_from_blockstates(self, section):
-        long_array = section["BlockStates"].value
-        bits_amount = len(long_array) / 64
-        binary_blocks = unpackbits(long_array[::-1].astype(">i8").view("uint8")).reshape(-1, bits_amount)
-        blocks_before_palette = binary_blocks.dot(2**arange(binary_blocks.shape[1]-1, -1, -1))[::-1]
-        blocks = asarray(section["Palette"].value, dtype="object")[blocks_before_palette]
-        raise NotImplementedError("1.13 version not supported yet")
+    def _get_blocks_and_data_from_blockstates(self, section, sy):
+        # Decodes a 1.13+ section's Palette and BlockStates into Blocks and Data sections indexed [x,z,y]. The
+        # section's tags are kept, so that it is saved as it was loaded unless its blocks change.
+        palette = section["Palette"]
+        bits = max(4, (len(palette) - 1).bit_length())
+        indices, padded = unpackBlockStates(section["BlockStates"].value, bits)
+        if 64 % bits or self._blockStatesPadded is None:
+            # Only sections whose layouts differ tell which one the chunk uses
+            self._blockStatesPadded = padded
+
+        ids, data = self.materials.blockstate_api.paletteToIDs(palette)[:2]
+        indices = indices.astype('uint16')
+        self._blockStates[sy] = palette, section["BlockStates"], indices, ids, data
+        indices = indices.reshape(16, 16, 16).swapaxes(0, 2)
+        return ids[indices], data[indices]
+
+    def _set_blockstates_from_blocks_and_data(self, section, sy):
+        # Encodes section sy of Blocks and Data as a 1.13+ Palette and BlockStates. A section whose blocks are the
+        # ones it was loaded with is saved with the tags it was loaded with. Otherwise the blocks that are unchanged
+        # keep their palette entry, and the others are named through the flattening table. Blockstates with no ID
+        # are loaded as air, so they are kept unless another block is put in their place.
+        Blocks = self.getSection("Blocks", sy).swapaxes(0, 2).ravel()
+        Data = self.getSection("Data", sy).swapaxes(0, 2).ravel()
+        api = self.materials.blockstate_api
+
+        loaded = self._blockStates.get(sy)
+        if loaded is not None:
+            paletteTag, statesTag, indices, ids, data = loaded
+            changed = (ids[indices] != Blocks) | (data[indices] != Data)
+            if not changed.any():
+                bits = max(4, (len(paletteTag) - 1).bit_length())
+                if len(statesTag.value) != _blockStatesLayout(bits, 4096, padded=self._blockStatesPadded)[4]:
+                    # Saved in the chunk's layout, if the section was loaded in the other one
+                    statesTag = nbt.TAG_Long_Array(packBlockStates(indices, bits, self._blockStatesPadded))
+                    self._blockStates[sy] = paletteTag, statesTag, indices, ids, data
+                section["Palette"] = paletteTag
+                section["BlockStates"] = statesTag
+                return
+
+            entries = list(paletteTag)
+            indices = indices.astype('intp')
+        else:
+            changed = slice(None)
+            entries = []
+            indices = zeros(4096, 'intp')
+
+        palette, newIndices = api.idsToPalette(Blocks[changed], Data[changed])
+        if None in palette:
+            keys = (Blocks[changed].astype('uint32') << 4) | Data[changed]
+            pairs = sorted(set(u"{0}:{1}".format(key >> 4, key & 0xf) for key, state in
+                               zip(keys, (palette[i] for i in newIndices)) if state is None))
+            log.warning(u"Section {0} of chunk {1} holds blocks with no known 1.13 Blockstate; they are saved as the "
+                        u"block they replaced, or as air: {2}".format(sy, self.chunkPosition, u", ".join(pairs)))
+
+        # New blocks use the palette entry of the same Blockstate if there is one
+        entryIndex = dict((api.paletteEntryKey(entry), i) for i, entry in reversed(list(enumerate(entries))))
+        stateIndices = []
+        for state in palette:
+            if state is None:
+                if loaded is not None:
+                    stateIndices.append(-1)
+                    continue
+                state = api.idToFlattenedBlockstate(0, 0)
+            name, properties = state
+            entry = nbt.TAG_Compound()
+            entry["Name"] = nbt.TAG_String(name)
+            if properties:
+                entry["Properties"] = nbt.TAG_Compound([nbt.TAG_String(v, k) for k, v in sorted(properties.items())])
+            key = api.paletteEntryKey(entry)
+            if key not in entryIndex:
+                entryIndex[key] = len(entries)
+                entries.append(entry)
+            stateIndices.append(entryIndex[key])
+        newStates = array(stateIndices, 'intp')[newIndices]
+        unnamed = newStates == -1
+        newStates[unnamed] = indices[changed][unnamed]
+        indices[changed] = newStates
+
+        # Entries no longer used are left out
+        used, indices = unique(indices, return_inverse=True)
+        paletteTag = nbt.TAG_List([entries[i] for i in used])
+        bits = max(4, (len(paletteTag) - 1).bit_length())
+        statesTag = nbt.TAG_Long_Array(packBlockStates(indices, bits, self._blockStatesPadded))
+        section["Palette"] = paletteTag
+        section["BlockStates"] = statesTag
+
+        # The saved tags are what the next save compares with
+        ids, data = api.paletteToIDs(paletteTag)[:2]
+        self._blockStates[sy] = paletteTag, statesTag, indices.astype('uint16'), ids, data
 
     def _load(self, root_tag):
         self.root_tag = root_tag
+        packed = self._packed
 
         for sec in self.root_tag["Level"].pop("Sections", []):
-            y = sec["Y"].value * 16
+            sy = sec["Y"].value
 
-            values_to_get = ["SkyLight", "BlockLight"]
             if "Blocks" in sec and "Data" in sec:
-                values_to_get.extend(["Blocks", "Data"])
-            else:
-                Blocks, Data = self._get_blocks_and_data_from_blockstates(sec)
-                self.Blocks[..., y:y + 16], self.Data[..., y:y + 16] = Blocks, Data
-
-            for name in values_to_get:
-                arr = getattr(self, name)
-                secarray = sec[name].value
-                if name == "Blocks":
-                    secarray.shape = (16, 16, 16)
-                else:
-                    secarray.shape = (16, 16, 8)
-                    secarray = unpackNibbleArray(secarray)
+                add = sec.get("Add")
+                packed["Blocks"][sy] = sec["Blocks"].value, add.value if add is not None else None
+                packed["Data"][sy] = sec["Data"].value
+            elif "BlockStates" in sec and "Palette" in sec:
+                Blocks, Data = self._get_blocks_and_data_from_blockstates(sec, sy)
+                if Blocks.any():
+                    self._sections["Blocks"][sy] = Blocks
+                if Data.any():
+                    self._sections["Data"][sy] = Data
+
+            for name in ("BlockLight", "SkyLight"):
+                if name in sec:
+                    packed[name][sy] = sec[name].value
 
-                arr[..., y:y + 16] = secarray.swapaxes(0, 2)
+    @staticmethod
+    def _unpackSection(name, packed):
+        # Turns a section as it is saved into a 16x16x16 array indexed [x,z,y].
+        if name == "Blocks":
+            blocks, add = packed
+            secarray = array(blocks.reshape(16, 16, 16), 'uint16')
+            if add is not None:
+                secarray |= array(unpackNibbleArray(add.reshape(16, 16, 8)), 'uint16') << 8
+        else:
+            secarray = unpackNibbleArray(packed.reshape(16, 16, 8))
+        return secarray.swapaxes(0, 2)
+
+    def _packSection(self, name, sy):
+        # Returns section sy as it is saved: a nibble array, or the Blocks and Add arrays for Blocks. Sections that
+        # were never unpacked are returned as they were loaded.
+        packed = self._packed[name].get(sy)
+        if packed is not None:
+            return packed
+
+        secarray = self.getSection(name, sy).swapaxes(0, 2)
+        if name == "Blocks":
+            add = secarray >> 8
+            return array(secarray, 'uint8'), packNibbleArray(add).astype('uint8') if add.any() else None
+        return packNibbleArray(secarray)
+
+    def _unpackedSection(self, name, sy):
+        # Returns section sy of the named array, or None if it only holds the fill value.
+        packed = self._packed[name].pop(sy, None)
+        if packed is not None:
+            section = self._unpackSection(name, packed)
+            # Sections are saved when any of their arrays is not empty; only keep the arrays that aren't.
+            if (section != self.arrayTypes[name][1]).any():
+                self._sections[name][sy] = section
+        return self._sections[name].get(sy)
+
+    def _getArray(self, name):
+        arr = self._arrays.get(name)
+        if arr is None:
+            dtype, fill = self.arrayTypes[name]
+            arr = zeros((16, 16, self.world.Height), dtype)
+            if fill:
+                arr[:] = fill
+            packed = self._packed[name]
+            for sy, section in packed.iteritems():
+                arr[..., sy << 4:(sy + 1) << 4] = self._unpackSection(name, section)
+            sections = self._sections[name]
+            for sy, section in sections.iteritems():
+                arr[..., sy << 4:(sy + 1) << 4] = section
+            self._arrays[name] = arr
+            packed.clear()
+            sections.clear()
+
+            # Let the world's chunk cache count the new array. Worlds without a chunk cache don't track this.
+            resized = getattr(self.world, "chunkDataResized", None)
+            if resized is not None:
+                resized(self)
+        return arr
+
+    def _setArray(self, name, value):
+        self._arrays[name] = value
+        self._packed[name].clear()
+        self._sections[name].clear()
+
+    Blocks = property(lambda self: self._getArray("Blocks"), lambda self, value: self._setArray("Blocks", value))
+    Data = property(lambda self: self._getArray("Data"), lambda self, value: self._setArray("Data", value))
+    BlockLight = property(lambda self: self._getArray("BlockLight"),
+                          lambda self, value: self._setArray("BlockLight", value))
+    SkyLight = property(lambda self: self._getArray("SkyLight"), lambda self, value: self._setArray("SkyLight", value))
+
+    def copySectionsFrom(self, other):
+        """ Replaces the block and light arrays with those of another chunk of the same height, without unpacking
+        any sections, and saves them in the other chunk's section format. Packed and unpacked sections are never
+        modified in place, so they are shared; full height arrays are copied. """
+        for name in self.arrayTypes:
+            self._packed[name] = dict(other._packed[name])
+            self._sections[name] = dict(other._sections[name])
+        self._arrays = dict((name, arr.copy()) for name, arr in other._arrays.iteritems())
+        self._blockStatesPadded = other._blockStatesPadded
+        self._blockStates = dict(other._blockStates)
+        self.dirty = True
 
-            tag = sec.get("Add")
-            if tag is not None:
-                tag.value.shape = (16, 16, 8)
-                add = unpackNibbleArray(tag.value)
-                self.Blocks[..., y:y + 16] |= (array(add, 'uint16') << 8).swapaxes(0, 2)
+        resized = getattr(self.world, "chunkDataResized", None)
+        if resized is not None:
+            resized(self)
+
+    def getSection(self, name, sy):
+        """ Returns the 16x16x16 section sy of the named array, indexed [x,z,y], without putting together the full
+        height array or unpacking the other sections. The result may be a view of the array or a new array, and
+        should not be modified. """
+        arr = self._arrays.get(name)
+        if arr is not None:
+            return arr[..., sy << 4:(sy + 1) << 4]
+        section = self._unpackedSection(name, sy)
+        if section is None:
+            dtype, fill = self.arrayTypes[name]
+            section = zeros((16, 16, 16), dtype)
+            if fill:
+                section[:] = fill
+        return section
+
+    def compact(self):
+        """ Splits the full height arrays back into sections, leaving out the sections that only hold the fill value.
+        Arrays returned by Blocks, Data and so on before this call are no longer part of the chunk. Returns the
+        number of bytes released. """
+        nbytes = self.nbytes
+        for name, arr in self._arrays.items():
+            dtype, fill = self.arrayTypes[name]
+            sections = self._sections[name]
+            for sy in xrange(arr.shape[2] >> 4):
+                section = arr[..., sy << 4:(sy + 1) << 4]
+                if (section != fill).any():
+                    sections[sy] = section.copy()
+        self._arrays.clear()
+        return nbytes - self.nbytes
 
     def savedTagData(self):
         """ does not recalculate any data or light """
 
         log.debug(u"Saving chunk: {0}".format(self))
-        sanitizeBlocks(self)
+        if "Blocks" in self._arrays:
+            # Sections that were never unpacked are saved as they were loaded.
+            sanitizeBlocks(self)
 
         sections = nbt.TAG_List()
         append = sections.append
-        for y in xrange(0, self.world.Height, 16):
-            section = nbt.TAG_Compound()
-
-            Blocks = self.Blocks[..., y:y + 16].swapaxes(0, 2)
-            Data = self.Data[..., y:y + 16].swapaxes(0, 2)
-            BlockLight = self.BlockLight[..., y:y + 16].swapaxes(0, 2)
-            SkyLight = self.SkyLight[..., y:y + 16].swapaxes(0, 2)
-
-            if (not Blocks.any() and
-                    not BlockLight.any() and
-                    (SkyLight == 15).all()):
+        for sy in xrange(self.world.Height >> 4):
+            if not any(name in self._arrays or sy in self._sections[name] or sy in self._packed[name]
+                       for name in self.arrayTypes) and sy not in self._blockStates:
                 continue
 
-            Data = packNibbleArray(Data)
-            BlockLight = packNibbleArray(BlockLight)
-            SkyLight = packNibbleArray(SkyLight)
+            if not any(sy in self._packed[name] for name in self.arrayTypes) and sy not in self._blockStates:
+                if (not self.getSection("Blocks", sy).any() and
+                        not self.getSection("BlockLight", sy).any() and
+                        (self.getSection("SkyLight", sy) == 15).all()):
+                    continue
 
-            add = Blocks >> 8
-            if add.any():
-                section["Add"] = nbt.TAG_Byte_Array(packNibbleArray(add).astype('uint8'))
+            section = nbt.TAG_Compound()
 
-            section['Blocks'] = nbt.TAG_Byte_Array(array(Blocks, 'uint8'))
-            section['Data'] = nbt.TAG_Byte_Array(array(Data))
-            section['BlockLight'] = nbt.TAG_Byte_Array(array(BlockLight))
-            section['SkyLight'] = nbt.TAG_Byte_Array(array(SkyLight))
+            if self._blockStatesPadded is not None:
+                self._set_blockstates_from_blocks_and_data(section, sy)
+            else:
+                Blocks, add = self._packSection("Blocks", sy)
+                if add is not None:
+                    section["Add"] = nbt.TAG_Byte_Array(add)
 
-            section["Y"] = nbt.TAG_Byte(y / 16)
+                section['Blocks'] = nbt.TAG_Byte_Array(Blocks)
+                section['Data'] = nbt.TAG_Byte_Array(self._packSection("Data", sy))
+            section['BlockLight'] = nbt.TAG_Byte_Array(self._packSection("BlockLight", sy))
+            section['SkyLight'] = nbt.TAG_Byte_Array(self._packSection("SkyLight", sy))
+
+            section["Y"] = nbt.TAG_Byte(sy)
             append(section)
 
         self.root_tag["Level"]["Sections"] = sections
@@ -240,6 +523,19 @@ class AnvilChunkData(object):
     def materials(self):
         return self.world.materials
 
+    @property
+    def nbytes(self):
+        """ Memory used by the block and light arrays. The chunk cache budget is counted in these bytes. """
+        nbytes = sum(arr.nbytes for arr in self._arrays.itervalues())
+        nbytes += sum(section.nbytes for sections in self._sections.itervalues() for section in sections.itervalues())
+        for name, packed in self._packed.iteritems():
+            if name == "Blocks":
+                nbytes += sum(blocks.nbytes + (add.nbytes if add is not None else 0) for blocks, add in packed.itervalues())
+            else:
+                nbytes += sum(section.nbytes for section in packed.itervalues())
+        nbytes += sum(loaded[2].nbytes for loaded in self._blockStates.itervalues())
+        return nbytes
+
 
 class AnvilChunk(LightedChunk):
     """ This is a 16x16xH chunk in an (infinite) world.
@@ -605,6 +901,8 @@ class ChunkedLevelMixin(MCLevel):
 
     createChunk = NotImplemented
 
+    from block_light import relightBoxes, relightBoxesIter, lightChunksParallel, lightChunksParallelIter
+
     def generateLights(self, dirtyChunkPositions=None):
         return exhaust(self.generateLightsIter(dirtyChunkPositions))
 
@@ -616,12 +914,25 @@ class ChunkedLevelMixin(MCLevel):
         startTime = datetime.now()
 
         if dirtyChunkPositions is None:
+            if self.incrementalLighting and self.lightingDirtyBoxes:
+                boxes, self.lightingDirtyBoxes = self.lightingDirtyBoxes, []
+                log.info(u"Relighting around {0} edits".format(len(boxes)))
+                for status in self.relightBoxesIter(boxes):
+                    yield status
             dirtyChunkPositions = self.chunksNeedingLighting
         else:
             dirtyChunkPositions = (c for c in dirtyChunkPositions if self.containsChunk(*c))
 
         dirtyChunkPositions = sorted(dirtyChunkPositions)
 
+        # Starting the worker processes is only worth it for enough chunks.
+        processes = getattr(self, 'lightingProcesses', 1)
+        if processes > 1 and len(dirtyChunkPositions) >= getattr(self, 'lightingProcessMinChunks', 1):
+            for status in self.lightChunksParallelIter(dirtyChunkPositions, processes):
+                yield status
+            log.info(u"Completed in {0}".format(datetime.now() - startTime))
+            return
+
         maxLightingChunks = getattr(self, 'loadedChunkLimit', 400)
 
         log.info(u"Asked to light {0} chunks".format(len(dirtyChunkPositions)))
@@ -956,6 +1267,10 @@ def TagProperty(tagName, tagType, default_or_func=None):
 
 
 class AnvilWorldFolder(object):
+    useChunkIndex = True  # if True, listChunks keeps a sidecar index so unchanged region headers are not read again
+    compactFreeFraction = 0.5  # deleteChunks(compact=True) compacts regions with more than this fraction free
+    chunkIndexFolder = None  # where the chunk indexes are kept; the ChunkIndex folder of the cache folder if None
+
     def __init__(self, filename):
         if not os.path.exists(filename):
             os.mkdir(filename)
@@ -965,6 +1280,12 @@ class AnvilWorldFolder(object):
 
         self.filename = filename
         self.regionFiles = {}
+        self._batchDepth = 0
+        self._batchedRegions = []
+        self._chunkIndex = None
+        # maps (rx, rz) to one bool per chunk for regions that are not open, False for every chunk if the region file
+        # does not exist
+        self._regionPresence = {}
 
     # --- File paths ---
 
@@ -991,6 +1312,10 @@ class AnvilWorldFolder(object):
         if regionFile:
             return regionFile
         regionFile = MCRegionFile(self.getRegionFilename(rx, rz), (rx, rz))
+        self._regionPresence.pop((rx, rz), None)
+        if self._batchDepth:
+            regionFile.beginBatch()
+            self._batchedRegions.append(regionFile)
         self.regionFiles[rx, rz] = regionFile
         return regionFile
 
@@ -1004,22 +1329,57 @@ class AnvilWorldFolder(object):
             rf.close()
 
         self.regionFiles = {}
+        # Closed regions may be removed from outside, e.g. when the work folder is cleared after saving.
+        self._regionPresence = {}
+
+    def compactRegions(self):
+        """
+        Compacts every open region file, removing the free sectors between chunks. Returns the number of sectors
+        removed.
+        """
+        return sum(rf.compact() for rf in self.regionFiles.values())
+
+    @contextmanager
+    def batch(self):
+        """
+        Defers region header writes for every region file used inside the block. Each region writes its offset and
+        timestamp tables once when the block exits, instead of once per saved chunk.
+        """
+        self._batchDepth += 1
+        if self._batchDepth == 1:
+            self._batchedRegions = self.regionFiles.values()
+            for rf in self._batchedRegions:
+                rf.beginBatch()
+        try:
+            yield self
+        finally:
+            self._batchDepth -= 1
+            if not self._batchDepth:
+                batchedRegions, self._batchedRegions = self._batchedRegions, []
+                for rf in batchedRegions:
+                    rf.endBatch()
 
     # --- Chunks and chunk listing ---
 
     @staticmethod
-    def tryLoadRegionFile(filepath):
+    def regionCoordsForPath(filepath):
         filename = os.path.basename(filepath)
         bits = filename.split('.')
         if len(bits) < 4 or bits[0] != 'r' or bits[3] != "mca":
             return None
 
         try:
-            rx, rz = map(int, bits[1:3])
+            return tuple(map(int, bits[1:3]))
         except ValueError:
             return None
 
-        return MCRegionFile(filepath, (rx, rz))
+    @classmethod
+    def tryLoadRegionFile(cls, filepath):
+        regionCoords = cls.regionCoordsForPath(filepath)
+        if regionCoords is None:
+            return None
+
+        return MCRegionFile(filepath, regionCoords)
 
     def findRegionFiles(self):
         regionDir = self.getFolderPath("region", generation=True)
@@ -1028,41 +1388,82 @@ class AnvilWorldFolder(object):
         for filename in regionFiles:
             yield os.path.join(regionDir, filename)
 
+    @property
+    def chunkIndex(self):
+        if self._chunkIndex is None:
+            self._chunkIndex = RegionChunkIndex(self.chunkIndexPath())
+        return self._chunkIndex
+
+    def chunkIndexPath(self):
+        # The index is kept out of the world folder, so that nothing is written there for it, under a name made
+        # from the folder's path.
+        path = os.path.abspath(self.filename)
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        folder = self.chunkIndexFolder or os.path.join(directories.getCacheDir(), u"ChunkIndex")
+        return os.path.join(folder, hashlib.sha1(path).hexdigest())
+
     def listChunks(self):
         chunks = set()
 
+        # Region files are stat()ed and read from disk below, so pending header writes have to land first.
+        for rf in self.regionFiles.values():
+            rf.flushHeader()
+
+        chunkIndex = self.chunkIndex if self.useChunkIndex else None
+        foundRegions = []
         for filepath in self.findRegionFiles():
-            regionFile = self.tryLoadRegionFile(filepath)
-            if regionFile is None:
+            regionCoords = self.regionCoordsForPath(filepath)
+            if regionCoords is None:
                 continue
 
-            if regionFile.offsets.any():
-                rx, rz = regionFile.regionCoords
-                self.regionFiles[rx, rz] = regionFile
-
-                for index, offset in enumerate(regionFile.offsets):
-                    if offset:
-                        cx = index & 0x1f
-                        cz = index >> 5
-
-                        cx += rx << 5
-                        cz += rz << 5
-
-                        chunks.add((cx, cz))
+            # An open region's offset table is already in memory.
+            regionFile = self.regionFiles.get(regionCoords)
+            offsets = regionFile.offsets if regionFile is not None else None
+            if chunkIndex is not None:
+                indices = chunkIndex.chunkIndices(regionCoords, filepath, offsets)
+            else:
+                indices = (offsets if offsets is not None else readRegionOffsets(filepath)).nonzero()[0]
+
+            if len(indices):
+                rx, rz = regionCoords
+                foundRegions.append(regionCoords)
+                chunks.update(itertools.izip(((indices & 0x1f) + (rx << 5)).tolist(),
+                                             ((indices >> 5) + (rz << 5)).tolist()))
+                if regionFile is None:
+                    presence = zeros(MCRegionFile.SECTOR_INTS, dtype=bool)
+                    presence[indices] = True
+                    self._regionPresence[regionCoords] = presence
             else:
                 log.info(u"Removing empty region file {0}".format(filepath))
-                regionFile.close()
-                os.unlink(regionFile.path)
+                if regionFile is not None:
+                    regionFile.close()
+                    del self.regionFiles[regionCoords]
+                os.unlink(filepath)
+                self._regionPresence[regionCoords] = self._noChunks
+
+        if chunkIndex is not None:
+            chunkIndex.retain(foundRegions)
+            chunkIndex.save()
 
         return chunks
 
+    _noChunks = zeros(MCRegionFile.SECTOR_INTS, dtype=bool)
+
     def containsChunk(self, cx, cz):
-        rx = cx >> 5
-        rz = cz >> 5
-        if not os.path.exists(self.getRegionFilename(rx, rz)):
-            return False
+        r = cx >> 5, cz >> 5
+        regionFile = self.regionFiles.get(r)
+        if regionFile is not None:
+            return regionFile.containsChunk(cx, cz)
+
+        # Regions are not opened just to look at them; their offset table is read once and remembered.
+        presence = self._regionPresence.get(r)
+        if presence is None:
+            path = self.getRegionFilename(*r)
+            presence = readRegionOffsets(path) != 0 if os.path.exists(path) else self._noChunks
+            self._regionPresence[r] = presence
 
-        return self.getRegionForChunk(cx, cz).containsChunk(cx, cz)
+        return bool(presence[(cx & 0x1f) + (cz & 0x1f) * 32])
 
     def deleteChunk(self, cx, cz):
         r = cx >> 5, cz >> 5
@@ -1073,6 +1474,45 @@ class AnvilWorldFolder(object):
                 rf.close()
                 os.unlink(rf.path)
                 del self.regionFiles[r]
+                self._regionPresence[r] = self._noChunks
+
+    def deleteChunks(self, chunkPositions, compact=False):
+        """
+        Deletes many chunks, writing the header of each region once. Regions left without chunks are removed
+        without being opened. If compact is True, regions left with more than compactFreeFraction of their sectors
+        free are compacted. Returns the number of bytes the region files shrank by.
+        """
+        regions = collections.defaultdict(list)
+        for cx, cz in chunkPositions:
+            regions[cx >> 5, cz >> 5].append((cx & 0x1f) + (cz & 0x1f) * 32)
+
+        freedBytes = 0
+        for r, indices in regions.iteritems():
+            path = self.getRegionFilename(*r)
+            regionFile = self.regionFiles.get(r)
+            if regionFile is None and not os.path.exists(path):
+                continue
+
+            remaining = (regionFile.offsets if regionFile is not None else readRegionOffsets(path)).copy()
+            remaining[indices] = 0
+            if not remaining.any():
+                if regionFile is not None:
+                    regionFile.close()
+                    del self.regionFiles[r]
+                freedBytes += os.path.getsize(path)
+                os.unlink(path)
+                self._regionPresence[r] = self._noChunks
+                continue
+
+            regionFile = self.getRegionFile(*r)
+            regionFile.deleteChunks(indices)
+            if not compact:
+                continue
+            freeSectors = regionFile.freeSectors
+            if freeSectors.sum() > len(freeSectors) * self.compactFreeFraction:
+                freedBytes += regionFile.compact() * MCRegionFile.SECTOR_BYTES
+
+        return freedBytes
 
     def readChunk(self, cx, cz):
         if not self.containsChunk(cx, cz):
@@ -1084,6 +1524,10 @@ class AnvilWorldFolder(object):
         regionFile = self.getRegionForChunk(cx, cz)
         regionFile.saveChunk(cx, cz, data)
 
+    def saveCompressedChunk(self, cx, cz, data, format):
+        regionFile = self.getRegionForChunk(cx, cz)
+        regionFile._saveChunk(cx, cz, data, format)
+
     def copyChunkFrom(self, worldFolder, cx, cz):
         fromRF = worldFolder.getRegionForChunk(cx, cz)
         rf = self.getRegionForChunk(cx, cz)
@@ -1152,17 +1596,38 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
 
             self.unsavedWorkFolder = AnvilWorldFolder(workFolderPath)
             self.fileEditsFolder = AnvilWorldFolder(workFolderPath2)
+            # The work folders only last for this session; an index of them would never be used again.
+            self.unsavedWorkFolder.useChunkIndex = self.fileEditsFolder.useChunkIndex = False
 
             self.editFileNumber = 1
 
         # maps (cx, cz) pairs to AnvilChunk
         self._loadedChunks = weakref.WeakValueDictionary()
 
-        # maps (cx, cz) pairs to AnvilChunkData
-        self._loadedChunkData = {}
+        # maps (cx, cz) pairs to AnvilChunkData, least recently used first
+        self._loadedChunkData = collections.OrderedDict()
+        # maps (cx, cz) pairs to the nbytes of each AnvilChunkData when it was last stored
+        self._loadedChunkBytes = {}
+        self.loadedChunkBytes = 0
+
+        # maps (cx, cz) pairs to (AnvilChunkData, AsyncResult) for dirty chunks that were evicted and are being
+        # serialized in the background before they are written to the work folder
+        self._pendingEvictions = {}
+        # maps (cx, cz) pairs to the error of evicted chunks that couldn't be written to the work folder. They are
+        # kept in the cache, dirty, until the world is saved.
+        self._failedEvictions = {}
+        # maps (cx, cz) pairs to the AsyncResult of the AnvilChunkData of chunks prefetched in the background
+        self._pendingPrefetches = {}
+
+        self.chunkCacheHits = 0
+        self.chunkCacheMisses = 0
+        self.chunkCacheEvictions = 0
+
         self.recentChunks = collections.deque(maxlen=20)
 
         self.chunksNeedingLighting = set()
+        # boxes passed to markLightingDirty since the last call to generateLights
+        self.lightingDirtyBoxes = []
         self._allChunks = None
         self.dimensions = {}
 
@@ -1284,53 +1749,62 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
                     log.info("Error loading %s.dat_old. Initializing with defaults."%dat_name)
                     self._create(self.filename, random_seed, last_played)
 
-        if self.root_tag.get('Data', nbt.TAG_Compound()).get('Version', nbt.TAG_Compound()).get('Id', nbt.TAG_Int(-1)).value > 1451:
-            raise NotImplementedError("Java 1.13 format worlds are not supported at this time")
-
     def saveInPlaceGen(self):
         if self.readonly:
             raise IOError("World is opened read only. (%s)"%self.filename)
         self.saving = True
-        self.checkSessionLock()
+        try:
+            self.checkSessionLock()
 
-        for level in self.dimensions.itervalues():
-            for _ in MCInfdevOldLevel.saveInPlaceGen(level):
+            for level in self.dimensions.itervalues():
+                for _ in MCInfdevOldLevel.saveInPlaceGen(level):
+                    yield
+
+            self.finishChunkEvictions(wait=True)
+
+            dirtyChunkCount = 0
+            with self.worldFolder.batch():
+                for chunk in self._loadedChunkData.values():
+                    cx, cz = chunk.chunkPosition
+                    if chunk.dirty:
+                        data = chunk.savedTagData()
+                        dirtyChunkCount += 1
+                        self.worldFolder.saveChunk(cx, cz, data)
+                        chunk.dirty = False
+                        if self._failedEvictions.pop((cx, cz), None) is not None:
+                            log.info(u"Chunk {0} that could not be evicted was saved".format((cx, cz)))
+                    yield
+
+                for cx, cz in self.unsavedWorkFolder.listChunks():
+                    if (cx, cz) not in self._loadedChunkData:
+                        # Copied still compressed
+                        self.worldFolder.copyChunkFrom(self.unsavedWorkFolder, cx, cz)
+                        dirtyChunkCount += 1
+                    yield
+
+            if self.compactRegionsOnSave:
+                self.worldFolder.compactRegions()
                 yield
 
-        dirtyChunkCount = 0
-        for chunk in self._loadedChunkData.itervalues():
-            cx, cz = chunk.chunkPosition
-            if chunk.dirty:
-                data = chunk.savedTagData()
-                dirtyChunkCount += 1
-                self.worldFolder.saveChunk(cx, cz, data)
-                chunk.dirty = False
-            yield
-
-        for cx, cz in self.unsavedWorkFolder.listChunks():
-            if (cx, cz) not in self._loadedChunkData:
-                data = self.unsavedWorkFolder.readChunk(cx, cz)
-                self.worldFolder.saveChunk(cx, cz, data)
-                dirtyChunkCount += 1
-            yield
-
-        self.unsavedWorkFolder.closeRegions()
-        shutil.rmtree(self.unsavedWorkFolder.filename, True)
-        if not os.path.exists(self.unsavedWorkFolder.filename):
-            os.mkdir(self.unsavedWorkFolder.filename)
-
-        for path, tag in self.playerTagCache.iteritems():
-            tag.save(path)
-
-        if self.playersFolder is not None:
-            for file_ in os.listdir(self.playersFolder):
-                if file_.endswith(".dat") and file_[:-4] not in self.players:
-                    os.remove(os.path.join(self.playersFolder, file_))
-
-        self.playerTagCache.clear()
-
-        self.root_tag.save(self.filename)
-        self.saving = False
+            self.unsavedWorkFolder.closeRegions()
+            shutil.rmtree(self.unsavedWorkFolder.filename, True)
+            if not os.path.exists(self.unsavedWorkFolder.filename):
+                os.mkdir(self.unsavedWorkFolder.filename)
+
+            for path, tag in self.playerTagCache.iteritems():
+                tag.save(path)
+
+            if self.playersFolder is not None:
+                for file_ in os.listdir(self.playersFolder):
+                    if file_.endswith(".dat") and file_[:-4] not in self.players:
+                        os.remove(os.path.join(self.playersFolder, file_))
+
+            self.playerTagCache.clear()
+
+            self.root_tag.save(self.filename)
+        finally:
+            # A chunk that can't be saved stops the save; the chunks not yet written stay dirty.
+            self.saving = False
         log.info(u"Saved {0} chunks (dim {1})".format(dirtyChunkCount, self.dimNo))
 
     def unload(self):
@@ -1339,14 +1813,19 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         """
         if self.saving:
             raise ChunkAccessDenied
+        self.finishChunkEvictions(wait=True)
         self.worldFolder.closeRegions()
         if not self.readonly:
             self.unsavedWorkFolder.closeRegions()
 
         self._allChunks = None
         self.recentChunks.clear()
+        self._pendingPrefetches.clear()
+        self._failedEvictions.clear()
         self._loadedChunks.clear()
         self._loadedChunkData.clear()
+        self._loadedChunkBytes.clear()
+        self.loadedChunkBytes = 0
 
     def close(self):
         """
@@ -1362,7 +1841,11 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
 
     # --- Resource limits ---
 
-    loadedChunkLimit = 400
+    loadedChunkLimit = 400  # chunks handled at once by lighting and prefetching
+    loadedChunkMemoryLimit = 128 << 20  # bytes of block and light arrays kept in the chunk cache
+    lightingProcesses = 1  # if more than 1, generateLights lights chunks in tiles using this many worker processes
+    lightingProcessMinChunks = 256  # fewer chunks than this are lit in this process, even with lightingProcesses
+    compactRegionsOnSave = False  # if True, region files written by a save are defragmented and trimmed afterward
 
     # --- Constants ---
 
@@ -1376,6 +1859,7 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
 
     materials = alphaMaterials
     isInfinite = True
+    incrementalLighting = True
     parentWorld = None
     dimNo = 0
     Height = 256
@@ -1561,6 +2045,7 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
 
     def preloadChunkPositions(self):
         log.info(u"Scanning for regions...")
+        self.finishChunkEvictions(wait=True)
         self._allChunks = self.worldFolder.listChunks()
         if not self.readonly:
             self._allChunks.update(self.unsavedWorkFolder.listChunks())
@@ -1633,6 +2118,8 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         if world.saving | self.saving:
             raise ChunkAccessDenied
         self.checkSessionLock()
+        self.finishChunkEvictions(wait=True)
+        world.finishChunkEvictions(wait=True)
 
         destChunk = self._loadedChunks.get((cx, cz))
         sourceChunk = world._loadedChunks.get((cx, cz))
@@ -1647,7 +2134,7 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
                 log.debug("Source chunk loaded. Saving into work folder.")
 
                 # Only source chunk loaded. Discard destination chunk and save source chunk in its place.
-                self._loadedChunkData.pop((cx, cz), None)
+                self._discardChunkData((cx, cz))
                 self.unsavedWorkFolder.saveChunk(cx, cz, sourceChunk.savedTagData())
                 return
         else:
@@ -1658,10 +2145,10 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
             else:
                 log.debug("No chunk loaded. Using world folder.copyChunkFrom")
                 # Neither chunk loaded. Copy via world folders.
-                self._loadedChunkData.pop((cx, cz), None)
+                self._discardChunkData((cx, cz))
 
                 # If the source chunk is dirty, write it to the work folder.
-                chunkData = world._loadedChunkData.pop((cx, cz), None)
+                chunkData = world._discardChunkData((cx, cz))
                 if chunkData and chunkData.dirty:
                     data = chunkData.savedTagData()
                     world.unsavedWorkFolder.saveChunk(cx, cz, data)
@@ -1682,11 +2169,34 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
     def _getChunkData(self, cx, cz):
         chunkData = self._loadedChunkData.get((cx, cz))
         if chunkData is not None:
+            self.chunkCacheHits += 1
+            if not self.saving:
+                self._cacheChunkData(chunkData)
             return chunkData
 
         if self.saving:
             raise ChunkAccessDenied
 
+        pending = self._pendingEvictions.pop((cx, cz), None)
+        if pending is not None:
+            # Take the chunk back before it reaches the work folder. It is still dirty, so it is written later.
+            chunkData, result = pending
+            result.wait()
+            self.chunkCacheHits += 1
+            self._storeLoadedChunkData(chunkData)
+            return chunkData
+
+        prefetch = self._pendingPrefetches.pop((cx, cz), None)
+        if prefetch is not None:
+            # A chunk that failed to parse in the background is read again below, to report its error.
+            chunkData = prefetch.get()
+            if chunkData is not None:
+                self.chunkCacheMisses += 1
+                self._storeLoadedChunkData(chunkData)
+                return chunkData
+
+        self.chunkCacheMisses += 1
+
         try:
             data = self._getChunkBytes(cx, cz)
             root_tag = nbt.load(buf=data)
@@ -1703,22 +2213,169 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
 
         return chunkData
 
+    def markLightingDirty(self, box):
+        self.lightingDirtyBoxes.append(box)
+
+    def prefetchChunks(self, chunks, wait=True):
+        '''
+        Loads the given chunks into the chunk cache ahead of time. The compressed chunk data is read in file order
+        for each region, then inflated, parsed and unpacked on chunkLoadPool(). Chunks that are already loaded, not
+        present or malformed are skipped; getChunk() reports their errors as usual.
+
+        :param chunks: An iterable of chunk coordinate tuples [(cx, cz), (cx, cz)...]
+        :type chunks: iterable
+        :param wait: If False, returns once the compressed data is read. The chunks are parsed in the background and
+            join the cache when getChunk() asks for them, or when another chunk is loaded after they are ready.
+        :type wait: bool
+        '''
+        if self.saving:
+            return
+
+        # Prefetching more chunks than the cache holds would only evict the first ones again.
+        chunks = [c for c in chunks if c not in self._loadedChunkData and c not in self._pendingEvictions
+                  and c not in self._pendingPrefetches]
+        del chunks[self.loadedChunkLimit:]
+
+        regions = collections.defaultdict(list)
+        for cx, cz in chunks:
+            if not self.readonly and self.unsavedWorkFolder.containsChunk(cx, cz):
+                folder = self.unsavedWorkFolder
+            elif self.worldFolder.containsChunk(cx, cz):
+                folder = self.worldFolder
+            else:
+                continue
+            regions[folder, cx >> 5, cz >> 5].append((cx, cz))
+
+        rawChunks = []
+        for (folder, rx, rz), positions in regions.iteritems():
+            dirty = folder is not self.worldFolder
+            for cPos, data, format in folder.getRegionFile(rx, rz).readChunksRaw(positions):
+                rawChunks.append((cPos, data, format, dirty))
+
+        if not wait:
+            for rawChunk in rawChunks:
+                self._pendingPrefetches[rawChunk[0]] = chunkLoadPool().apply_async(self._parseChunkData, (rawChunk,))
+            return
+
+        for chunkData in chunkLoadPool().imap(self._parseChunkData, rawChunks):
+            if chunkData is not None and chunkData.chunkPosition not in self._loadedChunkData:
+                self.chunkCacheMisses += 1
+                self._storeLoadedChunkData(chunkData)
+
+    def _parseChunkData(self, (cPos, data, format, dirty)):
+        # Runs on chunkLoadPool().
+        try:
+            root_tag = nbt.load(buf=MCRegionFile.decompress(data, format))
+            chunkData = AnvilChunkData(self, cPos, root_tag)
+        except Exception as e:
+            log.debug(u"Not prefetching chunk {0}: {1!r}".format(cPos, e))
+            return None
+        chunkData.dirty = dirty
+        return chunkData
+
+    def finishPrefetches(self):
+        """
+        Stores the chunks prefetched in the background that are parsed by now in the chunk cache.
+        """
+        ready = [cPos for cPos, result in self._pendingPrefetches.iteritems() if result.ready()]
+        for cPos in ready:
+            # Storing a chunk stores the other ready ones too.
+            result = self._pendingPrefetches.pop(cPos, None)
+            if result is None:
+                continue
+            chunkData = result.get()
+            if chunkData is not None and cPos not in self._loadedChunkData:
+                self.chunkCacheMisses += 1
+                self._storeLoadedChunkData(chunkData)
+
+    def _cacheChunkData(self, chunkData):
+        # (Re)inserts chunkData as the most recently used entry and updates its size.
+        cPos = chunkData.chunkPosition
+        self._discardChunkData(cPos)
+        nbytes = chunkData.nbytes
+        self._loadedChunkData[cPos] = chunkData
+        self._loadedChunkBytes[cPos] = nbytes
+        self.loadedChunkBytes += nbytes
+
+    def chunkDataResized(self, chunkData):
+        """ Called by AnvilChunkData when it puts together a full height array, so the cache can count it. The chunk
+        becomes the most recently used one, and other chunks are evicted if the cache is now over its budget. """
+        if self._loadedChunkData.get(chunkData.chunkPosition) is not chunkData:
+            return
+        self._cacheChunkData(chunkData)
+        if self.loadedChunkBytes > self.loadedChunkMemoryLimit and not self.saving:
+            if not self.readonly:
+                self.checkSessionLock()
+            self._evictChunkData()
+
+    def _discardChunkData(self, cPos):
+        # A chunk prefetched in the background could be older than what replaces this one.
+        self._pendingPrefetches.pop(cPos, None)
+        chunkData = self._loadedChunkData.pop(cPos, None)
+        if chunkData is not None:
+            self.loadedChunkBytes -= self._loadedChunkBytes.pop(cPos)
+        return chunkData
+
     def _storeLoadedChunkData(self, chunkData):
-        if len(self._loadedChunkData) > self.loadedChunkLimit:
-            # Try to find a chunk to unload. The chunk must not be in _loadedChunks, which contains only chunks that
-            # are in use by another object. If the chunk is dirty, save it to the temporary folder.
+        self.finishChunkEvictions()
+        self._cacheChunkData(chunkData)
+        if self._pendingPrefetches:
+            self.finishPrefetches()
+
+        if self.loadedChunkBytes > self.loadedChunkMemoryLimit:
             if not self.readonly:
                 self.checkSessionLock()
-            for (ocx, ocz), oldChunkData in self._loadedChunkData.items():
-                if (ocx, ocz) not in self._loadedChunks:
-                    if oldChunkData.dirty and not self.readonly:
-                        data = oldChunkData.savedTagData()
-                        self.unsavedWorkFolder.saveChunk(ocx, ocz, data)
+            self._evictChunkData()
+
+    def _evictChunkData(self):
+        # Evict least recently used chunks until the cache fits its budget. Chunks in _loadedChunks are in use by
+        # another object and chunks that failed to be written to the work folder can't be evicted, so they are moved
+        # to the most recently used end instead. Chunks with full height arrays are first compacted back into sections and given another pass through the cache. The
+        # chunk that was just stored is last in line, so it is never evicted here.
+        for _ in xrange(len(self._loadedChunkData) - 1):
+            if self.loadedChunkBytes <= self.loadedChunkMemoryLimit:
+                break
+
+            cPos = next(iter(self._loadedChunkData))
+            if (cPos in self._loadedChunks or cPos in self._failedEvictions or
+                    self._loadedChunkData[cPos].compact()):
+                self._cacheChunkData(self._loadedChunkData[cPos])
+                continue
 
-                    del self._loadedChunkData[ocx, ocz]
-                    break
+            chunkData = self._discardChunkData(cPos)
+            self.chunkCacheEvictions += 1
+            if chunkData.dirty and not self.readonly:
+                result = chunkLoadPool().apply_async(_compressChunkData, (chunkData,))
+                self._pendingEvictions[cPos] = chunkData, result
 
-        self._loadedChunkData[chunkData.chunkPosition] = chunkData
+    def finishChunkEvictions(self, wait=False):
+        """
+        Writes evicted dirty chunks to the work folder once their background serialization is done. If wait is
+        True, waits for every pending chunk; this must be done before reading the work folder directly.
+
+        A chunk that can't be serialized or written is logged and goes back into the cache, still dirty. It stays
+        there until the world is saved, which raises the error again if the chunk still can't be written.
+        """
+        for (cx, cz), (chunkData, result) in self._pendingEvictions.items():
+            if wait or result.ready():
+                del self._pendingEvictions[cx, cz]
+                try:
+                    data, format = result.get()
+                    self.unsavedWorkFolder.saveCompressedChunk(cx, cz, data, format)
+                except Exception as e:
+                    log.error(u"Chunk {0} could not be written to the work folder, it is kept in memory until the "
+                              u"world is saved: {1!r}".format((cx, cz), e))
+                    self._failedEvictions[cx, cz] = e
+                    self._cacheChunkData(chunkData)
+
+    def addDebugInfo(self, addDebugString):
+        addDebugString("CC: {0} ({1} MB), H/M/E: {2}/{3}/{4}, ".format(
+            len(self._loadedChunkData),
+            self.loadedChunkBytes / 1000000,
+            self.chunkCacheHits,
+            self.chunkCacheMisses,
+            self.chunkCacheEvictions,
+        ))
 
     def getChunk(self, cx, cz):
         '''
@@ -1983,7 +2640,7 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         '''
         if self._allChunks is not None:
             return (cx, cz) in self._allChunks
-        if (cx, cz) in self._loadedChunkData:
+        if (cx, cz) in self._loadedChunkData or (cx, cz) in self._pendingEvictions:
             return True
 
         return self.worldFolder.containsChunk(cx, cz)
@@ -2070,6 +2727,9 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         :param cz: The Z coordinate of the chunk
         :type cz: int
         '''
+        self._forgetChunk((cx, cz))
+        if not self.readonly and self.unsavedWorkFolder.containsChunk(cx, cz):
+            self.unsavedWorkFolder.deleteChunk(cx, cz)
         self.worldFolder.deleteChunk(cx, cz)
         if self._allChunks is not None:
             self._allChunks.discard((cx, cz))
@@ -2093,16 +2753,47 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         for cx, cz in itertools.product(xrange(box.mincx, box.maxcx), xrange(box.mincz, box.maxcz)):
             i += 1
             if self.containsChunk(cx, cz):
-                self.deleteChunk(cx, cz)
                 append((cx, cz))
 
-            assert not self.containsChunk(cx, cz), "Just deleted {0} but it didn't take".format((cx, cz))
-
             if i % 100 == 0:
                 log.info(u"Chunk {0}...".format(i))
 
+        self.deleteChunks(ret)
         return ret
 
+    def deleteChunks(self, chunkPositions, compact=False):
+        '''
+        Deletes many chunks at once. Each region file's header is written once, and region files left empty are
+        removed without being read.
+
+        :param chunkPositions: The coordinates of the chunks to delete
+        :type chunkPositions: list
+        :param compact: If True, region files left mostly empty are compacted. Only for batch tools; the editor
+            doesn't compact regions under a world that is open.
+        :type compact: bool
+        :return: The number of bytes the world's region files shrank by
+        :rtype: int
+        '''
+        for cPos in chunkPositions:
+            self._forgetChunk(cPos)
+        if not self.readonly:
+            self.unsavedWorkFolder.deleteChunks(chunkPositions)
+
+        freedBytes = self.worldFolder.deleteChunks(chunkPositions, compact)
+        if self._allChunks is not None:
+            self._allChunks.difference_update(chunkPositions)
+
+        self._bounds = None
+        return freedBytes
+
+    def _forgetChunk(self, cPos):
+        # Drops everything loaded for a chunk that is being deleted, so a later save or eviction can't write it back.
+        self._pendingEvictions.pop(cPos, None)
+        self._failedEvictions.pop(cPos, None)
+        self._discardChunkData(cPos)
+        self._loadedChunks.pop(cPos, None)
+        self.chunksNeedingLighting.discard(cPos)
+
     # --- Player and spawn manipulation ---
 
     def playerSpawnPosition(self, player=None):
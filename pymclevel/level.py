@@ -304,6 +304,24 @@ class MCLevel(object):
             chunks = self.allChunks
         return (self.getChunk(cx, cz) for (cx, cz) in chunks if self.containsChunk(cx, cz))
 
+    def prefetchChunks(self, chunks, wait=True):
+        """ pass a list of chunk coordinate tuples that are about to be requested
+        with getChunk. levels that read chunks from disk may load them ahead of
+        time, in the background if wait is False; the default does nothing."""
+        pass
+
+    incrementalLighting = False  # if True, edits call markLightingDirty instead of asking for whole chunks to be relit
+
+    def markLightingDirty(self, box):
+        """ pass the box of blocks changed by an edit to levels that support
+        incrementalLighting. generateLights will relight only around it. """
+        pass
+
+    def addDebugInfo(self, addDebugString):
+        """ pass resource usage statistics to addDebugString for the editor's
+        debug overlay. """
+        pass
+
     def _getFakeChunkEntities(self, cx, cz):
         """Returns Entities, TileEntities"""
         return nbt.TAG_List(), nbt.TAG_List()
@@ -2,8 +2,10 @@ dimension = '' #overworld
 # dimension = '\x01\x00\x00\x00' #nether
 # dimension = '\x02\x00\x00\x00' #end
 
+import collections
 import itertools
 import time
+import weakref
 from math import floor, ceil, log
 from level import FakeChunk, MCLevel
 import logging
@@ -15,7 +17,7 @@ from mclevelbase import ChunkNotPresent, ChunkMalformed
 import nbt
 import numpy
 import struct
-from infiniteworld import ChunkedLevelMixin, SessionLockLost, AnvilChunkData, AnvilWorldFolder, unpackNibbleArray, packNibbleArray
+from infiniteworld import ChunkedLevelMixin, SessionLockLost, AnvilChunkData, AnvilWorldFolder, unpackNibbleArray, packNibbleArray, chunkLoadPool
 from level import LightedChunk
 from contextlib import contextmanager
 from pymclevel import entity, BoundingBox, Entity, TileEntity
@@ -172,12 +174,48 @@ class InvalidPocketLevelDBWorldException(Exception):
 
 
 # =====================================================================
-def get_blocks_storage_from_blocks_and_data(blocks, data):
-    blocksCombined = numpy.stack((blocks, data))
-    uniqueBlocks = numpy.transpose(numpy.unique(blocksCombined, axis=1))
-    palette = []
-    numpy_blocks = numpy.zeros(4096, 'uint16')
-    for index, (blockID, blockData) in enumerate(uniqueBlocks):
+# Block storage words are little endian 32 bit integers. Each one holds as many bits_per_block wide palette indices as
+# fit, starting from the lowest bits, and the unused top bits are left at 0.
+def unpack_block_storage_words(raw_blocks, bits_per_block, count=4096):
+    """
+    Returns the count palette indices stored in a block storage's words.
+    :param raw_blocks: str, the words of the block storage
+    :param bits_per_block: int
+    :return: ndarray of uint16
+    """
+    if bits_per_block == 0:
+        return numpy.zeros(count, 'uint16')
+    blocks_per_word = 32 // bits_per_block
+    words = numpy.frombuffer(raw_blocks, '<u4').astype('uint32')
+    shifts = numpy.arange(0, blocks_per_word * bits_per_block, bits_per_block, dtype='uint32')
+    indices = (words[:, None] >> shifts) & ((1 << bits_per_block) - 1)
+    return indices.ravel()[:count].astype('uint16')
+
+
+def pack_block_storage_words(indices, bits_per_block):
+    """
+    Packs palette indices into block storage words, the inverse of unpack_block_storage_words.
+    :param indices: ndarray of palette indices
+    :param bits_per_block: int
+    :return: str
+    """
+    blocks_per_word = 32 // bits_per_block
+    word_count = -(-len(indices) // blocks_per_word)
+    padded = numpy.zeros(word_count * blocks_per_word, 'uint32')
+    padded[:len(indices)] = indices
+    shifts = numpy.arange(0, blocks_per_word * bits_per_block, bits_per_block, dtype='uint32')
+    # The indices' bits don't overlap, so adding them up is the same as or-ing them together.
+    words = (padded.reshape(word_count, blocks_per_word) << shifts).sum(axis=1, dtype='uint32')
+    return words.astype('<u4').tostring()
+
+
+_palette_entries = {}  # (block ID, block data) -> palette entry NBT
+
+
+def _palette_entry(blockID, blockData):
+    key = blockID, blockData
+    entry = _palette_entries.get(key)
+    if entry is None:
         try:
             if blockID != 0:
                 block_string = "minecraft:" + pocketMaterials.idStr[blockID]
@@ -189,27 +227,32 @@ def get_blocks_storage_from_blocks_and_data(blocks, data):
             block_string = "minecraft:air"
             block_data = 0
         with nbt.littleEndianNBT():
-            block_nbt = nbt.TAG_Compound([nbt.TAG_String(block_string, "name"), nbt.TAG_Short(block_data, "val")]).save(compressed=False)
-        if block_nbt not in palette:
+            entry = nbt.TAG_Compound([nbt.TAG_String(block_string, "name"), nbt.TAG_Short(block_data, "val")]).save(compressed=False)
+        # Block IDs can be given an idStr later on, so only known blocks are kept.
+        if blockID == 0 or (blockID < len(pocketMaterials.idStr) and pocketMaterials.idStr[blockID]):
+            _palette_entries[key] = entry
+    return entry
+
+
+def get_blocks_storage_from_blocks_and_data(blocks, data):
+    blocksCombined = (numpy.asarray(blocks, 'uint32') << 16) | numpy.asarray(data, 'uint32')
+    uniqueBlocks, inverse = numpy.unique(blocksCombined, return_inverse=True)
+    palette = []
+    positions = {}
+    unique_positions = numpy.zeros(len(uniqueBlocks), 'uint16')
+    for index, combined in enumerate(uniqueBlocks.tolist()):
+        block_nbt = _palette_entry(combined >> 16, combined & 0xffff)
+        position = positions.get(block_nbt)
+        if position is None:
+            position = positions[block_nbt] = len(palette)
             palette.append(block_nbt)
-        position = palette.index(block_nbt)
-        numpy_blocks[(blocksCombined[0]==blockID) & (blocksCombined[1]==blockData)] = position
-    max_bits = len('{0:b}'.format(numpy_blocks.max()))
+        unique_positions[index] = position
+    numpy_blocks = unique_positions[inverse]
+
+    max_bits = int(numpy_blocks.max()).bit_length()
     possible_bits_per_blocks = [1, 2, 3, 4, 5, 6, 8, 16]
     bits_per_block = possible_bits_per_blocks[numpy.searchsorted(possible_bits_per_blocks, max_bits, side='left')]
-    word_size = 32
-    blocks_per_word = int(floor(32 / bits_per_block))
-    word_count = int(ceil(4096 / float(blocks_per_word)))
-    blocks_binary = (numpy_blocks.reshape(-1, 1) >> numpy.arange(bits_per_block)[::-1] & 1).astype(bool)
-    bits_per_word = bits_per_block * blocks_per_word
-    bits_missing = bits_per_word - (blocks_binary.shape[0] * blocks_binary.shape[1]) % bits_per_word
-    if bits_missing == bits_per_word:
-        bits_missing = 0
-    final_blocks_binary = numpy.concatenate([blocks_binary, numpy.array([False] * bits_missing).reshape(-1, bits_per_block)])
-    clean_blocks_binary = final_blocks_binary.reshape(-1, word_size / bits_per_block, bits_per_block)[:, ::-1].reshape(-1, blocks_per_word * bits_per_block)
-    full_blocks_binary = numpy.hstack([numpy.empty([word_count, word_size - bits_per_word], dtype=bool), clean_blocks_binary])
-    flat_blocks_binary = full_blocks_binary.reshape(-1, word_size / 8, 8)[:, ::-1, :].ravel()
-    blocks_in_bytes = numpy.packbits(flat_blocks_binary.astype(int)).tobytes()
+    blocks_in_bytes = pack_block_storage_words(numpy_blocks, bits_per_block)
 
     palette_size = struct.pack("<i", len(palette))
     palette_string = "".join(palette)
@@ -217,6 +260,59 @@ def get_blocks_storage_from_blocks_and_data(blocks, data):
     return chr(bits_per_block << 1) + blocks_in_bytes + palette_size + palette_string
 
 
+class StreamingWriteBatch(object):
+    """
+    Stands in for a WriteBatch, and writes what it was given to a PocketLeveldbDatabase in batches of about
+    flushBytes bytes of keys and values. A full batch is written in the background while the next one is filled,
+    so at most two batches are held at once. flushIfFull should be called where a batch may end, e.g. between two
+    chunks, and flush(wait=True) once everything was given.
+    """
+    def __init__(self, database, flushBytes):
+        self.database = database
+        self.flushBytes = flushBytes
+        self.batch = leveldb_mcpe.WriteBatch()
+        self.size = 0
+        self._pending = None
+
+    def Put(self, key, value):
+        self.batch.Put(key, value)
+        self.size += len(key) + len(value)
+
+    def Delete(self, key):
+        self.batch.Delete(key)
+        self.size += len(key)
+
+    def flushIfFull(self):
+        if self.size >= self.flushBytes:
+            self.flush()
+
+    def flush(self, wait=False):
+        """
+        Starts writing the current batch once the previous one is written, and optionally waits for it too.
+        :param wait: bool
+        :return: None
+        """
+        self.wait()
+        if self.size:
+            batch, self.batch, self.size = self.batch, leveldb_mcpe.WriteBatch(), 0
+            self._pending = chunkLoadPool().apply_async(self._write, (batch,))
+        if wait:
+            self.wait()
+
+    def wait(self):
+        """
+        Waits for the batch being written, raising its error if the write failed.
+        :return: None
+        """
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.get()
+
+    def _write(self, batch):
+        with self.database.world_db() as db:
+            db.Write(self.database.writeOptions, batch)
+
+
 class PocketLeveldbDatabase(object):
     """
     Not to be confused with leveldb.DB
@@ -228,6 +324,7 @@ class PocketLeveldbDatabase(object):
     holdDatabaseOpen = True
     _world_db = None
     world_version = None  # to be set to 'pre1.0' or '1.plus'
+    subchunkMasks = None  # (cx, cz) -> bit mask of the Y of the subchunks stored for each 1.0+ chunk, from getAllChunks
 
     def __open_db(self):
         """Opens a DB and return the associated object."""
@@ -341,80 +438,30 @@ class PocketLeveldbDatabase(object):
                 del self._world_db
                 self._world_db = None
 
-    def _readChunk_pre1_0(self, cx, cz, readOptions=None, key=None):
+    @staticmethod
+    def _readChunkValues(db, readOptions, key):
         """
-        :param cx, cz: int Coordinates of the chunk
+        Reads everything stored for a chunk with one seek and a forward iteration. A chunk's keys are its key
+        followed by a tag byte, and by the subchunk's Y for subchunks.
+        :param db: DB
         :param readOptions: ReadOptions
-        :return: None
-        """
-        if key is None:
-            key = struct.pack('<i', cx) + struct.pack('<i', cz) + dimension
-        with self.world_db() as db:
-            rop = self.readOptions if readOptions is None else readOptions
-
-            # Only way to see if value exists is by failing db.Get()
-            try:
-                terrain = db.Get(rop, key + "0")
-            except RuntimeError:
-                return None
-
-            try:
-                tile_entities = db.Get(rop, key + "1")
-            except RuntimeError:
-                tile_entities = None
-
-            try:
-                entities = db.Get(rop, key + "2")
-            except RuntimeError:
-                entities = None
-
-        if len(terrain) != 83200:
-            raise ChunkMalformed(str(len(terrain)))
-
-        return terrain, tile_entities, entities
-
-    def _readSubChunk_1plus(self, cx, cz, y, readOptions=None, key=None):
-        """Read PE 1.0+ subchunk
-
-        cx, cz: int: coordinates of the chunk.
-        y: int: 'height' index of the subchunk, generaly a0 to 15 number.
-        readOptions: object: Pocket DB read options container to be used with the data base. Default to 'None'.
-            Automatically gathered if the default 'None' value is used.
-        key: str: binary form of the key to request data for. Default to 'None'.
-            Automatically calculated from cx and cz if the default 'None' value is used.
-        """
-        if key is None:
-            key = struct.pack('<i', cx) + struct.pack('<i', cz)+dimension
-        with self.world_db() as db:
-            rop = self.readOptions if readOptions is None else readOptions
-            c = chr(y)
-
-            try:
-                terrain = db.Get(rop, key + "\x2f" + c)
-            except RuntimeError:
-                if DEBUG_PE:
-                    write_dump("!!! No terrain found for sub-chunk (%s, %s, %s)\n" % (cx, cz, y))
-                terrain = None
-            except Exception as e:
-                if DEBUG_PE:
-                    write_dump("!!! An unhandled error occured when loading sub-chunk (%s, %s, %s) terrain.\n" % (cx, cz, y))
-                    write_dump("%s" % e)
-                terrain = None
-
-            if y == 0:
-                try:
-                    tile_entities = db.Get(rop, key + "\x31")
-                except RuntimeError:
-                    tile_entities = None
-
-                try:
-                    entities = db.Get(rop, key + "\x32")
-                except RuntimeError:
-                    entities = None
-            else:
-                tile_entities = entities = None
-
-        return terrain, tile_entities, entities
+        :param key: str, the chunk's coordinates and dimension
+        :return: dict, tag (and Y) -> value
+        """
+        values = {}
+        size = len(key)
+        it = db.NewIterator(readOptions)
+        it.seek(key)
+        while it.Valid():
+            k = it.key()
+            if k[:size] != key:
+                break
+            # Longer keys starting with the same coordinates belong to the other dimensions' chunks.
+            if size < len(k) <= size + 2:
+                values[k[size:]] = it.value()
+            it.stepForward()
+        del it
+        return values
 
     def _readChunk(self, cx, cz, world, readOptions=None):
         """
@@ -427,23 +474,21 @@ class PocketLeveldbDatabase(object):
         with self.world_db() as db:
             rop = self.readOptions if readOptions is None else readOptions
             key = struct.pack('<i', cx) + struct.pack('<i', cz)+dimension
-            raise_err = False
-            try:
-                chunk_version = db.Get(rop, key + chr(118))
-                if chunk_version is None:
-                    raise_err = True
-            except:
-                raise_err = True
-            if raise_err:
+            values = self._readChunkValues(db, rop, key)
+            chunk_version = values.get('\x76')
+            if chunk_version is None:
                 raise ChunkNotPresent((cx, cz, self))
             if DEBUG_PE:
                 write_dump("** Loading chunk ({x}, {z}) for PE {vs} ({v}).\n".format(x=cx, z=cz, vs={"\x02": "pre 1.0", "\x03": "1.0", "\x04": "1.1"}.get(chunk_version, 'Unknown'), v=repr(chunk_version)))
 
             if chunk_version == "\x02":
                 # We have a pre 1.0 chunk
-                data = self._readChunk_pre1_0(cx, cz, rop, key)
-                if data is None:
+                terrain = values.get("0")
+                if terrain is None:
                     raise ChunkNotPresent((cx, cz, self))
+                if len(terrain) != 83200:
+                    raise ChunkMalformed(str(len(terrain)))
+                data = terrain, values.get("1"), values.get("2")
                 chunk = PocketLeveldbChunkPre1(cx, cz, world, data, world_version=self.world_version)
             # Let assume that any chunk wich version is greater or equal to 3 in a PE 1+ one.
             elif ord(chunk_version) >= 3:
@@ -461,7 +506,7 @@ class PocketLeveldbDatabase(object):
                     world.allChunks
 
                 chunk = PocketLeveldbChunk1Plus(cx, cz, world, world_version=self.world_version, chunk_version=chunk_version)
-                d2d = db.Get(rop, key + "\x2d")
+                d2d = values.get("\x2d")
                 if d2d:
                     # data_2d contains the heightmap (currently computed dynamically, may change)
                     # and the biome information of the chunk on the last 256 bytes.
@@ -469,9 +514,9 @@ class PocketLeveldbDatabase(object):
                     biomes = numpy.fromstring(d2d[512:], 'uint8')
                     biomes.shape = (16, 16)
                     chunk.Biomes = biomes
+                chunk.add_data(tile_entities=values.get("\x31"), entities=values.get("\x32"), subchunk=0)
                 for i in range(16):
-                    tr, te, en = self._readSubChunk_1plus(cx, cz, i, rop, key)
-                    chunk.add_data(terrain=tr, tile_entities=te, entities=en, subchunk=i)
+                    chunk.add_data(terrain=values.get("\x2f" + chr(i)), subchunk=i)
 
                 # Generate the lights if we have a PE 1.1 chunk.
                 if ord(chunk.chunk_version) >= 4:
@@ -505,12 +550,14 @@ class PocketLeveldbDatabase(object):
         if batch is None:
             with self.world_db() as db:
                 wop = self.writeOptions if writeOptions is None else writeOptions
+                db.Put(wop, key + '\x76', chunk.chunk_version)
                 db.Put(wop, key + "0", data[0])
                 if data[1] is not None:
                     db.Put(wop, key + "1", data[1])
                 if data[2] is not None:
                     db.Put(wop, key + "2", data[2])
         else:
+            batch.Put(key + '\x76', chunk.chunk_version)
             batch.Put(key + "0", data[0])
             if data[1] is not None:
                 batch.Put(key + "1", data[1])
@@ -575,6 +622,7 @@ class PocketLeveldbDatabase(object):
             chunk._BlockLight.subchunks = chunk._Blocks.subchunks
             chunk._BlockLight.update_subchunks()
         chunk.subchunks = chunk._Blocks.subchunks
+        mask = self.subchunkMasks.get(chunk.chunkPosition, 0) if self.subchunkMasks is not None else 0
 
         for y in chunk.subchunks:
             c = chr(y)
@@ -596,10 +644,15 @@ class PocketLeveldbDatabase(object):
                 num_of_storages = 1
 
             terrain = ver + chr(num_of_storages) + blocks_storage + extra_blocks_storage
+            empty = not chunk._Blocks.binary_data[y].any() and not chunk._Data.binary_data[y].any()
+            if empty:
+                mask &= ~(1 << y)
+            else:
+                mask |= 1 << y
 
             if batch is None:
                 with self.world_db() as db:
-                    if blocks is None or blockData is None or (numpy.all(chunk._Blocks.binary_data[y] == 0) and numpy.all(chunk._Data.binary_data[y] == 0)):
+                    if empty:
                         db.Delete(key + "\x2f" + c)
                     else:
                         db.Put(wop, key + "\x2f" + c, terrain)
@@ -616,7 +669,7 @@ class PocketLeveldbDatabase(object):
                         if data_2d:
                             db.Put(wop, key + '\x2d', data_2d)
             else:
-                if blocks is None or blockData is None or (numpy.all(chunk._Blocks.binary_data[y] == 0) and numpy.all(chunk._Data.binary_data[y] == 0)):
+                if empty:
                     batch.Delete(key + "\x2f" + c)
                 else:
                     batch.Put(key + "\x2f" + c, terrain)
@@ -633,6 +686,9 @@ class PocketLeveldbDatabase(object):
                     if data_2d:
                         batch.Put(key + '\x2d', data_2d)
 
+        if self.subchunkMasks is not None:
+            self.subchunkMasks[chunk.chunkPosition] = mask
+
     def saveChunk(self, chunk, batch=None, writeOptions=None):
         """
         Wrapper for the methods corresponding to the world version.
@@ -661,6 +717,32 @@ class PocketLeveldbDatabase(object):
 
     _allChunks = None
 
+    def copyChunkKeys(self, database, cx, cz, batch):
+        """
+        Copies a chunk's keys from another PocketLeveldbDatabase into batch, as they are stored. Keys of a 1.0+ chunk
+        that are missing from the other database are deleted, as _saveChunk_1plus does.
+        :param database: PocketLeveldbDatabase
+        :param cx, cz: int Coordinates of the chunk
+        :param batch: WriteBatch
+        :return: None
+        """
+        key = struct.pack('<i', cx) + struct.pack('<i', cz) + dimension
+        with database.world_db() as db:
+            values = self._readChunkValues(db, database.readOptions, key)
+
+        chunk_version = values.get('\x76')
+        if chunk_version is None:
+            return
+        if chunk_version == "\x02":
+            deletable = ()
+        else:
+            deletable = ["\x2f" + chr(i) for i in xrange(16)] + ["\x31", "\x32"]
+        for suffix, value in values.iteritems():
+            batch.Put(key + suffix, value)
+        for suffix in deletable:
+            if suffix not in values:
+                batch.Delete(key + suffix)
+
     def deleteChunk(self, cx, cz, batch=None):
         if self.world_version == 'pre1.0':
             keys = [struct.pack('<i', cx) + struct.pack('<i', cz) + "0"]
@@ -673,6 +755,8 @@ class PocketLeveldbDatabase(object):
             for k in ("\x2d", "\x2e", "\x30", "\x31", "\x32", "\x33", "\x34",
                       "\x35", "\x36", "\x76"):
                 keys_append(coords_str + k)
+            if self.subchunkMasks is not None:
+                self.subchunkMasks.pop((cx, cz), None)
 
         if batch is None:
             with self.world_db() as db:
@@ -686,48 +770,42 @@ class PocketLeveldbDatabase(object):
 
     def getAllChunks(self, readOptions=None, world_version=None):
         """
-        Returns a list of all chunks that have terrain data in the database.
+        Returns a set of all chunks that have terrain data in the database.
         Chunks with only Entities or TileEntities are ignored.
+        The database is read with one forward pass, which also fills subchunkMasks for the 1.0+ chunks.
         :param readOptions: ReadOptions
         :param world_version: game version to read the data for. Default: None.
-        :return: list
+        :return: set
         """
         allChunks = set()
+        masks = collections.defaultdict(int)
+        if not world_version:
+            world_version = self.world_version
+        if world_version == 'pre1.0':
+            tag, chunk_dimension = '\x30', ''
+        else:
+            tag, chunk_dimension = '\x76', dimension
+        size = 8 + len(chunk_dimension)
+
         with self.world_db() as db:
-            if not world_version:
-                world_version = self.world_version
             rop = self.readOptions if readOptions is None else readOptions
-
             it = db.NewIterator(rop)
             it.SeekToFirst()
-            if it.Valid():
-                firstKey = it.key()
-            else:
-                # ie the database is empty
-                return []
-
-            it.SeekToLast()
-            key = ''
-            while key[0:8] != firstKey[0:8]:
+            while it.Valid():
                 key = it.key()
-                if len(key) >= 8:
-                    try:
-                        if world_version == 'pre1.0':
-                            val = db.Get(rop, key[:8] + '\x30')
-                        elif world_version == '1.plus':
-                            val = db.Get(rop, key[:8]+dimension+'\x76')
-                        # if the above key exists it is a valid chunk so add it
-                        if val is not None:
-                            allChunks.add(struct.unpack('<2i', key[:8]))
-                    except RuntimeError:
-                        pass
-
-                # seek to the first key with this beginning and go one further
-                it.seek(key[:8])
-                it.stepBackward()
+                # Chunk keys are the chunk's coordinates, the dimension for 1.0+ chunks, and a tag byte. Subchunk
+                # keys also have the subchunk's Y.
+                if len(key) == size + 1 and key[size] == tag and key[8:size] == chunk_dimension:
+                    allChunks.add(struct.unpack('<2i', key[:8]))
+                elif len(key) == size + 2 and key[size] == '\x2f' and key[8:size] == chunk_dimension:
+                    masks[struct.unpack('<2i', key[:8])] |= 1 << ord(key[size + 1])
+                it.stepForward()
 
             it.status()  # All this does is cause an exception if something went wrong. Might be unneeded?
             del it
+
+        if world_version != 'pre1.0':
+            self.subchunkMasks = dict((cPos, masks[cPos]) for cPos in allChunks)
         return allChunks
 
     def getAllPlayerData(self, readOptions=None):
@@ -784,7 +862,9 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
     oldPlayerFolderFormat = False
 
     _allChunks = None  # An array of cx, cz pairs.
-    _loadedChunks = {}  # A dictionary of actual PocketLeveldbChunk objects mapped by (cx, cz)
+    _loadedChunks = None  # A WeakValueDictionary of the PocketLeveldbChunk objects in memory mapped by (cx, cz)
+    _loadedChunkCache = None  # An OrderedDict holding the most recently used chunks, oldest first
+    _spillFile = None  # A PocketLeveldbDatabase holding evicted dirty chunks until the next save
     _playerData = None
     playerTagCache = {}
     _playerList = None
@@ -822,7 +902,7 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
         if self._allChunks is None:
             self._allChunks = self.worldFile.getAllChunks()
             if self.world_version == '1.plus' and self.dat_world_version == '\x04':
-                self._allChunks.union(self.worldFile.getAllChunks(world_version='pre1.0'))
+                self._allChunks.update(self.worldFile.getAllChunks(world_version='pre1.0'))
         return self._allChunks
 
     @property
@@ -900,6 +980,16 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
         self.fileEditsFolder = AnvilWorldFolder(workFolderPath2)
         self.editFileNumber = 1
 
+        self._loadedChunks = weakref.WeakValueDictionary()
+        self._loadedChunkCache = collections.OrderedDict()
+        self._spilledChunks = set()
+        self.chunkCacheEvictions = 0
+
+    # --- Resource limits ---
+
+    loadedChunkCacheLimit = 400  # chunks kept in memory; dirty chunks evicted beyond this are spilled to disk
+    saveBatchBytes = 16 << 20  # bytes of chunk data collected before saves and deletions write them to the database
+
     def _createLevelDat(self, random_seed, last_played):
         """
         Creates a new level.dat root_tag, and puts it in self.root_tag.
@@ -1004,17 +1094,76 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
         if c is None:
             if DEBUG_PE:
                 write_dump("    Not loaded, loading\n")
-            c = self.worldFile.loadChunk(cx, cz, self)
+            if (cx, cz) in self._spilledChunks:
+                c = self._spillFile.loadChunk(cx, cz, self)
+            else:
+                c = self.worldFile.loadChunk(cx, cz, self)
             self._loadedChunks[(cx, cz)] = c
             if DEBUG_PE:
                 write_dump("*** Loaded chunks num.: %s\n" % len(self._loadedChunks))
+        self._cacheChunk(c)
         return c
 
+    def _cacheChunk(self, chunk):
+        """
+        Makes chunk the most recently used one in the chunk cache, and evicts the least recently used chunks if the
+        cache is over its limit. Evicted chunks that are still used elsewhere stay in _loadedChunks.
+        :param chunk: PocketLeveldbChunk
+        :return: None
+        """
+        cache = self._loadedChunkCache
+        cache.pop(chunk.chunkPosition, None)
+        cache[chunk.chunkPosition] = chunk
+        if self.saving:
+            return
+        while len(cache) > self.loadedChunkCacheLimit:
+            _, evicted = cache.popitem(last=False)
+            self.chunkCacheEvictions += 1
+            if evicted.dirty and not self.readonly:
+                self._spillChunk(evicted)
+
+    def _spillChunk(self, chunk):
+        """
+        Writes a dirty chunk to the spill database, where it is loaded from until the next save copies it into the
+        world.
+        :param chunk: PocketLeveldbChunk
+        :return: None
+        """
+        if self._spillFile is None:
+            path = os.path.join(self.filename, "##MCEDIT.SPILL##")
+            shutil.rmtree(path, True)
+            os.mkdir(path)
+            self._spillFile = PocketLeveldbDatabase(path, self, create=True, world_version=self.world_version,
+                                                    dat_world_version=self.dat_world_version,
+                                                    compressors=self.worldFile.compressors)
+        if chunk.needsLighting:
+            chunk.genFastLights()
+        self._spillFile.saveChunk(chunk)
+        self._spilledChunks.add(chunk.chunkPosition)
+        # The chunk stays dirty: it may still be used, and changed, elsewhere. If it is still loaded at the next
+        # save, it is saved from memory instead of from the spill database.
+
+    def _discardSpillFile(self):
+        self._spilledChunks.clear()
+        if self._spillFile is not None:
+            self._spillFile.close()
+            shutil.rmtree(self._spillFile.path, True)
+            self._spillFile = None
+
+    def addDebugInfo(self, addDebugString):
+        addDebugString("CC: {0}, Spilled: {1}, E: {2}, ".format(
+            len(self._loadedChunkCache),
+            len(self._spilledChunks),
+            self.chunkCacheEvictions,
+        ))
+
     def unload(self):
         """
         Unload all chunks and close all open file-handlers.
         """
+        self._loadedChunkCache.clear()
         self._loadedChunks.clear()
+        self._discardSpillFile()
         self._allChunks = None
         self.worldFile.close()
 
@@ -1038,10 +1187,9 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
         :return: None
         """
         self.worldFile.deleteChunk(cx, cz, batch=batch)
-        try:
-            del self._loadedChunks[(cx, cz)]
-        except:
-            pass
+        self._loadedChunks.pop((cx, cz), None)
+        self._loadedChunkCache.pop((cx, cz), None)
+        self._spilledChunks.discard((cx, cz))
         try:
             self.allChunks.remove((cx, cz))
         except:
@@ -1057,11 +1205,12 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
                                                          ((box.mincx, box.mincz), (box.maxcx, box.maxcz))))
         i = 0
         ret = []
-        batch = leveldb_mcpe.WriteBatch()
+        batch = StreamingWriteBatch(self.worldFile, self.saveBatchBytes)
         for cx, cz in itertools.product(xrange(box.mincx, box.maxcx), xrange(box.mincz, box.maxcz)):
             i += 1
             if self.containsChunk(cx, cz):
                 self.deleteChunk(cx, cz, batch=batch)
+                batch.flushIfFull()
                 ret.append((cx, cz))
 
             assert not self.containsChunk(cx, cz), "Just deleted {0} but it didn't take".format((cx, cz))
@@ -1069,11 +1218,7 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
             if i % 100 == 0:
                 logger.info(u"Chunk {0}...".format(i))
 
-        with self.worldFile.world_db() as db:
-            wop = self.worldFile.writeOptions
-            db.Write(wop, batch)
-
-        del batch
+        batch.flush(wait=True)
         return ret
 
     @property
@@ -1128,17 +1273,28 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
         if DEBUG_PE:
             open(dump_fName, 'a').write("*** saveInPlaceGen\n")
         self.saving = True
-        batch = leveldb_mcpe.WriteBatch()
+        # The batch is written whenever it grows past saveBatchBytes, while the next chunks are lit and serialized.
+        batch = StreamingWriteBatch(self.worldFile, self.saveBatchBytes)
         dirtyChunkCount = 0
-        for c in self.chunksNeedingLighting:
-            self.getChunk(*c).genFastLights()
 
-        for chunkCoords in self._loadedChunks.keys():
-            chunk = self._loadedChunks[chunkCoords]
+        # Spilled chunks that are still loaded and dirty are saved from memory below.
+        for cx, cz in self._spilledChunks:
+            chunk = self._loadedChunks.get((cx, cz))
+            if chunk is not None and chunk.dirty:
+                continue
+            self.worldFile.copyChunkKeys(self._spillFile, cx, cz, batch)
+            batch.flushIfFull()
+            dirtyChunkCount += 1
+            yield
+
+        for chunkCoords, chunk in self._loadedChunks.items():
+            if chunk.needsLighting:
+                chunk.genFastLights()
             if chunk.dirty:
                 dirtyChunkCount += 1
                 self.worldFile.saveChunk(chunk, batch=batch)
                 chunk.dirty = False
+                batch.flushIfFull()
             yield
 
         with nbt.littleEndianNBT():
@@ -1150,10 +1306,8 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
                     playerData = playerData.save(compressed=False)  # It will get compressed in the DB itself
                     self.worldFile.savePlayer(p, playerData, batch=batch)
 
-        with self.worldFile.world_db() as db:
-            wop = self.worldFile.writeOptions
-            db.Write(wop, batch)
-
+        batch.flush(wait=True)
+        self._discardSpillFile()
         self.saving = False
         logger.info(u"Saved {0} chunks to the database".format(dirtyChunkCount))
         path = os.path.join(self.worldFile.path, 'level.dat')
@@ -1192,9 +1346,13 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
             self.allChunks.add((cx, cz))
 
         if self.world_version == 'pre1.0':
-            self._loadedChunks[(cx, cz)] = PocketLeveldbChunkPre1(cx, cz, self, create=True, world_version=self.world_version)
+            chunk = PocketLeveldbChunkPre1(cx, cz, self, create=True, world_version=self.world_version)
         else:
-            self._loadedChunks[(cx, cz)] = PocketLeveldbChunk1Plus(cx, cz, self, create=True, world_version=self.world_version)
+            chunk = PocketLeveldbChunk1Plus(cx, cz, self, create=True, world_version=self.world_version)
+        self._loadedChunks[(cx, cz)] = chunk
+        # A new chunk is only in memory, so it must be saved or spilled if it is evicted.
+        chunk.dirty = True
+        self._cacheChunk(chunk)
 
         self._bounds = None
 
@@ -1233,8 +1391,7 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
         Generator containing all chunks that need lighting.
         :yield: int (cx, cz) Coordinates of the chunk
         """
-        for chunkCoords in self._loadedChunks.keys():
-            chunk = self._loadedChunks[chunkCoords]
+        for chunkCoords, chunk in self._loadedChunks.items():
             if chunk.needsLighting:
                 yield chunk.chunkPosition
 
@@ -1552,6 +1709,18 @@ class PocketLeveldbWorld(ChunkedLevelMixin, MCLevel):
 
 
 # =====================================================================
+def _setChunkDirty(chunk, dirty):
+    # A chunk changed again after it was evicted from the world's chunk cache while still in use elsewhere goes
+    # back into the cache, so it is saved or spilled before it can be discarded.
+    chunk._dirty = dirty
+    world = getattr(chunk, "world", None)
+    if dirty and world is not None and world._loadedChunks.get(chunk.chunkPosition) is chunk:
+        world._cacheChunk(chunk)
+
+
+chunkDirty = property(lambda self: self._dirty, _setChunkDirty)
+
+
 class PocketLeveldbChunkPre1(LightedChunk):
     HeightMap = FakeChunk.HeightMap
 
@@ -1559,7 +1728,8 @@ class PocketLeveldbChunkPre1(LightedChunk):
 
     _Entities = nbt.TAG_List()
     _TileEntities = nbt.TAG_List()
-    dirty = False
+    _dirty = False
+    dirty = chunkDirty
     chunk_version = "\x02"
 
     def __init__(self, cx, cz, world, data=None, create=False, world_version=None):
@@ -1833,7 +2003,8 @@ class PocketLeveldbChunk1Plus(LightedChunk):
 
     _Entities = nbt.TAG_List()
     _TileEntities = nbt.TAG_List()
-    dirty = False
+    _dirty = False
+    dirty = chunkDirty
     chunk_version = "\x04"
 
     def __init__(self, cx, cz, world, data=None, create=False, world_version=None, chunk_version=None):
@@ -1883,28 +2054,33 @@ class PocketLeveldbChunk1Plus(LightedChunk):
         self._extra_blocks_data = PE1PlusDataContainer(4096, 'uint' + str(max_data_dtype), name='extra_blocks_data')
         self.extra_blocks_data = self._extra_blocks_data.destination
 
+    # Block storage palettes and what follows them, mapped to the palette's block IDs and data and the rest of the
+    # storage. Chunks tend to use the same few palettes, so most of them are only parsed once.
+    _palettes = {}
+
     def _read_block_storage(self, storage):
         bits_per_block, storage = ord(storage[0]) >> 1, storage[1:]
-        blocks_per_word = int(floor(32 / bits_per_block))
-        word_count = int(ceil(4096 / float(blocks_per_word)))
+        if bits_per_block:
+            word_count = -(-4096 // (32 // bits_per_block))
+        else:
+            word_count = 0
         raw_blocks, storage = storage[:word_count * 4], storage[word_count * 4:]
-        word_size = 32
-        bin_arr = numpy.unpackbits(numpy.frombuffer(bytearray(raw_blocks), dtype='uint8')).astype(bool)
-
-        # cut redundant bits
-        word_arr = bin_arr.reshape(-1, word_size/8, 8)
-        word_arr = word_arr[:, ::-1, :]
-        word_arr = word_arr.reshape(-1, word_size)
-        redundant_bits = word_size % bits_per_block
-        clean_word_arr = word_arr[:, redundant_bits:]
-
-        # convert blocks to uint
-        clean_word_arr = clean_word_arr.reshape(-1, word_size / bits_per_block, bits_per_block)[:, ::-1]
-        block_arr = clean_word_arr.reshape(-1, bits_per_block)
-        block_size = max(bits_per_block, 8)
-        blocks_before_palette = block_arr.dot(2**numpy.arange(block_arr.shape[1]-1, -1, -1))[:4096]
-        blocks_before_palette = blocks_before_palette.astype("uint"+str(block_size))
+        blocks_before_palette = unpack_block_storage_words(raw_blocks, bits_per_block)
+
+        palette = self._palettes.get(storage)
+        if palette is None:
+            palette = self._read_palette(storage)
+            if len(self._palettes) > 4096:
+                self._palettes.clear()
+            self._palettes[storage] = palette
+        ids, data, storage = palette
+
+        blocks = ids.astype(self._Blocks.bin_type)[blocks_before_palette]
+        data = data.astype(self._Data.bin_type)[blocks_before_palette]
+        return blocks, data, storage
 
+    @staticmethod
+    def _read_palette(storage):
         # This might be varint and not just 4 bytes, need to make sure
         palette_size, palette = struct.unpack("<i", storage[:4])[0], storage[4:]
         palette_nbt, storage = loadNBTCompoundList(palette, partNBT=True, count=palette_size)
@@ -1917,19 +2093,17 @@ class PocketLeveldbChunk1Plus(LightedChunk):
             if idStr == '':
                 idStr = 'air'
                 item["val"] = nbt.TAG_Short(0)
-            if idStr != 'air' and idStr not in pocketMaterials.idStr:
-                pocketMaterials.addJSONBlock({"id": pocketMaterials.tempBlockID, "name": idStr, "idStr": idStr, "mapcolor": [214, 127, 255], "data": {n: {"name": idStr} for n in range(16)}})
-                pocketMaterials.tempBlockID += 1
             if idStr == 'air':
                 ids.append(0)
-            elif idStr in pocketMaterials.idStr:
-                ids.append(pocketMaterials.idStr.index(idStr))
             else:
-                ids.append(255)
+                blockID = pocketMaterials.blockIDForIdStr(idStr)
+                if blockID is None:
+                    blockID = pocketMaterials.tempBlockID
+                    pocketMaterials.addJSONBlock({"id": blockID, "name": idStr, "idStr": idStr, "mapcolor": [214, 127, 255], "data": {n: {"name": idStr} for n in range(16)}})
+                    pocketMaterials.tempBlockID += 1
+                ids.append(blockID)
             data.append(item["val"].value)
-        blocks = numpy.asarray(ids, dtype=self._Blocks.bin_type)[blocks_before_palette]
-        data = numpy.asarray(data, dtype=self._Data.bin_type)[blocks_before_palette]
-        return blocks, data, storage
+        return numpy.array(ids, 'int32'), numpy.array(data, 'int32'), storage
 
     def add_data(self, terrain=None, tile_entities=None, entities=None, subchunk=None):
         """Add terrain to chunk.
@@ -1,8 +1,8 @@
 from logging import getLogger
-from numpy import zeros, rollaxis, indices
+from numpy import zeros, ones, rollaxis, indices, asarray, unique
 import traceback
 from os.path import join
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from pprint import pformat
 import mclangres
 import json
@@ -79,27 +79,43 @@ class BlockstateAPI(object):
     """
     material_map = {}
 
-    def __init__(self, mats, definition_file):
+    def __init__(self, mats, definition_file, flattening_file=None):
         self._mats = mats
         self.block_map = {}
         self.blockstates = {}
+        self.flattening = {}
+        self._paletteCache = {}  # (name, sorted properties) -> (id, data), or None for unknown Blockstates
+        self._flattenedCache = {}  # (id << 4 | data) -> (name, properties), or None for unknown pairs
 
-        for b in self._mats:
-            if b.ID == 0:
-                b.stringID = "air"
-            self.block_map[b.ID] = "minecraft:" + b.stringID
+        self._updateBlockMap()
+
+        self.blockstates = self._loadDefinitions(definition_file)
+        if flattening_file is not None:
+            # The 1.13+ Blockstates, by name, with the ID/Data pair each set of properties had before 1.13. Entries
+            # are kept in file order; the first Blockstate listed for a pair is the one that pair is saved as. The
+            # Java Edition table is made from pc_blockstates.json by gen_pc_flattening.py.
+            self.flattening = self._loadDefinitions(flattening_file, object_pairs_hook=OrderedDict)
+
+        self.material_map[self._mats] = self
 
+    @staticmethod
+    def _loadDefinitions(definition_file, **kwargs):
         # When running from a bundled app on Linux (and possibly on OSX) pkg_resource can't find the needed files.
         if pkg_resources.resource_exists(__name__, definition_file):
             # We're running from source or on Windows using the executable (<<== Not sure...)
             with pkg_resources.resource_stream(__name__, definition_file) as def_file:
-                self.blockstates = json.load(def_file)
+                return json.load(def_file, **kwargs)
         else:
             # In all other cases, retrieve the file directly from the file system.
             with open(os.path.join("pymclevel", definition_file)) as def_file:
-                self.blockstates = json.load(def_file)
+                return json.load(def_file, **kwargs)
 
-        self.material_map[self._mats] = self
+    def _updateBlockMap(self):
+        # The materials may get their blocks after this API is set up, so this is done again for unknown IDs.
+        for b in self._mats:
+            if b.ID == 0:
+                b.stringID = "air"
+            self.block_map[b.ID] = "minecraft:" + b.stringID
 
     def idToBlockstate(self, bid, data):
         """
@@ -112,6 +128,8 @@ class BlockstateAPI(object):
         :return: A tuple of BlockState name and it's properties
         :rtype: tuple
         """
+        if bid not in self.block_map:
+            self._updateBlockMap()
         if bid not in self.block_map:
             return "<Unknown>", {}
         
@@ -162,6 +180,114 @@ class BlockstateAPI(object):
                 return bid, prop["<data>"]
         return bid, 0
     
+    def flattenedBlockstateToID(self, name, properties):
+        """
+        Converts a 1.13+ (flattened) BlockState to the numerical ID/Data pair it had before 1.13
+
+        :param name: The BlockState name
+        :type name: str
+        :param properties: The BlockState's Property/Value pairs in dict form
+        :type properties: dict
+        :return: A tuple containing the numerical ID/Data pair (<id>, <data>), or (-1, -1) if the BlockState is unknown
+        :rtype: tuple
+        """
+        if ":" in name:
+            prefix, name = name.split(":")
+        else:
+            prefix = "minecraft"
+
+        definition = self.flattening.get(prefix, {}).get(name)
+        if definition is None:
+            return -1, -1
+
+        for prop in definition["properties"]:
+            if all(properties.get(key) == value for key, value in prop.iteritems() if not key.startswith("<")):
+                return prop.get("<id>", definition["id"]), prop["<data>"]
+        return -1, -1
+
+    def idToFlattenedBlockstate(self, bid, data):
+        """
+        Converts a numerical ID/Data pair to the 1.13+ (flattened) BlockState it became
+
+        :param bid: The ID of the block
+        :type bid: int
+        :param data: The data value of the block
+        :type data: int
+        :return: A tuple of the BlockState name and its properties, or None if the pair has no known BlockState
+        :rtype: tuple
+        """
+        key = bid << 4 | data
+        cache = self._flattenedCache
+        if not cache and self.flattening:
+            for prefix, definitions in self.flattening.iteritems():
+                for name, definition in definitions.iteritems():
+                    for prop in definition["properties"]:
+                        pairKey = prop.get("<id>", definition["id"]) << 4 | prop["<data>"]
+                        if pairKey not in cache:
+                            properties = dict((k, v) for k, v in prop.iteritems() if not k.startswith("<"))
+                            cache[pairKey] = prefix + ":" + name, properties
+        return cache.get(key)
+
+    def paletteToIDs(self, palette):
+        """
+        Converts a block palette, as found in 1.13+ chunk sections, to numerical ID/Data arrays. Each distinct
+        Blockstate is only looked up once; the results are cached. Blockstates that are not in the flattening table
+        are given ID 0 and marked as unknown.
+
+        :param palette: The palette; each entry is a TAG_Compound with a Name and optional Properties
+        :type palette: pymclevel.nbt.TAG_List
+        :return: A tuple of arrays (<ids>, <data>, <known>), indexed by palette index
+        :rtype: tuple
+        """
+        ids = zeros(len(palette), 'uint16')
+        data = zeros(len(palette), 'uint8')
+        known = ones(len(palette), 'bool')
+        cache = self._paletteCache
+        for i, entry in enumerate(palette):
+            key = self.paletteEntryKey(entry)
+            if key in cache:
+                pair = cache[key]
+            else:
+                name, properties = key[0], dict(key[1])
+                pair = self.flattenedBlockstateToID(name, properties)
+                if pair[0] == -1:
+                    log.warning(u"Unknown Blockstate {0}; it is shown as air, and kept unless it is replaced".format(
+                        self.stringifyBlockstate(name, properties)))
+                    pair = None
+                cache[key] = pair
+            if pair is None:
+                known[i] = False
+            else:
+                ids[i], data[i] = pair
+        return ids, data, known
+
+    def idsToPalette(self, ids, data):
+        """
+        Converts numerical ID/Data arrays to a 1.13+ block palette and the palette index of each block. Each distinct
+        ID/Data pair is only looked up once; the results are cached.
+
+        :param ids: The IDs of the blocks
+        :type ids: numpy.ndarray
+        :param data: The data values of the blocks
+        :type data: numpy.ndarray
+        :return: A tuple of the palette, a list of (<name>, <properties>) tuples or None for pairs that have no
+            known Blockstate, and an array of palette indices
+        :rtype: tuple
+        """
+        keys = (asarray(ids, 'uint32') << 4) | (asarray(data, 'uint32') & 0xf)
+        uniqueKeys, indices = unique(keys, return_inverse=True)
+        palette = [self.idToFlattenedBlockstate(int(key) >> 4, int(key) & 0xf) for key in uniqueKeys]
+        return palette, indices
+
+    @staticmethod
+    def paletteEntryKey(entry):
+        """
+        Returns the (<name>, <sorted Property/Value pairs>) key of a palette entry, a TAG_Compound with a Name and
+        optional Properties
+        """
+        properties = entry["Properties"].value if "Properties" in entry else ()
+        return entry["Name"].value, tuple(sorted((prop.name, prop.value) for prop in properties))
+
     @staticmethod
     def stringifyBlockstate(name, properties):
         """
@@ -248,6 +374,7 @@ class MCMaterials(object):
         self.flatColors[:] = self.defaultColor
 
         self.idStr = [""] * id_limit
+        self._idStrIDs = None
 
         self.id_limit = id_limit
 
@@ -358,8 +485,8 @@ class MCMaterials(object):
             bl = Block(self, block_id, blockData=data)
             return bl
         
-    def setup_blockstates(self, blockstate_definition_file):
-        self.blockstate_api = BlockstateAPI(self, blockstate_definition_file)
+    def setup_blockstates(self, blockstate_definition_file, flattening_file=None):
+        self.blockstate_api = BlockstateAPI(self, blockstate_definition_file, flattening_file)
 
     def addJSONBlocksFromFile(self, filename):
         blockyaml = None
@@ -404,7 +531,7 @@ class MCMaterials(object):
             meth = build_indev_materials
         else:
             f_name = 'minecraft.json'
-            self.setup_blockstates("pc_blockstates.json")
+            self.setup_blockstates("pc_blockstates.json", "pc_flattening.json")
             meth = build_alpha_materials
         if blockyaml:
             self.addJSONBlocks(blockyaml)
@@ -467,6 +594,7 @@ class MCMaterials(object):
             block = self.addBlock(blockID, val, **datakw)
             block.yaml = datakw
             self.idStr[blockID] = idStr
+            self._idStrIDs = None
 
         tex_direction_data = kw.get('tex_direction_data')
         if tex_direction_data:
@@ -488,6 +616,14 @@ class MCMaterials(object):
                     rot90cw()
                 self.blockTextures[blockID][int(data)] = texture
 
+    def blockIDForIdStr(self, idStr):
+        """ Returns the lowest block ID whose idStr is the given one, as idStr.index would, or None. """
+        if self._idStrIDs is None:
+            self._idStrIDs = {}
+            for blockID, name in enumerate(self.idStr):
+                self._idStrIDs.setdefault(name, blockID)
+        return self._idStrIDs.get(idStr)
+
     def addBlock(self, blockID, blockData=0, **kw):
         blockData = int(blockData)
         try:
@@ -1351,7 +1487,7 @@ __all__ = "indevMaterials, pocketMaterials, alphaMaterials, classicMaterials, na
 if '--dump-mats' in os.sys.argv:
     os.sys.argv.remove('--dump-mats')
     alphaMaterials.addJSONBlocksFromFile("minecraft.json")
-    alphaMaterials.setup_blockstates("pc_blockstates.json")
+    alphaMaterials.setup_blockstates("pc_blockstates.json", "pc_flattening.json")
     classicMaterials.addJSONBlocksFromFile("classic.json")
     indevMaterials.addJSONBlocksFromFile("indev.json")
     pocketMaterials.addJSONBlocksFromFile("pocket.json")
@@ -1361,7 +1497,7 @@ if '--dump-mats' in os.sys.argv:
 
 if '--find-blockstates' in os.sys.argv:
     alphaMaterials.addJSONBlocksFromFile("minecraft.json")
-    alphaMaterials.setup_blockstates("pc_blockstates.json")
+    alphaMaterials.setup_blockstates("pc_blockstates.json", "pc_flattening.json")
     pocketMaterials.addJSONBlocksFromFile("pocket.json")
     pocketMaterials.setup_blockstates("pe_blockstates.json")
     pe_blockstates = {'minecraft': {}}
@@ -1,9 +1,12 @@
+from contextlib import contextmanager
 import logging
+import mmap
 import os
 import struct
 import zlib
 
-from numpy import fromstring
+from numpy import fromstring, ones, zeros, concatenate, count_nonzero, flatnonzero, diff, argmin, dtype, packbits, \
+    unpackbits, bincount, cumsum
 import time
 from mclevelbase import notclosing, RegionMalformed, ChunkNotPresent
 import nbt
@@ -23,19 +26,41 @@ def inflate(data):
 
 class MCRegionFile(object):
     holdFileOpen = False  # if False, reopens and recloses the file on each access
+    useMmap = False  # if True, maps the file into memory and reads and writes chunks in place
 
     @property
     def file(self):
         openfile = lambda: open(self.path, "rb+")
-        if MCRegionFile.holdFileOpen:
+        if MCRegionFile.holdFileOpen or MCRegionFile.useMmap:
             if self._file is None:
                 self._file = openfile()
             return notclosing(self._file)
         else:
             return openfile()
 
+    @property
+    def mapping(self):
+        """
+        The whole region file mapped into memory. Only used when useMmap is set; created on first use.
+        """
+        if self._mmap is None:
+            if self._freeSectors is None:
+                self._scanSectors()  # sizes the file to whole sectors, which mmap needs
+            with self.file as f:
+                self._mmap = mmap.mmap(f.fileno(), 0)
+        return self._mmap
+
+    def _unmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
     def close(self):
-        if MCRegionFile.holdFileOpen:
+        if not hasattr(self, "_batchDepth"):
+            return
+        self.flushHeader()
+        self._unmap()
+        if self._file is not None:
             self._file.close()
             self._file = None
 
@@ -46,11 +71,46 @@ class MCRegionFile(object):
         self.path = path
         self.regionCoords = regionCoords
         self._file = None
+        self._mmap = None
+        self._freeSectors = None
+        self._batchDepth = 0
+        self._offsetsDirty = False
+        self._modTimesDirty = False
+        # (first sector, sector count) of the sectors given up since the header was last written. The header on disk
+        # may still point to them, so they are only reused once it has been written.
+        self._releasedSectors = []
         if not os.path.exists(path):
             open(path, "w").close()
 
+        # Only the header is read here. The file is sized and its sectors are checked when a chunk is first read or
+        # written.
         with self.file as f:
-            filesize = os.path.getsize(path)
+            f.seek(0)
+            header = f.read(self.SECTOR_BYTES * 2).ljust(self.SECTOR_BYTES * 2, "\0")
+
+        self.offsets = fromstring(header[:self.SECTOR_BYTES], dtype='>u4')
+        self.modTimes = fromstring(header[self.SECTOR_BYTES:], dtype='>u4')
+
+    @property
+    def freeSectors(self):
+        """
+        One bool per sector, True where the sector is free.
+        """
+        if self._freeSectors is None:
+            self._scanSectors()
+        return self._freeSectors
+
+    @freeSectors.setter
+    def freeSectors(self, value):
+        self._freeSectors = value
+
+    def _scanSectors(self):
+        """
+        Pads the file to whole sectors, marks the sectors used by the header and by each chunk, and repairs the file
+        if a chunk runs past its end or two of them overlap.
+        """
+        with self.file as f:
+            filesize = os.path.getsize(self.path)
             if filesize & 0xfff:
                 filesize = (filesize | 0xfff) + 1
                 f.truncate(filesize)
@@ -59,44 +119,32 @@ class MCRegionFile(object):
                 filesize = self.SECTOR_BYTES * 2
                 f.truncate(filesize)
 
-            f.seek(0)
-            offsetsData = f.read(self.SECTOR_BYTES)
-            modTimesData = f.read(self.SECTOR_BYTES)
-
-            self.freeSectors = [True] * (filesize / self.SECTOR_BYTES)
-            self.freeSectors[0:2] = False, False
-
-            self.offsets = fromstring(offsetsData, dtype='>u4')
-            self.modTimes = fromstring(modTimesData, dtype='>u4')
-
-        needsRepair = False
-
-        for offset in self.offsets:
-            sector = offset >> 8
-            count = offset & 0xff
-
-            for i in xrange(sector, sector + count):
-                if i >= len(self.freeSectors):
-                    # raise RegionMalformed("Region file offset table points to sector {0} (past the end of the file)".format(i))
-                    print "Region file offset table points to sector {0} (past the end of the file)".format(i)
-                    needsRepair = True
-                    break
-                if self.freeSectors[i] is False:
-                    needsRepair = True
-                self.freeSectors[i] = False
-
-        if needsRepair:
+        sectorCount = filesize / self.SECTOR_BYTES
+        starts = self.offsets >> 8
+        ends = starts + (self.offsets & 0xff)
+        if ends.max() > sectorCount:
+            print "Region file offset table points to sector {0} (past the end of the file)".format(ends.max() - 1)
+
+        # How many chunks (or the header) use each sector
+        length = max(sectorCount, ends.max()) + 1
+        users = cumsum(bincount(starts, minlength=length) - bincount(ends, minlength=length))
+        users[0:2] += 1
+
+        self._freeSectors = users[:sectorCount] == 0
+        for start, count in self._releasedSectors:
+            self._freeSectors[start:start + count] = False
+        if ends.max() > sectorCount or users.max() > 1:
             self.repair()
 
         log.info("Found region file {file} with {used}/{total} sectors used and {chunks} chunks present".format(
-            file=os.path.basename(path), used=self.usedSectors, total=self.sectorCount, chunks=self.chunkCount))
+            file=os.path.basename(self.path), used=self.usedSectors, total=self.sectorCount, chunks=self.chunkCount))
 
     def __repr__(self):
         return "%s(\"%s\")" % (self.__class__.__name__, self.path)
 
     @property
     def usedSectors(self):
-        return len(self.freeSectors) - sum(self.freeSectors)
+        return len(self.freeSectors) - count_nonzero(self.freeSectors)
 
     @property
     def sectorCount(self):
@@ -104,7 +152,7 @@ class MCRegionFile(object):
 
     @property
     def chunkCount(self):
-        return sum(self.offsets > 0)
+        return count_nonzero(self.offsets)
 
     def repair(self):
         lostAndFound = {}
@@ -187,9 +235,13 @@ class MCRegionFile(object):
         if sectorStart + numSectors > len(self.freeSectors):
             raise ChunkNotPresent((cx, cz))
 
-        with self.file as f:
-            f.seek(sectorStart * self.SECTOR_BYTES)
-            data = f.read(numSectors * self.SECTOR_BYTES)
+        if MCRegionFile.useMmap:
+            start = sectorStart * self.SECTOR_BYTES
+            data = self.mapping[start:start + numSectors * self.SECTOR_BYTES]
+        else:
+            with self.file as f:
+                f.seek(sectorStart * self.SECTOR_BYTES)
+                data = f.read(numSectors * self.SECTOR_BYTES)
         if len(data) < 5:
             raise RegionMalformed("Chunk data is only %d bytes long (expected 5)" % len(data))
 
@@ -202,13 +254,34 @@ class MCRegionFile(object):
 
     def readChunk(self, cx, cz):
         data, format = self._readChunk(cx, cz)
-        if format == self.VERSION_GZIP:
+        return self.decompress(data, format)
+
+    @classmethod
+    def decompress(cls, data, format):
+        if format == cls.VERSION_GZIP:
             return nbt.gunzip(data)
-        if format == self.VERSION_DEFLATE:
+        if format == cls.VERSION_DEFLATE:
             return inflate(data)
 
         raise IOError("Unknown compress format: {0}".format(format))
 
+    def readChunksRaw(self, chunkPositions):
+        """
+        Reads the still compressed data of several chunks, in the order they are stored in the file. Returns a list
+        of ((cx, cz), data, format) tuples. Chunks that are not present are left out. Decompress the data with
+        decompress().
+        """
+        chunkPositions = sorted(chunkPositions, key=lambda (cx, cz): self.getOffset(cx, cz))
+        result = []
+        for cx, cz in chunkPositions:
+            try:
+                data, format = self._readChunk(cx, cz)
+            except (ChunkNotPresent, RegionMalformed):
+                continue
+            result.append(((cx, cz), data, format))
+
+        return result
+
     def copyChunkFrom(self, regionFile, cx, cz):
         """
         Silently fails if regionFile does not contain the requested chunk.
@@ -219,14 +292,26 @@ class MCRegionFile(object):
         except ChunkNotPresent:
             pass
 
+    @classmethod
+    def compress(cls, data):
+        """
+        Returns (data, format) for writing with _saveChunk.
+        """
+        return deflate(data), cls.VERSION_DEFLATE
+
     def saveChunk(self, cx, cz, uncompressedData):
-        data = deflate(uncompressedData)
+        data, format = self.compress(uncompressedData)
         try:
-            self._saveChunk(cx, cz, data, self.VERSION_DEFLATE)
+            self._saveChunk(cx, cz, data, format)
         except ChunkTooBig as e:
             raise ChunkTooBig(e.message + " (%d uncompressed)" % len(uncompressedData))
 
     def _saveChunk(self, cx, cz, data, format):
+        # The offset and the timestamp tables are written together once the chunk is in place.
+        with self.batch():
+            self._saveChunkData(cx, cz, data, format)
+
+    def _saveChunkData(self, cx, cz, data, format):
         cx &= 0x1f
         cz &= 0x1f
         offset = self.getOffset(cx, cz)
@@ -244,63 +329,148 @@ class MCRegionFile(object):
         else:
             # we need to allocate new sectors
 
-            # mark the sectors previously used for this chunk as free
-            for i in xrange(sectorNumber, sectorNumber + sectorsAllocated):
-                self.freeSectors[i] = True
-
-            runLength = 0
-            runStart = 0
-            try:
-                runStart = self.freeSectors.index(True)
-
-                for i in xrange(runStart, len(self.freeSectors)):
-                    if runLength:
-                        if self.freeSectors[i]:
-                            runLength += 1
-                        else:
-                            runLength = 0
-                    elif self.freeSectors[i]:
-                        runStart = i
-                        runLength = 1
+            # the sectors previously used for this chunk are freed once the header no longer points to them
+            self._releaseSectors(sectorNumber, sectorsAllocated)
 
-                    if runLength >= sectorsNeeded:
-                        break
-            except ValueError:
-                pass
+            sectorNumber = self.findFreeRun(sectorsNeeded)
 
             # we found a free space large enough
-            if runLength >= sectorsNeeded:
+            if sectorNumber is not None:
                 log.debug("REGION SAVE {0},{1}, reusing {2}b".format(cx, cz, len(data)))
-                sectorNumber = runStart
-                self.setOffset(cx, cz, sectorNumber << 8 | sectorsNeeded)
-                self.writeSector(sectorNumber, data, format)
-                self.freeSectors[sectorNumber:sectorNumber + sectorsNeeded] = [False] * sectorsNeeded
-
             else:
                 # no free space large enough found -- we need to grow the
-                # file
+                # file. A free run at the end of the file is reused and only the rest is added.
 
                 log.debug("REGION SAVE {0},{1}, growing by {2}b".format(cx, cz, len(data)))
 
-                with self.file as f:
-                    f.seek(0, 2)
-                    filesize = f.tell()
+                sectorCount = len(self.freeSectors)
+                sectorNumber = sectorCount
+                while sectorNumber > 2 and self.freeSectors[sectorNumber - 1]:
+                    sectorNumber -= 1
+
+                growth = sectorNumber + sectorsNeeded - sectorCount
+                self._growFile(sectorCount, growth)
+                self.freeSectors = concatenate((self.freeSectors, ones(growth, dtype=bool)))
+
+            self.setOffset(cx, cz, sectorNumber << 8 | sectorsNeeded)
+            self.writeSector(sectorNumber, data, format)
+            self.freeSectors[sectorNumber:sectorNumber + sectorsNeeded] = False
+
+        self.setTimestamp(cx, cz)
+
+    def freeRuns(self):
+        """
+        Returns two arrays holding the first sector and the length of each run of free sectors, in file order.
+        """
+        edges = diff(concatenate(([False], self.freeSectors, [False])).view('int8'))
+        starts = flatnonzero(edges == 1)
+        return starts, flatnonzero(edges == -1) - starts
+
+    def findFreeRun(self, sectorsNeeded):
+        """
+        Returns the first sector of the smallest free run that can hold sectorsNeeded sectors, or None if there is
+        no such run. Picking the tightest fit keeps large runs available for large chunks.
+        """
+        starts, lengths = self.freeRuns()
+        fits = lengths >= sectorsNeeded
+        if not fits.any():
+            return None
+        starts = starts[fits]
+        return int(starts[argmin(lengths[fits])])
+
+    def compact(self):
+        """
+        Moves every chunk toward the start of the file so no free sectors are left between them, then truncates the
+        file after the last chunk. Returns the number of sectors removed from the file.
 
-                    sectorNumber = len(self.freeSectors)
+        The file stays readable if this is interrupted: no sector the header on disk points to is written over until
+        the header has been written without it. A chunk that would be moved over its own sectors is first copied to
+        the end of the file.
+        """
+        self.flushHeader()
+        if not self.freeSectors.any():
+            return 0
 
-                    assert sectorNumber * self.SECTOR_BYTES == filesize
+        indexes = flatnonzero(self.offsets)
+        indexes = indexes[(self.offsets[indexes] >> 8).argsort()]
 
-                    filesize += sectorsNeeded * self.SECTOR_BYTES
-                    f.truncate(filesize)
+        fileSectors = len(self.freeSectors)
+        nextSector = 2
+        with self.batch():
+            diskSectors = self._sectorsUsedBy(self.offsets)
 
-                self.freeSectors += [False] * sectorsNeeded
+            for index in indexes:
+                offset = int(self.offsets[index])
+                sectorStart = offset >> 8
+                sectorCount = offset & 0xff
+                if sectorStart != nextSector:
+                    cx, cz = index & 0x1f, index >> 5
+                    data, format = self._readChunk(cx, cz)
+                    if nextSector + sectorCount > sectorStart:
+                        stagingSector = len(self.freeSectors)
+                        self._growFile(stagingSector, sectorCount)
+                        self.freeSectors = concatenate((self.freeSectors, zeros(sectorCount, dtype=bool)))
+                        self.writeSector(stagingSector, data, format)
+                        self.offsets[index] = stagingSector << 8 | sectorCount
+                        self._offsetsDirty = True
+                        self.flushHeader()
+                        diskSectors = self._sectorsUsedBy(self.offsets)
+
+                    if diskSectors[nextSector:nextSector + sectorCount].any():
+                        self.flushHeader()
+                        diskSectors = self._sectorsUsedBy(self.offsets)
+
+                    self.writeSector(nextSector, data, format)
+                    self.offsets[index] = nextSector << 8 | sectorCount
+                    self._offsetsDirty = True
+                nextSector += sectorCount
+
+            # The header has to point inside the file before the file is cut short.
+            self.flushHeader()
+
+        removed = fileSectors - nextSector
+        if len(self.freeSectors) > nextSector:
+            self._unmap()
+            with self.file as f:
+                f.truncate(nextSector * self.SECTOR_BYTES)
+
+        self.freeSectors = zeros(nextSector, dtype=bool)
+        log.info("Compacted region file {file}, removed {removed} sectors".format(file=os.path.basename(self.path),
+                                                                                   removed=removed))
+        return removed
+
+    def _sectorsUsedBy(self, offsets):
+        # One bool per sector of the file (and past its end if offsets point there), True where a chunk of offsets
+        # is stored.
+        starts = offsets >> 8
+        ends = starts + (offsets & 0xff)
+        length = max(len(self.freeSectors), int(ends.max())) + 1
+        used = cumsum(bincount(starts, minlength=length) - bincount(ends, minlength=length)) > 0
+        used[0] = used[1] = False
+        return used
+
+    def _growFile(self, sectorCount, sectorsNeeded):
+        # An active mapping cannot outlive a change in the file size on every platform, so drop it and let the
+        # next access map the grown file.
+        self._unmap()
+        with self.file as f:
+            f.seek(0, 2)
+            filesize = f.tell()
 
-                self.setOffset(cx, cz, sectorNumber << 8 | sectorsNeeded)
-                self.writeSector(sectorNumber, data, format)
+            assert sectorCount * self.SECTOR_BYTES == filesize
 
-        self.setTimestamp(cx, cz)
+            filesize += sectorsNeeded * self.SECTOR_BYTES
+            f.truncate(filesize)
 
     def writeSector(self, sectorNumber, data, format):
+        if MCRegionFile.useMmap:
+            log.debug("REGION: Writing sector {0}".format(sectorNumber))
+
+            start = sectorNumber * self.SECTOR_BYTES
+            header = struct.pack(">IB", len(data) + 1, format)
+            self.mapping[start:start + len(header) + len(data)] = header + data
+            return
+
         with self.file as f:
             log.debug("REGION: Writing sector {0}".format(sectorNumber))
 
@@ -322,9 +492,27 @@ class MCRegionFile(object):
         cx &= 0x1f
         cz &= 0x1f
         self.offsets[cx + cz * 32] = offset
-        with self.file as f:
-            f.seek(0)
-            f.write(self.offsets.tostring())
+        self._offsetsDirty = True
+        if not self._batchDepth:
+            self.flushHeader()
+
+    def deleteChunks(self, chunkIndices):
+        """
+        Removes the chunks at the given indices (cx + cz * 32, local to the region) and frees their sectors. The
+        header is written once.
+        """
+        offsets = self.offsets[chunkIndices]
+        for offset in offsets[offsets != 0]:
+            self._releaseSectors(offset >> 8, offset & 0xff)
+
+        with self.batch():
+            self.offsets[chunkIndices] = 0
+            self.modTimes[chunkIndices] = 0
+            self._offsetsDirty = self._modTimesDirty = True
+
+    def _releaseSectors(self, sectorStart, sectorCount):
+        if sectorStart and sectorCount:
+            self._releasedSectors.append((sectorStart, sectorCount))
 
     def getTimestamp(self, cx, cz):
         cx &= 0x1f
@@ -338,9 +526,65 @@ class MCRegionFile(object):
         cx &= 0x1f
         cz &= 0x1f
         self.modTimes[cx + cz * 32] = timestamp
-        with self.file as f:
-            f.seek(self.SECTOR_BYTES)
-            f.write(self.modTimes.tostring())
+        self._modTimesDirty = True
+        if not self._batchDepth:
+            self.flushHeader()
+
+    # --- Batched header writes ---
+
+    def beginBatch(self):
+        """
+        Defers writing the offset and timestamp tables until the matching endBatch() call. Batches may be nested;
+        the tables are written once, when the outermost batch ends.
+        """
+        self._batchDepth += 1
+
+    def endBatch(self):
+        assert self._batchDepth > 0, "endBatch() called without beginBatch()"
+        self._batchDepth -= 1
+        if not self._batchDepth:
+            self.flushHeader()
+
+    @contextmanager
+    def batch(self):
+        self.beginBatch()
+        try:
+            yield self
+        finally:
+            self.endBatch()
+
+    def flushHeader(self):
+        """
+        Writes the offset and timestamp tables to the file if they were changed since the last flush. Sectors given
+        up since then become free.
+        """
+        if not (self._offsetsDirty or self._modTimesDirty):
+            self._freeReleasedSectors()
+            return
+
+        if MCRegionFile.useMmap:
+            m = self.mapping
+            if self._offsetsDirty:
+                m[0:self.SECTOR_BYTES] = self.offsets.tostring()
+            if self._modTimesDirty:
+                m[self.SECTOR_BYTES:self.SECTOR_BYTES * 2] = self.modTimes.tostring()
+        else:
+            with self.file as f:
+                if self._offsetsDirty:
+                    f.seek(0)
+                    f.write(self.offsets.tostring())
+                if self._modTimesDirty:
+                    f.seek(self.SECTOR_BYTES)
+                    f.write(self.modTimes.tostring())
+
+        self._offsetsDirty = self._modTimesDirty = False
+        self._freeReleasedSectors()
+
+    def _freeReleasedSectors(self):
+        if self._freeSectors is not None:
+            for sectorStart, sectorCount in self._releasedSectors:
+                self._freeSectors[sectorStart:sectorStart + sectorCount] = True
+        self._releasedSectors = []
 
     SECTOR_BYTES = 4096
     SECTOR_INTS = SECTOR_BYTES / 4
@@ -353,3 +597,110 @@ class MCRegionFile(object):
 
 class ChunkTooBig(ValueError):
     pass
+
+
+def readRegionOffsets(path):
+    """
+    Reads only the offset table of the region file at path, without opening it as an MCRegionFile. A file too short
+    to hold the table reads as having no chunks.
+    """
+    with open(path, "rb") as f:
+        data = f.read(MCRegionFile.SECTOR_BYTES)
+    if len(data) < MCRegionFile.SECTOR_BYTES:
+        return zeros(MCRegionFile.SECTOR_INTS, dtype='>u4')
+    return fromstring(data, dtype='>u4')
+
+
+class RegionChunkIndex(object):
+    """
+    A sidecar file remembering which chunks are present in each region file of a folder, so the chunk list can be
+    built without reading every region header. An entry is trusted only while its region file has the same size and
+    modification time as when the entry was made; other regions are read again and their entries replaced.
+    """
+    magic = "MCEDITCI"
+    version = 1
+    entryType = dtype([("rx", "<i4"), ("rz", "<i4"), ("size", "<i8"), ("mtime", "<f8"), ("present", "u1", (128,))])
+
+    # Files changed this recently may be changed again without their modification time moving, on file systems
+    # with coarse timestamps, so their entries are not kept.
+    racySeconds = 2.0
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # (rx, rz) -> (size, mtime, packed presence bits)
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            return
+
+        header = struct.Struct("<8sI")
+        if len(data) < header.size:
+            return
+        magic, version = header.unpack_from(data)
+        body = data[header.size:]
+        if magic != self.magic or version != self.version or len(body) % self.entryType.itemsize:
+            log.info(u"Ignoring unreadable chunk index {0}".format(self.path))
+            return
+
+        for entry in fromstring(body, dtype=self.entryType):
+            self.entries[int(entry["rx"]), int(entry["rz"])] = (int(entry["size"]), float(entry["mtime"]),
+                                                                entry["present"])
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        entries = zeros(len(self.entries), dtype=self.entryType)
+        for i, ((rx, rz), (size, mtime, present)) in enumerate(self.entries.iteritems()):
+            entries[i] = (rx, rz, size, mtime, present)
+
+        try:
+            folder = os.path.dirname(self.path)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(self.path, "wb") as f:
+                f.write(struct.pack("<8sI", self.magic, self.version))
+                f.write(entries.tostring())
+        except (IOError, OSError) as e:
+            log.info(u"Could not write chunk index {0}: {1}".format(self.path, e))
+            return
+        self.dirty = False
+
+    def chunkIndices(self, regionCoords, path, offsets=None):
+        """
+        Returns the indices (cx + cz * 32, local to the region) of the chunks present in the region file at path.
+        The stored entry is used if the file is unchanged; otherwise the presence comes from offsets, if given, or
+        from the file's offset table, and the entry is replaced.
+        """
+        st = os.stat(path)
+        entry = self.entries.get(regionCoords)
+        upToDate = entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime
+        if upToDate and offsets is None:
+            return flatnonzero(unpackbits(entry[2]))
+
+        if offsets is None:
+            offsets = readRegionOffsets(path)
+        present = packbits(offsets != 0)
+
+        if st.st_mtime >= time.time() - self.racySeconds:
+            if entry is not None:
+                del self.entries[regionCoords]
+                self.dirty = True
+        elif not (upToDate and (entry[2] == present).all()):
+            self.entries[regionCoords] = (st.st_size, st.st_mtime, present)
+            self.dirty = True
+
+        return flatnonzero(offsets)
+
+    def retain(self, regionCoords):
+        """
+        Forgets the entries of regions not in regionCoords, e.g. because their files were deleted.
+        """
+        for r in set(self.entries) - set(regionCoords):
+            del self.entries[r]
+            self.dirty = True
@@ -709,6 +709,8 @@ class ZipSchematic(infiniteworld.MCInfdevOldLevel):
         yield
 
     def saveToFile(self, filename):
+        self.finishChunkEvictions(wait=True)
+
         schematicDat = nbt.TAG_Compound()
         schematicDat.name = "Mega Schematic"
 
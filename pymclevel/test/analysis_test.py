@@ -0,0 +1,100 @@
+import json
+import shutil
+import StringIO
+import unittest
+
+from numpy import bincount, zeros
+
+from pymclevel import nbt
+from pymclevel.block_analysis import analyzeBlocks
+from pymclevel.infiniteworld import MCInfdevOldLevel
+from pymclevel.box import BoundingBox
+from templevel import mktemp
+
+
+class TestBlockAnalysis(unittest.TestCase):
+    def setUp(self):
+        self.temppath = mktemp("BlockAnalysis")
+        self.level = level = MCInfdevOldLevel(filename=self.temppath, create=True)
+        level.createChunksInBox(BoundingBox((-48, 0, -48), (96, 1, 96)))
+        level.fillBlocks(BoundingBox((-48, 0, -48), (96, 40, 96)), level.materials.Stone)
+        level.fillBlocks(BoundingBox((-40, 40, 0), (30, 3, 30)), level.materials.Dirt)
+
+        wool = level.getChunk(1, 1)
+        wool.Blocks[:, 0, 50] = level.materials.WhiteWool.ID
+        wool.Data[:, 0, 50] = range(16)
+        wool.Blocks[0, 0, 51] = 300
+        wool.chunkChanged()
+        # One chunk is saved as a 1.13+ Palette and BlockStates section
+        level._getChunkData(2, 2)._blockStatesPadded = True
+        level.saveInPlace()
+
+        # and one is changed but not saved.
+        level.getChunk(-1, 0).Blocks[:, :, 100] = level.materials.Glass.ID
+        level.getChunk(-1, 0).chunkChanged()
+
+    def tearDown(self):
+        self.level.close()
+        shutil.rmtree(self.temppath)
+
+    def countChunks(self):
+        totals = zeros(65536, 'int64')
+        heights = zeros((self.level.Height, 4096), 'int64')
+        for cPos in self.level.allChunks:
+            chunk = self.level.getChunk(*cPos)
+            keys = (chunk.Data.astype('uint16') << 12) | chunk.Blocks
+            totals += bincount(keys.ravel(), minlength=65536)
+            for y in range(self.level.Height):
+                heights[y] += bincount(chunk.Blocks[:, :, y].ravel(), minlength=4096)
+        return totals, heights
+
+    def testMatchesChunkCounts(self):
+        totals, heights = self.countChunks()
+        for processes in (1, 2):
+            analysis = analyzeBlocks(self.level, processes, byRegion=True, byHeight=True)
+            assert (analysis.totals == totals).all()
+            assert (analysis.heights == heights).all()
+            assert sorted(analysis.regions) == [(-1, -1), (-1, 0), (0, -1), (0, 0)]
+            assert sum(sum(c.itervalues()) for c in analysis.regions.itervalues()) == totals.sum()
+
+    def testOutput(self):
+        analysis = analyzeBlocks(self.level, byRegion=True)
+        f = StringIO.StringIO()
+        analysis.writeJSON(f, self.level.materials)
+        result = json.loads(f.getvalue())
+        assert result["chunks"] == self.level.chunkCount
+        stone = [b for b in result["blocks"] if b["id"] == self.level.materials.Stone.ID]
+        assert stone[0]["count"] == analysis.totals[self.level.materials.Stone.ID]
+        assert sorted(result["regions"]) == ["-1,-1", "-1,0", "0,-1", "0,0"]
+
+        f = StringIO.StringIO()
+        analysis.writeCSV(f, self.level.materials)
+        lines = f.getvalue().splitlines()
+        assert lines[0] == "region_x,region_z,y,id,data,name,count"
+        assert len(lines) == 1 + len(result["blocks"]) + sum(len(b) for b in result["regions"].itervalues())
+
+    def testUnknownBlockstates(self):
+        stone = self.level.materials.Stone.ID
+        before = analyzeBlocks(self.level).totals[stone]
+
+        # The stone of the bottom 1.13+ section becomes a Blockstate that has no ID
+        worldFolder = self.level.worldFolder
+        root = nbt.load(buf=worldFolder.readChunk(2, 2))
+        section = [s for s in root["Level"]["Sections"] if s["Y"].value == 0][0]
+        for entry in section["Palette"]:
+            if entry["Name"].value == "minecraft:stone":
+                entry["Name"] = nbt.TAG_String("minecraft:kelp_plant")
+        worldFolder.saveChunk(2, 2, root.save(compressed=False))
+        worldFolder.closeRegions()
+
+        analysis = analyzeBlocks(self.level, byRegion=True, byHeight=True)
+        assert analysis.totals[stone] == before - 4096
+        rows = [row for row in analysis.rows(self.level.materials) if row[5] == "minecraft:kelp_plant"]
+        assert rows == ([(None, None, None, None, None, "minecraft:kelp_plant", 4096),
+                         (0, 0, None, None, None, "minecraft:kelp_plant", 4096)] +
+                        [(None, None, y, None, None, "minecraft:kelp_plant", 256) for y in range(16)])
+
+        f = StringIO.StringIO()
+        analysis.writeJSON(f, self.level.materials)
+        blocks = json.loads(f.getvalue())["blocks"]
+        assert {"name": "minecraft:kelp_plant", "count": 4096} in blocks
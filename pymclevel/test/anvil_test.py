@@ -40,6 +40,14 @@ class TestAnvilLevel(unittest.TestCase):
         level = self.anvilLevel.level
         print len(level.getEntitiesInBox(level.bounds))
 
+    def testPrefetchChunks(self):
+        level = self.anvilLevel.level
+        chunks = list(level.allChunks)[:16]
+        level.prefetchChunks(chunks)
+        for cx, cz in chunks:
+            assert (cx, cz) in level._loadedChunkData
+            level.getChunk(cx, cz)
+
     def testCreateChunks(self):
         level = self.anvilLevel.level
 
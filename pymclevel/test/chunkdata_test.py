@@ -0,0 +1,312 @@
+import shutil
+import unittest
+
+from numpy import arange
+
+from pymclevel import nbt
+from pymclevel.infiniteworld import MCInfdevOldLevel, packBlockStates, unpackBlockStates
+from pymclevel.box import BoundingBox
+from pymclevel.entity import TileEntity
+from templevel import mktemp
+
+
+class TestAnvilChunkData(unittest.TestCase):
+    def setUp(self):
+        self.temppath = mktemp("AnvilChunkData")
+        self.level = MCInfdevOldLevel(filename=self.temppath, create=True)
+        self.level.createChunksInBox(BoundingBox((0, 0, 0), (32, 1, 32)))
+        chunk = self.level.getChunk(0, 0)
+        chunk.Blocks[3, 4, 70] = self.level.materials.Stone.ID
+        chunk.SkyLight[:, :, :64] = 0
+        chunk.chunkChanged(False)
+        self.level.saveInPlace()
+
+    def tearDown(self):
+        self.level.close()
+        shutil.rmtree(self.temppath)
+
+    def reopen(self):
+        self.level.close()
+        self.level = MCInfdevOldLevel(filename=self.temppath)
+        return self.level
+
+    def testSparseSections(self):
+        chunkData = self.reopen()._getChunkData(0, 0)
+        assert chunkData.getSection("Blocks", 4)[3, 4, 6] == self.level.materials.Stone.ID
+        assert not chunkData.getSection("Blocks", 3).any()
+        assert not chunkData.getSection("Blocks", 5).any()
+        assert sorted(chunkData._sections["Blocks"]) == [4]
+        assert (chunkData.getSection("SkyLight", 2) == 0).all()
+        assert (chunkData.getSection("SkyLight", 8) == 15).all()
+        assert chunkData.nbytes < 16 * 16 * 256
+
+        assert chunkData.Blocks[3, 4, 70] == self.level.materials.Stone.ID
+        assert not chunkData._sections["Blocks"]
+        assert chunkData.nbytes > 16 * 16 * 256
+
+    def testLazyUnpacking(self):
+        chunkData = self.reopen()._getChunkData(0, 0)
+        chunkData.Blocks[5, 5, 5] = self.level.materials.Stone.ID
+        chunkData.dirty = True
+        assert sorted(chunkData._packed["SkyLight"]) == [0, 1, 2, 3, 4]
+        assert not chunkData._sections["SkyLight"]
+
+        self.level.saveInPlace()
+        chunk = self.reopen().getChunk(0, 0)
+        assert chunk.Blocks[5, 5, 5] == chunk.Blocks[3, 4, 70] == self.level.materials.Stone.ID
+        assert chunk.SkyLight[5, 5, 10] == 0
+        assert chunk.SkyLight[5, 5, 70] == 15
+
+    def testCompact(self):
+        chunkData = self.reopen()._getChunkData(0, 0)
+        chunkData.Blocks[0, 0, 200] = self.level.materials.Stone.ID
+        chunkData.Data[:] = 0
+        chunkData.dirty = True
+
+        assert chunkData.compact() > 0
+        assert sorted(chunkData._sections["Blocks"]) == [4, 12]
+        assert not chunkData._sections["Data"]
+
+        self.level.saveInPlace()
+        chunk = self.reopen().getChunk(0, 0)
+        assert chunk.Blocks[0, 0, 200] == chunk.Blocks[3, 4, 70] == self.level.materials.Stone.ID
+        assert chunk.SkyLight[5, 5, 10] == 0
+
+    def testBlockStates(self):
+        for padded in (False, True):
+            chunkData = self.level._getChunkData(0, 0)
+            chunkData.Blocks[:, :, 20] = self.level.materials.Stone.ID
+            chunkData.Data[:8, :, 20] = 1
+            chunkData.Blocks[2, 2, 21] = self.level.materials.Dirt.ID
+            # 16 wool colours make the palette need 5 bits, where the two long array layouts differ
+            chunkData.Blocks[:, 0, 22] = self.level.materials.WhiteWool.ID
+            chunkData.Data[:, 0, 22] = range(16)
+            chunkData._blockStatesPadded = padded
+            chunkData.dirty = True
+            self.level.saveInPlace()
+
+            chunkData = self.reopen()._getChunkData(0, 0)
+            assert chunkData._blockStatesPadded == padded
+            assert (chunkData.Blocks[:, :, 20] == self.level.materials.Stone.ID).all()
+            assert (chunkData.Data[:8, :, 20] == 1).all() and not chunkData.Data[8:, :, 20].any()
+            assert chunkData.Blocks[2, 2, 21] == self.level.materials.Dirt.ID
+            assert chunkData.Blocks[3, 4, 70] == self.level.materials.Stone.ID
+            assert (chunkData.Data[:, 0, 22] == range(16)).all()
+            assert chunkData.Blocks.sum() == (257 * self.level.materials.Stone.ID + self.level.materials.Dirt.ID +
+                                              16 * self.level.materials.WhiteWool.ID)
+
+    def writeModernSections(self):
+        # Replaces the sections of chunk 0, 0 with two 1.13+ sections. Section 1 holds a Blockstate that has no
+        # known ID, section 2 only holds known ones.
+        def section(sy, states):
+            sec = nbt.TAG_Compound()
+            sec["Y"] = nbt.TAG_Byte(sy)
+            sec["Palette"] = nbt.TAG_List()
+            for name, properties in states:
+                entry = nbt.TAG_Compound()
+                entry["Name"] = nbt.TAG_String(name)
+                if properties:
+                    entry["Properties"] = nbt.TAG_Compound([nbt.TAG_String(v, k) for k, v in properties])
+                sec["Palette"].append(entry)
+            sec["BlockStates"] = nbt.TAG_Long_Array(packBlockStates(arange(4096) % len(states), 4, True))
+            return sec
+
+        root = nbt.load(buf=self.level.worldFolder.readChunk(0, 0))
+        root["Level"]["Sections"] = nbt.TAG_List([
+            section(1, [("minecraft:air", ()), ("minecraft:granite", ()),
+                        ("minecraft:grass_block", (("snowy", "false"),)), ("minecraft:kelp_plant", ()),
+                        ("minecraft:oak_log", (("axis", "x"),))]),
+            section(2, [("minecraft:cave_air", ()), ("minecraft:stone", ()), ("minecraft:white_wool", ())]),
+        ])
+        self.level.worldFolder.saveChunk(0, 0, root.save(compressed=False))
+        self.level.worldFolder.closeRegions()
+
+    def savedSections(self):
+        root = nbt.load(buf=self.level.worldFolder.readChunk(0, 0))
+        return dict((sec["Y"].value, sec) for sec in root["Level"]["Sections"])
+
+    def paletteKeys(self, section):
+        return [self.level.materials.blockstate_api.paletteEntryKey(entry) for entry in section["Palette"]]
+
+    def testModernSectionsRoundTrip(self):
+        self.writeModernSections()
+        original = self.savedSections()
+        chunkData = self.reopen()._getChunkData(0, 0)
+        materials = self.level.materials
+        assert chunkData._blockStatesPadded is not None
+        # x, z, y of palette index 1 and 2 in section 2
+        assert chunkData.Blocks[1, 0, 32] == materials.Stone.ID and chunkData.Blocks[2, 0, 32] == materials.WhiteWool.ID
+        assert chunkData.Blocks[1, 0, 16] == materials.Stone.ID and chunkData.Data[1, 0, 16] == 1
+        assert chunkData.Blocks[4, 0, 16] == materials.Wood.ID and chunkData.Data[4, 0, 16] == 4
+
+        chunkData.Blocks[0, 0, 32] = materials.Dirt.ID
+        chunkData.dirty = True
+        self.level.saveInPlace()
+
+        saved = self.savedSections()
+        assert self.paletteKeys(saved[1]) == self.paletteKeys(original[1])
+        assert (saved[1]["BlockStates"].value == original[1]["BlockStates"].value).all()
+        names = [entry["Name"].value for entry in saved[2]["Palette"]]
+        assert names == ["minecraft:cave_air", "minecraft:stone", "minecraft:white_wool", "minecraft:dirt"]
+        indices, padded = unpackBlockStates(saved[2]["BlockStates"].value, 4)
+        assert indices[0] == 3 and indices[3] == 0 and (indices[1:3] == [1, 2]).all()
+
+        chunk = self.reopen().getChunk(0, 0)
+        assert chunk.Blocks[0, 0, 32] == materials.Dirt.ID
+        assert chunk.Blocks[1, 0, 16] == materials.Stone.ID
+
+    def testUnknownBlockstatesAreKept(self):
+        self.writeModernSections()
+        original = self.savedSections()
+        chunkData = self.reopen()._getChunkData(0, 0)
+        # The first of the kelp blocks is replaced, the others are saved as they were
+        chunkData.Blocks[3, 0, 16] = self.level.materials.Stone.ID
+        chunkData.dirty = True
+        self.level.saveInPlace()
+
+        saved = self.savedSections()
+        assert self.paletteKeys(saved[1]) == self.paletteKeys(original[1]) + [("minecraft:stone", ())]
+        indices, padded = unpackBlockStates(saved[1]["BlockStates"].value, 4)
+        assert indices[3] == 5 and indices[8] == 3 and (indices[:3] == [0, 1, 2]).all()
+
+    def testModernLevel(self):
+        self.level.root_tag["Data"]["Version"] = nbt.TAG_Compound([nbt.TAG_Int(1631, "Id")])
+        self.level.root_tag["Data"]["DataVersion"] = nbt.TAG_Int(1631)
+        self.level.saveInPlace()
+        self.writeModernSections()
+        root = nbt.load(buf=self.level.worldFolder.readChunk(0, 0))
+        sec = nbt.TAG_Compound()
+        sec["Y"] = nbt.TAG_Byte(3)
+        sec["Palette"] = nbt.TAG_List()
+        for name, properties in [("minecraft:air", ()), ("minecraft:wall_torch", (("facing", "north"),)),
+                                 ("minecraft:chest", (("facing", "west"), ("type", "single"),
+                                                      ("waterlogged", "false"))),
+                                 ("minecraft:oak_stairs", (("facing", "east"), ("half", "top"), ("shape", "straight"),
+                                                           ("waterlogged", "true")))]:
+            entry = nbt.TAG_Compound([nbt.TAG_String(name, "Name")])
+            if properties:
+                entry["Properties"] = nbt.TAG_Compound([nbt.TAG_String(v, k) for k, v in properties])
+            sec["Palette"].append(entry)
+        sec["BlockStates"] = nbt.TAG_Long_Array(packBlockStates(arange(4096) % 4, 4, True))
+        root["Level"]["Sections"].append(sec)
+        self.level.worldFolder.saveChunk(0, 0, root.save(compressed=False))
+        self.level.worldFolder.closeRegions()
+
+        chunk = self.reopen().getChunk(0, 0)
+        materials = self.level.materials
+        assert chunk.Blocks[1, 0, 48] == materials.Torch.ID and chunk.Data[1, 0, 48] == 4
+        assert chunk.Blocks[2, 0, 48] == materials.Chest.ID and chunk.Data[2, 0, 48] == 4
+        assert chunk.Blocks[3, 0, 48] == materials.WoodenStairs.ID and chunk.Data[3, 0, 48] == 4
+
+        chunk.Blocks[0, 0, 48] = materials.Furnace.ID
+        chunk.Data[0, 0, 48] = 5
+        chunk.chunkChanged(False)
+        self.level.saveInPlace()
+        palette = self.paletteKeys(self.savedSections()[3])
+        assert palette[-1] == ("minecraft:furnace", (("facing", "east"), ("lit", "false")))
+        assert palette[3][0] == "minecraft:oak_stairs" and ("waterlogged", "true") in palette[3][1]
+
+        chunk = self.reopen().getChunk(0, 0)
+        assert chunk.Blocks[0, 0, 48] == materials.Furnace.ID and chunk.Data[0, 0, 48] == 5
+        assert chunk.Blocks[2, 0, 48] == materials.Chest.ID
+
+    def testChunkAlignedCopy(self):
+        level = self.reopen()
+        level.addTileEntity(TileEntity.Create("Chest", (3, 70, 4)))
+        destPath = mktemp("AnvilChunkDataCopy")
+        dest = MCInfdevOldLevel(filename=destPath, create=True)
+        try:
+            dest.copyBlocksFrom(level, BoundingBox((0, 0, 0), (32, 256, 32)), (32, 0, -16), create=True)
+            assert sorted(dest.allChunks) == [(2, -1), (2, 0), (3, -1), (3, 0)]
+
+            chunkData = dest._getChunkData(2, -1)
+            assert sorted(chunkData._packed["Blocks"]) == [0, 1, 2, 3, 4]
+            assert not chunkData._sections["Blocks"]
+            assert chunkData.Blocks[3, 4, 70] == level.materials.Stone.ID
+            assert (chunkData.SkyLight[:, :, :64] == 0).all()
+            assert TileEntity.pos(dest.getChunk(2, -1).TileEntities[0]) == [35, 70, -12]
+            assert dest.lightingDirtyBoxes
+        finally:
+            dest.close()
+            shutil.rmtree(destPath)
+
+    def testVerticalOffsetCopy(self):
+        level = self.reopen()
+        level.addTileEntity(TileEntity.Create("Chest", (3, 70, 4)))
+        destPath = mktemp("AnvilChunkDataCopy")
+        dest = MCInfdevOldLevel(filename=destPath, create=True)
+        try:
+            dest.copyBlocksFrom(level, BoundingBox((0, 0, 0), (32, 256, 32)), (32, 16, 0), create=True)
+            assert dest.getChunk(2, 0).Blocks[3, 4, 86] == level.materials.Stone.ID
+            assert dest.getChunk(2, 0).Blocks[3, 4, 70] != level.materials.Stone.ID
+            assert TileEntity.pos(dest.getChunk(2, 0).TileEntities[0]) == [35, 86, 4]
+        finally:
+            dest.close()
+            shutil.rmtree(destPath)
+
+    def evictEditedChunks(self, level, chunkPositions):
+        level.loadedChunkMemoryLimit = 0
+        for cPos in chunkPositions:
+            chunk = level.getChunk(*cPos)
+            chunk.Blocks[0, 0, 100] = level.materials.Stone.ID
+            chunk.chunkChanged(False)
+        del chunk
+        level.recentChunks.clear()
+        level.getChunk(1, 1)  # compacts the edited chunks
+        level._evictChunkData()  # and evicts them
+
+    def testDeleteEditedChunks(self):
+        level = self.reopen()
+        deleted = [(0, 0), (1, 0), (0, 1)]
+        self.evictEditedChunks(level, deleted)
+        level.finishChunkEvictions(wait=True)
+        assert level.unsavedWorkFolder.containsChunk(1, 0)
+
+        level.deleteChunks(deleted)
+        assert not level.containsChunk(0, 0)
+        assert not level.unsavedWorkFolder.containsChunk(1, 0)
+        level.saveInPlace()
+        level = self.reopen()
+        assert not any(level.containsChunk(*cPos) for cPos in deleted)
+        assert level.containsChunk(1, 1)
+
+    def testFailedEviction(self):
+        level = self.reopen()
+        edited = [(0, 0), (1, 0), (0, 1)]
+
+        def saveCompressedChunk(cx, cz, data, format):
+            raise IOError("No space left on device")
+
+        level.unsavedWorkFolder.saveCompressedChunk = saveCompressedChunk
+        self.evictEditedChunks(level, edited)
+        # Reading another chunk doesn't raise the error
+        level.getChunk(1, 1)
+        level.finishChunkEvictions(wait=True)
+        del level.unsavedWorkFolder.saveCompressedChunk
+        assert not level.unsavedWorkFolder.containsChunk(1, 0)
+        # The chunks that failed to be written are back in the cache, dirty, and aren't evicted again
+        failed = sorted(level._failedEvictions)
+        assert failed and set(failed) <= set(edited)
+        level._evictChunkData()
+        assert all(level._loadedChunkData[cPos].dirty for cPos in failed)
+
+        level.saveInPlace()
+        assert not level._failedEvictions
+        level = self.reopen()
+        for cPos in edited:
+            assert level.getChunk(*cPos).Blocks[0, 0, 100] == level.materials.Stone.ID
+
+    def testBackgroundPrefetch(self):
+        level = self.reopen()
+        chunks = sorted(level.allChunks)
+        level.prefetchChunks(chunks, wait=False)
+        assert sorted(level._pendingPrefetches) == chunks
+        assert not level._loadedChunkData
+
+        assert level.getChunk(0, 0).Blocks[3, 4, 70] == level.materials.Stone.ID
+        assert (0, 0) not in level._pendingPrefetches
+        for result in level._pendingPrefetches.values():
+            result.wait()
+        level.getChunk(1, 1)
+        assert not level._pendingPrefetches
+        assert sorted(level._loadedChunkData) == chunks
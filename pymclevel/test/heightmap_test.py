@@ -0,0 +1,54 @@
+import os
+import shutil
+import unittest
+
+import numpy
+
+from pymclevel.heightmap_import import HeightmapImage, importHeightmap
+from pymclevel.infiniteworld import MCInfdevOldLevel
+from templevel import mktemp
+
+
+class TestHeightmapImport(unittest.TestCase):
+    def setUp(self):
+        self.temppath = mktemp("HeightmapImport")
+        self.level = MCInfdevOldLevel(filename=self.temppath, create=True)
+        self.imagePath = mktemp("heightmap.pgm")
+
+        self.pixels = numpy.random.RandomState(0).randint(0, 1024, (70, 600)).astype('>u2')
+        with open(self.imagePath, "wb") as f:
+            f.write("P5\n# 16 bit\n600 70\n1023\n")
+            f.write(self.pixels.tostring())
+
+    def tearDown(self):
+        self.level.close()
+        shutil.rmtree(self.temppath)
+        os.unlink(self.imagePath)
+
+    def testImport(self):
+        level = self.level
+        level.loadedChunkMemoryLimit = 1 << 20
+        importHeightmap(level, HeightmapImage(self.imagePath))
+        assert level.chunkCacheEvictions
+        level.saveInPlace()
+        level.close()
+
+        level = self.level = MCInfdevOldLevel(filename=self.temppath)
+        assert level.chunkCount == 5 * 38
+        heights = self.pixels.astype(int) * 128 / 1024
+        for x, z in ((0, 0), (17, 300), (69, 599), (40, 513)):
+            chunk = level.getChunk(x >> 4, z >> 4)
+            column = chunk.Blocks[x & 0xf, z & 0xf]
+            h = heights[x, z]
+            assert column[0] == level.materials.Bedrock.ID
+            assert column[h] in (level.materials.Grass.ID, level.materials.Sand.ID)
+            assert not column[max(h + 1, 64):].any()
+            assert (column[h + 1:64] == level.materials.Water.ID).all()
+
+        # Columns outside of the image are left alone.
+        assert not level.getChunk(4, 37).Blocks[6:, :].any()
+
+        chunk = level.getChunk(2, 20)
+        skyLight = chunk.SkyLight.copy()
+        chunk.genFastLights()
+        assert (chunk.SkyLight == skyLight).all()
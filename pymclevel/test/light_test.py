@@ -0,0 +1,72 @@
+import shutil
+import unittest
+import numpy
+
+from pymclevel import block_light
+from pymclevel.infiniteworld import MCInfdevOldLevel
+from pymclevel.box import BoundingBox
+from templevel import mktemp
+
+
+class TestIncrementalLighting(unittest.TestCase):
+    def setUp(self):
+        self.temppath = mktemp("AnvilLighting")
+        self.level = level = MCInfdevOldLevel(filename=self.temppath, create=True)
+        level.createChunksInBox(BoundingBox((-32, 0, -32), (64, 1, 64)))
+
+        rand = numpy.random.RandomState(0)
+        for cPos in level.allChunks:
+            chunk = level.getChunk(*cPos)
+            chunk.Blocks[:, :, :40] = level.materials.Stone.ID
+            caves = chunk.Blocks[:, :, 40:60]
+            caves[rand.random_sample(caves.shape) < 0.3] = level.materials.Stone.ID
+            caves[rand.random_sample(caves.shape) < 0.02] = level.materials.Glowstone.ID
+            chunk.chunkChanged()
+        level.generateLights()
+
+    def tearDown(self):
+        self.level.close()
+        shutil.rmtree(self.temppath)
+
+    def lights(self):
+        return dict((cPos, (self.level.getChunk(*cPos).BlockLight.copy(), self.level.getChunk(*cPos).SkyLight.copy()))
+                    for cPos in self.level.allChunks)
+
+    def testMatchesFullRelight(self):
+        level = self.level
+        edits = [(BoundingBox((-5, 45, -5), (10, 10, 10)), level.materials.Air),
+                 (BoundingBox((0, 62, 0), (20, 1, 20)), level.materials.Stone),
+                 (BoundingBox((10, 50, 10), (3, 3, 3)), level.materials.Glowstone)]
+
+        for box, block in edits:
+            level.fillBlocks(box, block)
+            assert level.lightingDirtyBoxes == [box]
+            level.generateLights()
+            assert not level.lightingDirtyBoxes
+
+            incremental = self.lights()
+            level.generateLights(level.allChunks)
+            for cPos, (blockLight, skyLight) in self.lights().iteritems():
+                assert (incremental[cPos][0] == blockLight).all(), cPos
+                assert (incremental[cPos][1] == skyLight).all(), cPos
+
+    def testParallelMatchesClassic(self):
+        level = self.level
+        level.fillBlocks(BoundingBox((-5, 45, -5), (10, 10, 10)), level.materials.Air)
+        level.generateLights(level.allChunks)
+        classic = self.lights()
+
+        for cPos in level.allChunks:
+            level.getChunk(*cPos).BlockLight[:] = 0
+        level.lightingProcesses = 2
+        level.lightingProcessMinChunks = 0
+        level.generateLights(level.allChunks)
+        for cPos, (blockLight, skyLight) in self.lights().iteritems():
+            assert (classic[cPos][0] == blockLight).all(), cPos
+            assert (classic[cPos][1] == skyLight).all(), cPos
+
+    def testUnreadableTile(self):
+        # None of the chunks of this tile exist
+        tile = block_light._readTile(self.level, (4, 4), 8)
+        assert tile is None
+        assert block_light._lightTile(tile) is None
@@ -1,5 +1,10 @@
+from contextlib import contextmanager
+import os
+import struct
 import unittest
 import numpy
+from pymclevel import mclevel
+from pymclevel.leveldbpocket import PocketLeveldbDatabase, StreamingWriteBatch, dimension
 from templevel import TempLevel
 
 __author__ = 'Rio'
@@ -25,3 +30,187 @@ class TestPocket(unittest.TestCase):
 
         # level.copyBlocksFrom(alphalevel, BoundingBox((0, 0, 0), (64, 64, 64,)), (0, 0, 0))
         # assert((level.Blocks[0:64, 0:64, 0:64] == alphalevel.Blocks[0:64, 0:64, 0:64]).all())
+
+
+class TestPocketBlockStorage(unittest.TestCase):
+    def testWordsRoundTrip(self):
+        from pymclevel.leveldbpocket import pack_block_storage_words, unpack_block_storage_words
+        for bits in (1, 2, 3, 4, 5, 6, 8, 16):
+            indices = numpy.random.randint(0, 1 << bits, 4096)
+            raw = pack_block_storage_words(indices, bits)
+            assert len(raw) == 4 * -(-4096 // (32 // bits))
+            assert (unpack_block_storage_words(raw, bits) == indices).all(), bits
+
+
+class TestPocketChunkReads(unittest.TestCase):
+    # Chunk keys are found and read with forward scans of the database; these compare them with reading each key.
+    chunkSuffixes = ["\x2f" + chr(i) for i in xrange(16)] + ["\x2d", "\x2e", "0", "1", "2", "\x33", "\x34",
+                                                              "\x35", "\x36", "\x76"]
+
+    def setUp(self):
+        self.tempLevel = TempLevel("PocketWorld")
+        self.database = self.tempLevel.level.worldFile
+
+    def get(self, db, key):
+        try:
+            return db.Get(self.database.readOptions, key)
+        except Exception:
+            return None
+
+    def testAllChunks(self):
+        database = self.database
+        versionTag = "0" if database.world_version == 'pre1.0' else dimension + "\x76"
+        allChunks = database.getAllChunks()
+        assert allChunks
+
+        expected = set()
+        with database.world_db() as db:
+            it = db.NewIterator(database.readOptions)
+            it.SeekToFirst()
+            while it.Valid():
+                key = it.key()
+                if len(key) > 8 and self.get(db, key[:8] + versionTag) is not None:
+                    expected.add(struct.unpack('<2i', key[:8]))
+                it.stepForward()
+            del it
+        assert allChunks == expected
+
+    def testChunkValues(self):
+        database = self.database
+        masks = database.subchunkMasks
+        with database.world_db() as db:
+            for cx, cz in sorted(database.getAllChunks())[:32]:
+                key = struct.pack('<2i', cx, cz) + dimension
+                values = PocketLeveldbDatabase._readChunkValues(db, database.readOptions, key)
+                for suffix in self.chunkSuffixes:
+                    assert values.get(suffix) == self.get(db, key + suffix), ((cx, cz), suffix)
+                for suffix, value in values.iteritems():
+                    assert self.get(db, key + suffix) == value
+                if masks is not None:
+                    subchunks = [i for i in xrange(16) if "\x2f" + chr(i) in values]
+                    assert masks.get((cx, cz), 0) == sum(1 << i for i in subchunks)
+
+    def testScannedChunkRead(self):
+        level = self.tempLevel.level
+        database = self.database
+        cx, cz = sorted(level.allChunks)[0]
+        chunk = level.getChunk(cx, cz)
+
+        key = struct.pack('<2i', cx, cz) + dimension
+        with database.world_db() as db:
+            assert chunk.chunk_version == self.get(db, key + "\x76")
+            subchunks = [i for i in xrange(16) if self.get(db, key + "\x2f" + chr(i)) is not None]
+        if database.world_version != 'pre1.0':
+            assert sorted(set(chunk.subchunks)) == subchunks
+
+
+class TestPocketChunkCache(unittest.TestCase):
+    def setUp(self):
+        self.tempLevel = TempLevel("PocketWorld")
+        self.level = self.tempLevel.level
+        self.positions = sorted(self.level.allChunks)[:4]
+
+    def reopen(self):
+        self.level.close()
+        self.level = self.tempLevel.level = mclevel.fromFile(self.tempLevel.tmpname)
+        return self.level
+
+    def editChunk(self, cPos):
+        chunk = self.level.getChunk(*cPos)
+        chunk.Blocks[0, 0, 1] = 20
+        chunk.dirty = True
+        return chunk
+
+    def testEviction(self):
+        level = self.level
+        level.loadedChunkCacheLimit = 2
+        for cPos in self.positions:
+            self.editChunk(cPos)
+
+        assert list(level._loadedChunkCache) == self.positions[2:]
+        assert level._spilledChunks == set(self.positions[:2])
+        assert level._spillFile.loadChunk(*self.positions[0], world=level).Blocks[0, 0, 1] == 20
+        level.getChunk(*self.positions[0])
+        assert list(level._loadedChunkCache) == self.positions[3:] + self.positions[:1]
+
+    def testReloadSpilledChunk(self):
+        level = self.level
+        level.loadedChunkCacheLimit = 1
+        self.editChunk(self.positions[0])
+        level.getChunk(*self.positions[1])
+        level._loadedChunks.pop(self.positions[0], None)
+
+        chunk = level.getChunk(*self.positions[0])
+        assert chunk.Blocks[0, 0, 1] == 20
+        level.saveInPlace()
+        assert not level._spilledChunks
+        assert self.reopen().getChunk(*self.positions[0]).Blocks[0, 0, 1] == 20
+
+    def testEditAfterSpill(self):
+        level = self.level
+        level.loadedChunkCacheLimit = 1
+        chunk = self.editChunk(self.positions[0])
+        level.getChunk(*self.positions[1])
+        assert self.positions[0] in level._spilledChunks
+        assert chunk.dirty
+
+        # Changed again while it is still in use, without being marked dirty again
+        chunk.Blocks[0, 0, 2] = 20
+        level.saveInPlace()
+        chunk = self.reopen().getChunk(*self.positions[0])
+        assert chunk.Blocks[0, 0, 1] == chunk.Blocks[0, 0, 2] == 20
+
+    def testDiscardSpilledChunks(self):
+        level = self.level
+        level.loadedChunkCacheLimit = 1
+        original = level.getChunk(*self.positions[0]).Blocks[0, 0, 1]
+        self.editChunk(self.positions[0])
+        level.getChunk(*self.positions[1])
+        spillPath = level._spillFile.path
+        assert os.path.exists(spillPath)
+
+        level = self.reopen()
+        assert not os.path.exists(spillPath)
+        assert level.getChunk(*self.positions[0]).Blocks[0, 0, 1] == original
+
+
+class TestStreamingWriteBatch(unittest.TestCase):
+    def setUp(self):
+        self.tempLevel = TempLevel("PocketWorld")
+
+    def testBatches(self):
+        database = self.tempLevel.level.worldFile
+        batch = StreamingWriteBatch(database, 100)
+        for i in range(50):
+            batch.Put("mcedit-test-%02d" % i, "value %d" % i)
+            batch.flushIfFull()
+            assert batch.size < 100
+        batch.Delete("mcedit-test-00")
+        batch.flush(wait=True)
+        assert batch.size == 0
+
+        values = {}
+        with database.world_db() as db:
+            it = db.NewIterator(database.readOptions)
+            it.seek("mcedit-test-")
+            while it.Valid() and it.key().startswith("mcedit-test-"):
+                values[it.key()] = it.value()
+                it.stepForward()
+            del it
+        assert values == dict(("mcedit-test-%02d" % i, "value %d" % i) for i in range(1, 50))
+
+
+class TestStreamingWriteBatchErrors(unittest.TestCase):
+    def testWriteError(self):
+        class BrokenDatabase(object):
+            writeOptions = None
+
+            @contextmanager
+            def world_db(self):
+                raise IOError("No space left on device")
+                yield
+
+        batch = StreamingWriteBatch(BrokenDatabase(), 1)
+        batch.Put("key", "value")
+        batch.flushIfFull()
+        self.assertRaises(IOError, batch.flush, True)
@@ -0,0 +1,224 @@
+import os
+import shutil
+import unittest
+
+from pymclevel.infiniteworld import AnvilWorldFolder
+from pymclevel.regionfile import MCRegionFile, readRegionOffsets
+from templevel import mktemp
+
+
+class TestRegionFile(unittest.TestCase):
+    useMmap = False
+
+    def setUp(self):
+        self.oldUseMmap = MCRegionFile.useMmap
+        MCRegionFile.useMmap = self.useMmap
+        self.path = mktemp("r.0.0.mca")
+        self.regionFile = MCRegionFile(self.path, (0, 0))
+
+    def tearDown(self):
+        self.regionFile.close()
+        MCRegionFile.useMmap = self.oldUseMmap
+        os.unlink(self.path)
+
+    def reopen(self):
+        self.regionFile.close()
+        self.regionFile = MCRegionFile(self.path, (0, 0))
+        return self.regionFile
+
+    def testSaveAndRead(self):
+        rf = self.regionFile
+        chunks = dict(((cx, cz), os.urandom(5000 + cx * 700 + cz)) for cx in range(4) for cz in range(3))
+        for (cx, cz), data in chunks.iteritems():
+            rf.saveChunk(cx, cz, data)
+
+        # Grow one chunk past its allocation so it has to move.
+        chunks[1, 1] = os.urandom(20000)
+        rf.saveChunk(1, 1, chunks[1, 1])
+
+        rf = self.reopen()
+        assert rf.chunkCount == len(chunks)
+        for (cx, cz), data in chunks.iteritems():
+            assert rf.readChunk(cx, cz) == data
+
+    def testBatchDefersHeader(self):
+        rf = self.regionFile
+        with rf.batch():
+            rf.saveChunk(3, 4, "chunk data")
+            with open(self.path, "rb") as f:
+                assert f.read(MCRegionFile.SECTOR_BYTES) == "\0" * MCRegionFile.SECTOR_BYTES
+
+        assert self.reopen().readChunk(3, 4) == "chunk data"
+
+    def testBatchKeepsFreedSectors(self):
+        rf = self.regionFile
+        rf.saveChunk(0, 0, os.urandom(9000))
+        oldSector = rf.getOffset(0, 0) >> 8
+        with rf.batch():
+            # The header on disk still points to the chunk's old sectors until the batch ends.
+            rf.saveChunk(0, 0, os.urandom(20000))
+            rf.saveChunk(1, 0, os.urandom(9000))
+            assert rf.getOffset(1, 0) >> 8 != oldSector
+        rf.saveChunk(2, 0, os.urandom(9000))
+        assert rf.getOffset(2, 0) >> 8 == oldSector
+
+    def testBestFitAndCompact(self):
+        rf = self.regionFile
+        chunks = {}
+        for cx in range(8):
+            # 2, 3 or 4 sectors each
+            chunks[cx, 0] = os.urandom(4096 * (cx % 3 + 1))
+            rf.saveChunk(cx, 0, chunks[cx, 0])
+
+        # Leave a 4-sector hole and a 3-sector hole; a 3-sector chunk should take the second one.
+        holes = [rf.getOffset(2, 0) >> 8, rf.getOffset(4, 0) >> 8]
+        for cx in (2, 4):
+            rf.setOffset(cx, 0, 0)
+            del chunks[cx, 0]
+        rf = self.reopen()
+
+        chunks[9, 0] = os.urandom(9000)
+        rf.saveChunk(9, 0, chunks[9, 0])
+        assert rf.getOffset(9, 0) >> 8 == holes[1]
+
+        sectorCount = rf.sectorCount
+        assert rf.compact() == 4
+        assert rf.sectorCount == sectorCount - 4 == rf.usedSectors
+        assert os.path.getsize(self.path) == rf.sectorCount * MCRegionFile.SECTOR_BYTES
+
+        rf = self.reopen()
+        for (cx, cz), data in chunks.iteritems():
+            assert rf.readChunk(cx, cz) == data
+
+    def testCompactKeepsHeaderValid(self):
+        rf = self.regionFile
+        chunks = {}
+        for cx in range(8):
+            chunks[cx, 0] = os.urandom(4096 * (cx % 3 + 1))
+            rf.saveChunk(cx, 0, chunks[cx, 0])
+        # The 4-sector chunk after this 3-sector one has to move over its own sectors.
+        rf.deleteChunks([1])
+        del chunks[1, 0]
+
+        writeSector = rf.writeSector
+
+        def checkedWriteSector(sectorNumber, data, format):
+            # Nothing the header on disk points to is written over.
+            sectorCount = (len(data) + MCRegionFile.CHUNK_HEADER_SIZE) / MCRegionFile.SECTOR_BYTES + 1
+            offsets = readRegionOffsets(self.path)
+            for offset in offsets[offsets != 0]:
+                start, count = offset >> 8, offset & 0xff
+                assert start + count <= sectorNumber or sectorNumber + sectorCount <= start
+            writeSector(sectorNumber, data, format)
+
+        rf.writeSector = checkedWriteSector
+        assert rf.compact() == 3
+        assert os.path.getsize(self.path) == rf.sectorCount * MCRegionFile.SECTOR_BYTES
+
+        rf = self.reopen()
+        assert rf.usedSectors == rf.sectorCount
+        for (cx, cz), data in chunks.iteritems():
+            assert rf.readChunk(cx, cz) == data
+
+    def testLazySectorScan(self):
+        rf = self.regionFile
+        rf.saveChunk(1, 2, "chunk data")
+        rf.saveChunk(3, 4, "more chunk data")
+        offset = rf.getOffset(1, 2)
+
+        rf = self.reopen()
+        assert rf._freeSectors is None
+        assert rf.containsChunk(3, 4) and rf.chunkCount == 2
+        assert rf.usedSectors == 4
+
+        # Two chunks sharing sectors are found when the file is first used.
+        rf.setOffset(3, 4, offset)
+        rf = self.reopen()
+        repairs = []
+        rf.repair = lambda: repairs.append(True)
+        assert rf.readChunk(1, 2) == "chunk data"
+        assert repairs
+
+
+class TestRegionFileMmap(TestRegionFile):
+    useMmap = True
+
+
+class TestRegionChunkIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = mktemp("RegionChunkIndex")
+        self.indexPath = mktemp("ChunkIndexFolder")
+        AnvilWorldFolder.chunkIndexFolder = self.indexPath
+        self.chunks = set([(0, 0), (31, 31), (40, 3), (-1, -70)])
+        folder = AnvilWorldFolder(self.path)
+        for cx, cz in self.chunks:
+            folder.saveChunk(cx, cz, "chunk data")
+        folder.closeRegions()
+        self.age()
+
+    def tearDown(self):
+        AnvilWorldFolder.chunkIndexFolder = None
+        shutil.rmtree(self.path)
+        shutil.rmtree(self.indexPath, True)
+
+    def age(self):
+        # Entries for recently changed region files are not trusted.
+        for filepath in AnvilWorldFolder(self.path).findRegionFiles():
+            os.utime(filepath, (1000000000, 1000000000))
+
+    def testIndexIsUsedUntilRegionChanges(self):
+        assert AnvilWorldFolder(self.path).listChunks() == self.chunks
+        # The index is kept in its own folder, not in the world folder.
+        assert os.path.exists(AnvilWorldFolder(self.path).chunkIndexPath())
+        assert sorted(os.listdir(self.path)) == ["region"]
+
+        # Clear a header without changing the file's size or time; the index still lists its chunks.
+        folder = AnvilWorldFolder(self.path)
+        filepath = folder.getRegionFilename(0, 0)
+        with open(filepath, "rb+") as f:
+            f.write("\0" * MCRegionFile.SECTOR_BYTES)
+        os.utime(filepath, (1000000000, 1000000000))
+        assert AnvilWorldFolder(self.path).listChunks() == self.chunks
+
+        os.utime(filepath, (1000000100, 1000000100))
+        assert AnvilWorldFolder(self.path).listChunks() == set([(40, 3), (-1, -70)])
+        assert not os.path.exists(filepath)
+
+    def testOpenRegionsAreListedFromMemory(self):
+        folder = AnvilWorldFolder(self.path)
+        assert folder.listChunks() == self.chunks
+        folder.saveChunk(5, 6, "more chunk data")
+        folder.deleteChunk(40, 3)
+        assert folder.listChunks() == self.chunks - set([(40, 3)]) | set([(5, 6)])
+        folder.closeRegions()
+
+
+class TestDeleteChunks(unittest.TestCase):
+    def setUp(self):
+        self.path = mktemp("DeleteChunks")
+        self.folder = AnvilWorldFolder(self.path)
+        self.chunks = {}
+        with self.folder.batch():
+            for cx in range(40):
+                for cz in range(8):
+                    self.chunks[cx, cz] = os.urandom(5000)
+                    self.folder.saveChunk(cx, cz, self.chunks[cx, cz])
+
+    def tearDown(self):
+        self.folder.closeRegions()
+        shutil.rmtree(self.path)
+
+    def testDeleteChunks(self):
+        folder = self.folder
+        sizes = [os.path.getsize(folder.getRegionFilename(rx, 0)) for rx in (0, 1)]
+        deleted = [cPos for cPos in self.chunks if cPos[0] >= 4]
+        freedBytes = folder.deleteChunks(deleted, compact=True)
+
+        assert not os.path.exists(folder.getRegionFilename(1, 0))
+        assert os.path.getsize(folder.getRegionFilename(0, 0)) == (2 + 32 * 2) * MCRegionFile.SECTOR_BYTES
+        assert freedBytes == sum(sizes) - (2 + 32 * 2) * MCRegionFile.SECTOR_BYTES
+
+        folder.closeRegions()
+        assert folder.listChunks() == set(self.chunks) - set(deleted)
+        for cPos in folder.listChunks():
+            assert folder.readChunk(*cPos) == self.chunks[cPos]
@@ -0,0 +1,146 @@
+import os
+import shutil
+import unittest
+
+import numpy
+
+from mesh_cache import MeshCache
+from pymclevel.box import BoundingBox
+from pymclevel.infiniteworld import MCInfdevOldLevel
+from templevel import mktemp
+
+try:
+    import renderer
+except ImportError:  # the renderer needs OpenGL
+    renderer = None
+
+
+class InlineMeshPool(object):
+    """ Runs mesh worker tasks in this process, with a calculator of their own as a worker would have. """
+
+    def __init__(self, workerCalculator):
+        renderer._initMeshWorker(workerCalculator)
+
+    def apply_async(self, func, args):
+        return InlineResult(func(*args))
+
+
+class InlineResult(object):
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+class GeometryRenderer(object):
+    """ What ChunkRenderer and ChunkCalculator use of an MCRenderer. """
+    alpha = 0xff
+    showHiddenOres = False
+
+    def __init__(self, level):
+        self.level = level
+        self.visibleLayers = set(renderer.Layer.AllLayers)
+
+    def invalidateMasterList(self):
+        pass
+
+
+@unittest.skipIf(renderer is None, "the renderer can't be imported")
+class TestMeshWorker(unittest.TestCase):
+    def setUp(self):
+        self.temppath = mktemp("MeshWorker")
+        self.level = level = MCInfdevOldLevel(filename=self.temppath, create=True)
+        level.createChunksInBox(BoundingBox((0, 0, 0), (32, 1, 32)))
+
+        # Ground with every kind of block scattered over it, data included
+        materials = level.materials
+        blockIDs = numpy.array(sorted(set(b.ID for b in materials.allBlocks if 0 < b.ID < 256)), 'uint16')
+        rng = numpy.random.RandomState(0)
+        for cPos in level.allChunks:
+            chunk = level.getChunk(*cPos)
+            chunk.Blocks[:, :, :62] = materials.Stone.ID
+            chunk.Blocks[:, :, 62] = materials.Grass.ID
+            placed = rng.random_sample((16, 16, 24)) < 0.3
+            chunk.Blocks[:, :, 63:87][placed] = rng.choice(blockIDs, placed.sum())
+            chunk.Data[:, :, 63:87][placed] = rng.randint(0, 16, placed.sum())
+            chunk.chunkChanged(False)
+
+    def tearDown(self):
+        self.level.close()
+        shutil.rmtree(self.temppath)
+
+    def calculator(self, settings, meshProcesses=0):
+        calculator = renderer.ChunkCalculator(self.level, meshProcesses)
+        calculator.fastLeaves, calculator.roughGraphics, calculator.greedyMeshing = settings
+        calculator.cacheMeshes = False
+        return calculator
+
+    def geometry(self, calculator, cPos):
+        chunkRenderer = renderer.ChunkRenderer(GeometryRenderer(self.level), cPos)
+        for _ in calculator.calcFacesForChunkRenderer(chunkRenderer):
+            pass
+        return sorted((type(br).__name__, getattr(br, "y", None), [a.tostring() for a in br.vertexArrays],
+                       getattr(br, "textureTiles", None))
+                      for br in chunkRenderer.blockRenderers)
+
+    def testWorkerMatchesInProcess(self):
+        for settings in ((True, False, False), (False, False, False), (True, False, True), (True, True, False)):
+            local = self.calculator(settings)
+            pooled = self.calculator(settings, 1)
+            pooled._meshPool = InlineMeshPool(self.calculator((True, False, False)))
+            for cPos in self.level.allChunks:
+                expected = self.geometry(local, cPos)
+                assert expected
+                assert self.geometry(pooled, cPos) == expected
+
+    def testEdgeSectionKeys(self):
+        # The bottom and top sections of a level of stone get the same rows of blocks, cut off at each edge
+        calculator = self.calculator((True, False, False))
+        height = self.level.Height
+        blocks = numpy.ones((16, 16, height), 'uint16')
+        area = numpy.ones((18, 18, height + 2), 'uint8')
+        keys = calculator.meshCacheKeys(blocks, blocks, [0, 16, height - 16], area, area, area, 0)
+        assert len(set(keys)) == 3
+
+
+class TestMeshCache(unittest.TestCase):
+    def setUp(self):
+        self.temppath = mktemp("MeshCache")
+
+    def tearDown(self):
+        shutil.rmtree(self.temppath, True)
+
+    def geometry(self, length):
+        return [("GenericBlockRenderer", [numpy.random.random_sample((length, 4, 6)).astype('float32')], None)]
+
+    def testPutAndGet(self):
+        cache = MeshCache(self.temppath)
+        geometry = self.geometry(10)
+        cache.put("a", geometry)
+        assert cache.get("a") is not None
+        cache.flush()
+        assert os.path.exists(cache.filename("a"))
+
+        cache = MeshCache(self.temppath)
+        # Found before and after the folder is scanned
+        for _ in range(2):
+            (className, vertexArrays, textureTiles), = cache.get("a")
+            assert className == "GenericBlockRenderer" and textureTiles is None
+            assert (vertexArrays[0] == geometry[0][1][0]).all()
+            cache.flush()
+        assert cache.get("b") is None
+        assert cache.entries.keys() == ["a"]
+
+    def testEviction(self):
+        cache = MeshCache(self.temppath, 1 << 12)
+        for key in "abcdefgh":
+            cache.put(key, self.geometry(10))
+            cache.flush()
+        assert cache.size <= 1 << 12
+        assert cache.entries.keys()[-1] == "h"
+        assert cache.get("a") is None
+        assert sorted(os.listdir(self.temppath)) == sorted(cache.entries)
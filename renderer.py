@@ -27,7 +27,7 @@ MCRenderer:
 
 
     (+) ChunkRenderer
-        Has "chunkPosition", "invalidLayers", "lists"
+        Has "chunkPosition", "invalidLayers", "invalidSections", "lists"
         One per chunk and detail level.
         Creates display lists from BlockRenderers
 
@@ -217,14 +217,20 @@ BlockRender documentation
 from collections import defaultdict, deque
 from datetime import datetime, timedelta
 from depths import DepthOffset
-from glutils import gl, Texture
+from glutils import gl, Texture, VertexBufferPool
+from mesh_cache import MeshCache
 from albow.resource import _2478aq_heot
+import ctypes
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import numpy
 from OpenGL import GL
 import pymclevel
 from pymclevel.materials import alphaMaterials, pocketMaterials
 import sys
+from timeit import default_timer
 from config import config
 # import time
 
@@ -282,10 +288,12 @@ class ChunkRenderer(object):
         self.blockRenderers = []
         self.detailLevel = 0
         self.invalidLayers = set(Layer.AllLayers)
+        self.invalidSections = None  # the y of each section whose blocks changed, or None for all of them
 
         self.chunkPosition = chunkPosition
         self.bufferSize = 0
         self.renderstateLists = None
+        self.bufferRanges = {}  # block renderer -> ((buffer, offset), size) in the renderer's vertexBufferPool
 
     @property
     def visibleLayers(self):
@@ -318,6 +326,7 @@ class ChunkRenderer(object):
             return
         self.forgetDisplayLists()
         if not self.blockRenderers:
+            self.forgetVertexBuffers()
             return
 
         lists = defaultdict(list)
@@ -329,11 +338,18 @@ class ChunkRenderer(object):
 
         renderers = self.blockRenderers
 
+        # Renderers drawn the standard way go into vertex buffers instead, unless they are shown being redrawn.
+        useBuffers = self.renderer.vertexBufferPool is not None and not (showRedraw and self.needsBlockRedraw)
+        bufferedRenderers = []
+
         for blockRenderer in renderers:
             if self.detailLevel not in blockRenderer.detailLevels:
                 continue
             if blockRenderer.layer not in self.visibleLayers:
                 continue
+            if useBuffers and blockRenderer.drawsFromVertexBuffers and blockRenderer.textureTiles is None:
+                bufferedRenderers.append(blockRenderer)
+                continue
 
             l = blockRenderer.makeArrayList(self.chunkPosition, self.needsBlockRedraw and showRedraw)
             lists[blockRenderer.renderstate].append(l)
@@ -341,19 +357,57 @@ class ChunkRenderer(object):
         if not (showRedraw and self.needsBlockRedraw):
             GL.glDisableClientState(GL.GL_COLOR_ARRAY)
 
+        if self.renderer.vertexBufferPool is not None:
+            self.makeVertexBuffers(bufferedRenderers)
+
         self.needsRedisplay = False
         self.renderstateLists = lists
 
+    def makeVertexBuffers(self, renderers):
+        """ Copies the vertex arrays of the renderers that were not uploaded before into the renderer's vertex buffer
+        pool, and frees the ranges of the renderers that are gone, so only changed sections are uploaded. Vertices
+        are placed relative to the chunk's region, so that all of a region's chunks are drawn in one call. """
+        pool = self.renderer.vertexBufferPool
+        cx, cz = self.chunkPosition
+        bufferRanges = {}
+
+        for blockRenderer in renderers:
+            if blockRenderer in self.bufferRanges:
+                bufferRanges[blockRenderer] = self.bufferRanges.pop(blockRenderer)
+                continue
+
+            arrays = [a for a in blockRenderer.vertexArrays if len(a)]
+            if not arrays:
+                continue
+            vertices = numpy.concatenate(arrays)
+            vertices[_XYZ] += ((cx & 0x1f) << 4, getattr(blockRenderer, "y", 0), (cz & 0x1f) << 4)
+            bufferRanges[blockRenderer] = pool.upload(vertices), vertices.nbytes
+
+        self.forgetVertexBuffers()
+        self.bufferRanges = bufferRanges
+
+    def forgetVertexBuffers(self):
+        if self.bufferRanges:
+            for location, size in self.bufferRanges.itervalues():
+                self.renderer.vertexBufferPool.free(location, size)
+            self.bufferRanges = {}
+            self.renderer.discardMasterList()
+
     @property
     def needsBlockRedraw(self):
         return Layer.Blocks in self.invalidLayers
 
-    def invalidate(self, layers=None):
+    def invalidate(self, layers=None, sections=None):
         if layers is None:
             layers = Layer.AllLayers
 
         if layers:
             layers = set(layers)
+            if Layer.Blocks in layers:
+                if sections is None or self.invalidSections is None:
+                    self.invalidSections = None
+                else:
+                    self.invalidSections.update(sections)
             self.invalidLayers.update(layers)
             blockRenderers = [br for br in self.blockRenderers
                               if br.layer is Layer.Blocks
@@ -373,6 +427,7 @@ class ChunkRenderer(object):
             self.forgetDisplayLists()
             self.detailLevel = minlod
             self.invalidLayers.add(Layer.Blocks)
+            self.invalidSections = None
 
             # discard the standard detail renderers
             if minlod > 0:
@@ -399,6 +454,7 @@ class ChunkRenderer(object):
                 br.setAlpha(self.renderer.alpha)
         self.bufferSize = bufferSize
         self.invalidLayers = set()
+        self.invalidSections = set()
         self.needsRedisplay = True
         self.renderer.invalidateMasterList()
 
@@ -627,7 +683,7 @@ class ChunkCalculator(object):
     whiteLight = numpy.array([[[15] * 16] * 16] * 16, numpy.uint8)
     precomputedVertices = createPrecomputedVertices()
 
-    def __init__(self, level):
+    def __init__(self, level, meshProcesses=0):
         if not hasattr(alphaMaterials, 'Stone'):
             get_materials()
         self.stoneid = stoneid = alphaMaterials.Stone.ID
@@ -645,6 +701,92 @@ class ChunkCalculator(object):
                                         dtype=self.precomputedVertices[0].dtype)
         config.settings.fastLeaves.addObserver(self)
         config.settings.roughGraphics.addObserver(self)
+        config.settings.greedyMeshing.addObserver(self)
+        config.settings.cacheMeshes.addObserver(self)
+        config.settings.meshCacheSize.addObserver(self)
+
+        self.meshProcesses = meshProcesses
+        self._meshPool = None
+        self._meshCacheRevision = None
+
+    @property
+    def meshPool(self):
+        """ The worker processes that compute high detail geometry, or None if it is computed here. The workers are
+        forked from this process and work with their copy of this calculator. """
+        if self._meshPool is None and self.meshProcesses > 0:
+            self._meshPool = multiprocessing.Pool(self.meshProcesses, _initMeshWorker, (self,))
+        return self._meshPool
+
+    @property
+    def meshCache(self):
+        """ The on-disk cache of section geometry, or None if it is not used. """
+        if not self.cacheMeshes:
+            return None
+        return MeshCache.shared(self.meshCacheSize << 20)
+
+    def meshCacheKeys(self, blocks, blockData, sections, areaBlockMats, facingMats, areaBlockLights, baseY):
+        """ Returns a key for the geometry of each section, made from everything it is computed from: the graphics
+        settings, the texture coordinates and colors of the materials, the section's blocks and data with the rows
+        around it that doors look at, and the materials and lights of it and the blocks around it. The same blocks
+        make the same geometry at any height, so the section's y is only part of it at the level's edges. """
+        if self._meshCacheRevision is None:
+            revision = hashlib.sha1(str(MeshCache.version))
+            revision.update(self.level.materials.name)
+            revision.update(self.level.materials.blockTextures.tostring())
+            revision.update(repr((GenericBlockRenderer.grassColor, LeafBlockRenderer.leafColor)))
+            self._meshCacheRevision = revision
+        revision = self._meshCacheRevision.copy()
+        revision.update(repr((self.fastLeaves, self.roughGraphics, self.greedyMeshing)))
+
+        keys = []
+        for y in sections:
+            ly = y - baseY
+            by = max(0, y - 1)
+            key = revision.copy()
+            # The rows of blocks around the bottom and top sections are cut off by the level's edges, and both have
+            # one row less; where the section starts in them and their shapes tell them apart.
+            key.update(repr(y - by))
+            for array in (blocks[:, :, by:y + 17],
+                          blockData[:, :, by:y + 17],
+                          areaBlockMats[:, :, ly:ly + 18],
+                          facingMats[:, :, ly:ly + 18],
+                          areaBlockLights[:, :, ly:ly + 18]):
+                key.update(repr(array.shape))
+                key.update(array.tostring())
+            keys.append(key.hexdigest())
+        return keys
+
+    def cacheGeometry(self, meshCache, cacheKeys, geometry):
+        """ Stores the (class index, y, vertexArrays, textureTiles) of each block renderer of the sections in
+        cacheKeys, which maps their y to their key. """
+        sectionGeometry = dict((y, []) for y in cacheKeys)
+        for classIndex, y, vertexArrays, textureTiles in geometry:
+            if y in sectionGeometry:
+                sectionGeometry[y].append((self.blockRendererClasses[classIndex].__name__, vertexArrays,
+                                           textureTiles))
+        for y, key in cacheKeys.iteritems():
+            meshCache.put(key, sectionGeometry[y])
+
+    def cachedGeometry(self, y, geometry):
+        """ Returns the (className, vertexArrays, textureTiles) read from the mesh cache as
+        (class index, y, vertexArrays, textureTiles), or None if a class is not one of this calculator's. """
+        classIndices = dict((cls.__name__, i) for i, cls in enumerate(self.blockRendererClasses))
+        if any(className not in classIndices for className, vertexArrays, textureTiles in geometry):
+            return None
+        return [(classIndices[className], y, vertexArrays, textureTiles)
+                for className, vertexArrays, textureTiles in geometry]
+
+    @property
+    def chunksInFlight(self):
+        """ How many chunks the renderer works on at once: enough to keep the workers busy while the main thread
+        reads chunks and uploads geometry. """
+        return max(1, self.meshProcesses * 2)
+
+    def close(self):
+        if self._meshPool is not None:
+            self._meshPool.terminate()
+            self._meshPool.join()
+            self._meshPool = None
 
     class renderstatePlain(object):
         @classmethod
@@ -847,7 +989,7 @@ class ChunkCalculator(object):
             br = blockRendererClass(self)
             br.detailLevel = cr.detailLevel
 
-            for _ in br.makeChunkVertices(chunk):
+            for _ in self.timedSteps(blockRendererClass, br.makeChunkVertices(chunk)):
                 yield
             append(br)
 
@@ -855,6 +997,9 @@ class ChunkCalculator(object):
 
         # Recalculate high detail blocks if needed, otherwise retain the high detail renderers
         if lod == 0 and Layer.Blocks in cr.invalidLayers:
+            if cr.invalidSections is not None:
+                blockRenderers.extend(br for br in cr.blockRenderers
+                                      if not isinstance(br, classes) and br.y not in cr.invalidSections)
             for _ in self.calcHighDetailFaces(cr, blockRenderers):
                 yield
         else:
@@ -1034,7 +1179,7 @@ class ChunkCalculator(object):
     def calcHighDetailFaces(self, cr, blockRenderers):
         """ calculate the geometry for a chunk renderer from its blockMats, data,
         and lighting array. fills in the cr's blockRenderers with verts
-        for each block facing and material"""
+        for each block facing and material of its invalid sections"""
 
         # chunkBlocks and chunkLights shall be indexed [x,z,y] to follow infdev's convention
         cx, cz = cr.chunkPosition
@@ -1043,21 +1188,35 @@ class ChunkCalculator(object):
         chunk = level.getChunk(cx, cz)
 #         if isinstance(chunk, pymclevel.level.FakeChunk):
 #             return
+        height = chunk.world.Height
+        if cr.invalidSections is None:
+            sections = range(0, height, 16)
+        else:
+            sections = sorted(y for y in cr.invalidSections if 0 <= y < height)
+        if not sections:
+            return
+
         neighboringChunks = self.getNeighboringChunks(chunk)
 
-        areaBlocks = self.getAreaBlocks(chunk, neighboringChunks)
+        # Only the rows from the lowest to the highest invalid section, and the rows around them, are worked on. One
+        # more row is kept until the slabs have taken the light above them.
+        baseY, topY = sections[0], sections[-1] + 16
+        areaBlocks = self.getAreaBlocks(chunk, neighboringChunks)[:, :, baseY:topY + 3]
         yield
 
-        areaBlockLights = self.getAreaBlockLights(chunk, neighboringChunks)
+        areaBlockLights = self.getAreaBlockLights(chunk, neighboringChunks)[:, :, baseY:topY + 3]
         yield
 
         allSlabs = set([b.ID for b in alphaMaterials.allBlocks if "Slab" in b.name])
         for slab in allSlabs:
-            slabs = areaBlocks == slab
+            slabs = areaBlocks[:, :, :-1] == slab
             if slabs.any():
-                areaBlockLights[slabs] = areaBlockLights[:, :, 1:][slabs[:, :, :-1]]
+                areaBlockLights[:, :, :-1][slabs] = areaBlockLights[:, :, 1:][slabs]
             yield
 
+        areaBlocks = areaBlocks[:, :, :topY + 2 - baseY]
+        areaBlockLights = areaBlockLights[:, :, :topY + 2 - baseY]
+
         showHiddenOres = cr.renderer.showHiddenOres
         if showHiddenOres:
             facingMats = self.hiddenOreMaterials[areaBlocks]
@@ -1071,14 +1230,67 @@ class ChunkCalculator(object):
         else:
             areaBlockMats = self.materialMap[areaBlocks]
 
+        meshCache = self.meshCache
+        cacheKeys = {}  # y -> key of the sections to store once they are computed
+        if meshCache is not None:
+            # Sections of air with only air around them have no geometry to compute or look up.
+            sections = [y for y in sections if areaBlockMats[:, :, y - baseY:y - baseY + 18].any()]
+            keys = self.meshCacheKeys(chunk.Blocks, chunk.Data, sections, areaBlockMats, facingMats,
+                                      areaBlockLights, baseY)
+            for y, key in zip(sections, keys):
+                geometry = meshCache.get(key)
+                if geometry is not None:
+                    geometry = self.cachedGeometry(y, geometry)
+                if geometry is None:
+                    cacheKeys[y] = key
+                else:
+                    blockRenderers.extend(self.makeBlockRenderers(geometry))
+                    sections.remove(y)
+            if not sections:
+                return
+            yield
+
+        if self.meshPool is not None:
+            # A worker finds the faces and their vertices; other chunks are worked on until it is done.
+            result = self.meshPool.apply_async(_computeChunkGeometry, ((
+                chunk.Blocks.copy(), chunk.Data.copy(), sections, baseY, areaBlockMats, facingMats, areaBlockLights,
+                self.fastLeaves, self.roughGraphics, self.greedyMeshing),))
+            while not result.ready():
+                yield
+
+            geometry = result.get()
+            blockRenderers.extend(self.makeBlockRenderers(geometry))
+            if cacheKeys:
+                self.cacheGeometry(meshCache, cacheKeys, geometry)
+            return
+
         facingBlockIndices = self.getFacingBlockIndices(areaBlocks, facingMats)
         yield
 
-        for _ in self.computeGeometry(chunk, areaBlockMats, facingBlockIndices, areaBlockLights, cr, blockRenderers):
+        start = len(blockRenderers)
+        for _ in self.computeGeometry(chunk.Blocks, chunk.Data, sections, areaBlockMats, facingBlockIndices,
+                                      areaBlockLights, blockRenderers, baseY):
             yield
 
-    def computeGeometry(self, chunk, areaBlockMats, facingBlockIndices, areaBlockLights, chunkRenderer, blockRenderers):
-        blocks, blockData = chunk.Blocks, chunk.Data
+        if cacheKeys:
+            self.cacheGeometry(meshCache, cacheKeys, [
+                (self.blockRendererClasses.index(type(br)), br.y, br.vertexArrays, br.textureTiles)
+                for br in blockRenderers[start:]])
+
+    def makeBlockRenderers(self, geometry):
+        """ Makes the block renderers for the (class index, y, vertexArrays, textureTiles) of each returned by a mesh
+        worker. """
+        for classIndex, y, vertexArrays, textureTiles in geometry:
+            blockRenderer = self.blockRendererClasses[classIndex](self)
+            blockRenderer.y = y
+            blockRenderer.vertexArrays = vertexArrays
+            blockRenderer.textureTiles = textureTiles
+            yield blockRenderer
+
+    def computeGeometry(self, blocks, blockData, sections, areaBlockMats, facingBlockIndices, areaBlockLights,
+                        blockRenderers, baseY=0):
+        """ computes the geometry of the sections at the given y values. blocks and blockData
+        hold the whole chunk; the other arrays start at baseY. """
         blockData &= 0xf
         blockMaterials = areaBlockMats[1:-1, 1:-1, 1:-1]
         if self.roughGraphics:
@@ -1109,24 +1321,30 @@ class ChunkCalculator(object):
         sx = sz = slice(0, 16)
         asx = asz = slice(0, 18)
 
-        for y in xrange(0, chunk.world.Height, 16):
+        for y in sections:
             sy = slice(y, y + 16)
-            asy = slice(y, y + 18)
+            ly = slice(y - baseY, y - baseY + 16)
+            asy = slice(y - baseY, y - baseY + 18)
+
+            sectionMaterials = blockMaterials[sx, sz, ly]
+            sectionFaces = [f[sx, sz, ly] for f in facingBlockIndices]
+            # sections of air and plain cubes that show no faces have nothing to draw
+            if sectionMaterials.max() <= 1 and not any(f.any() for f in sectionFaces):
+                continue
 
             for _ in self.computeCubeGeometry(
                     y,
                     blockRenderers,
                     blocks[sx, sz, sy],
                     blockData[sx, sz, sy],
-                    chunk.materials,
-                    blockMaterials[sx, sz, sy],
-                    [f[sx, sz, sy] for f in facingBlockIndices],
-                    areaBlockLights[asx, asz, asy],
-                    chunkRenderer):
+                    self.level.materials,
+                    sectionMaterials,
+                    sectionFaces,
+                    areaBlockLights[asx, asz, asy]):
                 yield
 
     def computeCubeGeometry(self, y, blockRenderers, blocks, blockData, materials, blockMaterials, facingBlockIndices,
-                            areaBlockLights, chunkRenderer):
+                            areaBlockLights):
         materialCounts = numpy.bincount(blockMaterials.ravel())
         
         append = blockRenderers.append
@@ -1142,8 +1360,8 @@ class ChunkCalculator(object):
             blockRenderer = blockRendererClass(self)
             blockRenderer.y = y
             blockRenderer.materials = materials
-            for _ in blockRenderer.makeVertices(facingBlockIndices, blocks, blockMaterials, blockData, areaBlockLights,
-                                                texMap):
+            for _ in self.timedSteps(blockRendererClass, blockRenderer.makeVertices(
+                    facingBlockIndices, blocks, blockMaterials, blockData, areaBlockLights, texMap)):
                 yield
             append(blockRenderer)
 
@@ -1152,6 +1370,48 @@ class ChunkCalculator(object):
     def makeTemplate(self, direction, blockIndices):
         return self.precomputedVertices[direction][numpy.where(blockIndices)]
 
+    rendererTimes = None  # when set to a dict, the seconds each block renderer class spends making vertices
+
+    def timedSteps(self, blockRendererClass, steps):
+        """ Yields for each of the steps, adding the time spent in them to rendererTimes if it is set. Geometry
+        computed by the mesh workers is not timed. """
+        if self.rendererTimes is None:
+            return steps
+        return self._timedSteps(self.rendererTimes, blockRendererClass.__name__, steps)
+
+    @staticmethod
+    def _timedSteps(times, key, steps):
+        start = default_timer()
+        for _ in steps:
+            times[key] = times.get(key, 0.0) + default_timer() - start
+            yield
+            start = default_timer()
+        times[key] = times.get(key, 0.0) + default_timer() - start
+
+
+def _initMeshWorker(calculator):
+    global _meshCalculator
+    _meshCalculator = calculator
+
+
+def _computeChunkGeometry((blocks, blockData, sections, baseY, areaBlockMats, facingMats, areaBlockLights, fastLeaves,
+                           roughGraphics, greedyMeshing)):
+    # Runs in a mesh worker process. Returns the vertex arrays of each block renderer as (class index, y,
+    # vertexArrays, textureTiles); the settings are passed along as the worker's calculator does not see them change.
+    calculator = _meshCalculator
+    calculator.fastLeaves = fastLeaves
+    calculator.roughGraphics = roughGraphics
+    calculator.greedyMeshing = greedyMeshing
+
+    blockRenderers = []
+    facingBlockIndices = calculator.getFacingBlockIndices(None, facingMats)
+    for _ in calculator.computeGeometry(blocks, blockData, sections, areaBlockMats, facingBlockIndices, areaBlockLights,
+                                        blockRenderers, baseY):
+        pass
+
+    classes = calculator.blockRendererClasses
+    return [(classes.index(type(br)), br.y, br.vertexArrays, br.textureTiles) for br in blockRenderers]
+
 
 class Layer:
     Blocks = "Blocks"
@@ -1178,6 +1438,8 @@ class BlockRenderer(object):
     }
     renderstate = ChunkCalculator.renderstateAlphaTest
     used = False
+    textureTiles = None  # the terrain texture tile each vertex array repeats, for merged faces
+    drawsFromVertexBuffers = True  # False for renderers that draw their vertex arrays their own way
 
     def __init__(self, cc):
         self.makeTemplate = cc.makeTemplate
@@ -1255,6 +1517,7 @@ class BlockRenderer(object):
 class EntityRendererGeneric(BlockRenderer):
     renderstate = ChunkCalculator.renderstateEntity
     detailLevels = (0, 1, 2)
+    drawsFromVertexBuffers = False
 
     def drawFaceVertices(self, buf):
         if not len(buf):
@@ -1518,6 +1781,7 @@ class ChunkBorderRenderer(EntityRendererGeneric):
 class LowDetailBlockRenderer(BlockRenderer):
     renderstate = ChunkCalculator.renderstateLowDetail
     detailLevels = (1,)
+    drawsFromVertexBuffers = False
 
     def drawFaceVertices(self, buf):
         if not len(buf):
@@ -1636,11 +1900,168 @@ class OverheadBlockRenderer(LowDetailBlockRenderer):
     detailLevels = (2,)
 
 
+def mergeFaces(keys):
+    """ Merges the faces in keys, indexed [slice, row, column] with -1 where there is no face, into rectangles of
+    faces with equal keys: first into runs along each row, then runs that are the same in consecutive rows into one.
+    Returns the slice, row, column, height, width and key of each rectangle. """
+    slices, rows, columns = keys.shape
+    # a column of -1 after each row ends the runs there
+    padded = numpy.empty((slices * rows, columns + 1), keys.dtype)
+    padded[:, :-1] = keys.reshape(slices * rows, columns)
+    padded[:, -1] = -1
+    padded = padded.ravel()
+
+    changes = numpy.ones(len(padded), bool)
+    changes[1:] = padded[1:] != padded[:-1]
+    starts = changes.nonzero()[0]
+    lengths = numpy.diff(numpy.append(starts, len(padded)))
+    runKeys = padded[starts]
+    faces = runKeys != -1
+    starts, lengths, runKeys = starts[faces], lengths[faces], runKeys[faces]
+    runSlices, runRows = numpy.divmod(starts // (columns + 1), rows)
+    runColumns = starts % (columns + 1)
+
+    order = numpy.lexsort((runRows, runKeys, lengths, runColumns, runSlices))
+    runSlices, runRows, runColumns, lengths, runKeys = (a[order] for a in
+                                                        (runSlices, runRows, runColumns, lengths, runKeys))
+    continues = numpy.zeros(len(order), bool)
+    continues[1:] = ((runSlices[1:] == runSlices[:-1]) & (runColumns[1:] == runColumns[:-1]) &
+                     (lengths[1:] == lengths[:-1]) & (runKeys[1:] == runKeys[:-1]) & (runRows[1:] == runRows[:-1] + 1))
+    rectangles = (~continues).nonzero()[0]
+    heights = numpy.diff(numpy.append(rectangles, len(order)))
+    return (runSlices[rectangles], runRows[rectangles], runColumns[rectangles], heights, lengths[rectangles],
+            runKeys[rectangles])
+
+
+def tileUnits(materials):
+    """ The texture coordinates across one tile of the terrain texture when it is drawn by itself. """
+    return 512 if materials.name in ("Pocket", "Alpha") else 256
+
+
+def tileTexture(materials, (s, t)):
+    """ Returns a texture of the tile of materials' terrain texture at s, t, for merged faces to repeat, or None if
+    the terrain texture has no image to cut it from. Textures are kept with the terrain texture they were cut from. """
+    terrainTexture = materials.terrainTexture
+    data = getattr(terrainTexture, "data", None)
+    if data is None:
+        return None
+
+    tiles = terrainTexture.__dict__.setdefault("tileTextures", {})
+    if (s, t) not in tiles:
+        h, w = data.shape[:2]
+        size = w * 16 / tileUnits(materials)
+        x, y = s * w / tileUnits(materials), t * h / tileUnits(materials)
+        texData = numpy.array(data[y:y + size, x:x + size])
+
+        def _loadFunc():
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, size, size, 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, texData)
+
+        tiles[s, t] = Texture(_loadFunc)
+    return tiles[s, t]
+
+
 class GenericBlockRenderer(BlockRenderer):
     renderstate = ChunkCalculator.renderstateAlphaTest
 
     materialIndex = 1
 
+    # For merged faces: the axes of the section arrays ([x, z, y]) that are the slices, rows and columns for faces
+    # in each direction, and the axes of the vertices ([x, y, z]) along the texture's s and t.
+    greedyAxes = {
+        pymclevel.faces.FaceXIncreasing: ((0, 1, 2), (2, 1)),
+        pymclevel.faces.FaceXDecreasing: ((0, 1, 2), (2, 1)),
+        pymclevel.faces.FaceYIncreasing: ((2, 0, 1), (0, 2)),
+        pymclevel.faces.FaceYDecreasing: ((2, 0, 1), (0, 2)),
+        pymclevel.faces.FaceZIncreasing: ((1, 0, 2), (0, 1)),
+        pymclevel.faces.FaceZDecreasing: ((1, 0, 2), (0, 1)),
+    }
+
+    def makeVertices(self, facingBlockIndices, blocks, blockMaterials, blockData, areaBlockLights, texMap):
+        if self.chunkCalculator.greedyMeshing:
+            return self.makeGreedyVertices(facingBlockIndices, blocks, blockMaterials, blockData, areaBlockLights,
+                                           texMap)
+        return self.makeGenericVertices(facingBlockIndices, blocks, blockMaterials, blockData, areaBlockLights,
+                                        texMap)
+
+    def makeGreedyVertices(self, facingBlockIndices, blocks, blockMaterials, blockData, areaBlockLights, texMap):
+        """ Like makeGenericVertices, but the faces that show the same texture with the same light next to each
+        other are drawn as one quad. Each vertex array holds the quads of one texture tile, which they repeat. """
+        quads = []
+        tiles = []
+        materialIndices = self.getMaterialIndices(blockMaterials)
+        grassID = alphaMaterials.Grass.ID if self.materials.name in ("Alpha", "Pocket") else -1
+        scale = tileUnits(self.materials) / 16.
+        yield
+
+        for (direction, exposedFaceIndices) in enumerate(facingBlockIndices):
+            blockIndices = materialIndices & exposedFaceIndices
+            if not blockIndices.any():
+                continue
+
+            # faces can be merged if their texture, light and grass color are the same
+            facingBlockLight = areaBlockLights[self.directionOffsets[direction]]
+            theseBlocks = blocks[blockIndices]
+            st = texMap(theseBlocks, blockData[blockIndices], direction).astype('int64')
+            keys = numpy.zeros(blocks.shape, 'int64') - 1
+            keys[blockIndices] = ((st[:, 0] << 10 | st[:, 1]) << 5 | facingBlockLight[blockIndices]) << 1 | (
+                (theseBlocks == grassID) & (direction == pymclevel.faces.FaceYIncreasing))
+
+            (sliceAxis, rowAxis, columnAxis), (sAxis, tAxis) = self.greedyAxes[direction]
+            rectangles = mergeFaces(keys.transpose(sliceAxis, rowAxis, columnAxis))
+            keys = rectangles[5]
+
+            origin = numpy.zeros((len(keys), 3), 'float32')  # [x, z, y] like the section arrays
+            extent = numpy.ones((len(keys), 3), 'float32')
+            origin[:, sliceAxis], origin[:, rowAxis], origin[:, columnAxis] = rectangles[:3]
+            extent[:, rowAxis], extent[:, columnAxis] = rectangles[3:5]
+            origin, extent = origin[:, (0, 2, 1)], extent[:, (0, 2, 1)]  # to the vertices' [x, y, z]
+
+            template = faceVertexTemplates[direction]
+            vertexArray = numpy.zeros((len(keys), 4, 6), 'float32')
+            vertexArray[_XYZ] = origin[:, numpy.newaxis] + template[:, 0:3] * extent[:, numpy.newaxis]
+            vertexArray[..., 3] = template[:, 3] * extent[:, sAxis, numpy.newaxis] * scale
+            vertexArray[..., 4] = template[:, 4] * extent[:, tAxis, numpy.newaxis] * scale
+
+            rgba = vertexArray.view('uint8')[_RGBA]
+            rgba[..., :3] = template[:, 5, numpy.newaxis]
+            rgba[..., :3] *= ((keys >> 1) & 0x1f).astype('uint8')[:, numpy.newaxis, numpy.newaxis]
+            rgba[..., 3] = 0xff
+            grass = (keys & 1).astype(bool)
+            rgba[grass, :, :3] = rgba[grass, :, :3].astype(float) * self.grassColor
+            yield
+
+            quads.append(vertexArray)
+            tiles.append(keys >> 6)
+
+        self.vertexArrays = []
+        self.textureTiles = []
+        if quads:
+            quads = numpy.concatenate(quads)
+            tiles = numpy.concatenate(tiles)
+            order = numpy.argsort(tiles, kind='mergesort')
+            quads, tiles = quads[order], tiles[order]
+            splits = (tiles[1:] != tiles[:-1]).nonzero()[0] + 1
+            for start, end in zip(numpy.append(0, splits), numpy.append(splits, len(tiles))):
+                self.vertexArrays.append(quads[start:end])
+                self.textureTiles.append((int(tiles[start] >> 10), int(tiles[start] & 0x3ff)))
+
+    def makeArrayList(self, chunkPosition, showRedraw):
+        if self.textureTiles is not None:
+            # Tile textures are made before the list is compiled; compiling would only record their upload.
+            for tile in self.textureTiles:
+                tileTexture(self.materials, tile)
+            self.materials.terrainTexture.bind()
+        return super(GenericBlockRenderer, self).makeArrayList(chunkPosition, showRedraw)
+
+    def drawVertices(self):
+        if self.textureTiles is None:
+            return super(GenericBlockRenderer, self).drawVertices()
+
+        for tile, buf in zip(self.textureTiles, self.vertexArrays):
+            (tileTexture(self.materials, tile) or self.materials.terrainTexture).bind()
+            self.drawFaceVertices(buf)
+        self.materials.terrainTexture.bind()
+
     def makeGenericVertices(self, facingBlockIndices, blocks, blockMaterials, blockData, areaBlockLights, texMap):
         vertexArrays = []
         append = vertexArrays.append
@@ -1672,8 +2093,6 @@ class GenericBlockRenderer(BlockRenderer):
 
     grassColor = grassColorDefault = [0.39, 0.71, 0.23]  # 62C743
 
-    makeVertices = makeGenericVertices
-
 
 class LeafBlockRenderer(BlockRenderer):
     
@@ -3204,6 +3623,8 @@ class MCRenderer(object):
         self.visibleLayers = set(Layer.AllLayers)
 
         self.masterLists = None
+        self.bufferDraws = {}
+        self.vertexBufferPool = None
 
         alpha *= 255
         self.alpha = (int(alpha) & 0xff)
@@ -3220,6 +3641,9 @@ class MCRenderer(object):
         config.settings.fastLeaves.addObserver(self)
 
         config.settings.roughGraphics.addObserver(self)
+        config.settings.greedyMeshing.addObserver(self)
+        config.settings.useVertexBuffers.addObserver(self)
+        config.settings.meshProcesses.addObserver(self)
         config.settings.showHiddenOres.addObserver(self)
         config.settings.vertexBufferLimit.addObserver(self)
 
@@ -3352,6 +3776,29 @@ class MCRenderer(object):
     minWorkFactor = 1
     workFactor = 2
 
+    # Worker processes computing high detail chunk geometry, from the Mesh Processes graphics setting. They are forked
+    # from the editor after it has a GL context and threads, so they are only used when asked for, and never where
+    # processes are spawned instead (Windows) or a forked GUI process can't be relied on (OS X). Otherwise the
+    # geometry is computed on the main thread between frames.
+    canForkMeshProcesses = sys.platform not in ("win32", "darwin")
+    _meshProcesses = 0
+
+    @property
+    def meshProcesses(self):
+        return self._meshProcesses if self.canForkMeshProcesses else 0
+
+    @meshProcesses.setter
+    def meshProcesses(self, val):
+        val = max(0, int(val))
+        if self._meshProcesses != val:
+            self._meshProcesses = val
+            if self.chunkCalculator:
+                # Chunks waiting on the old workers are started again
+                self.stopWork()
+                self.chunkCalculator.close()
+                self.chunkCalculator.meshProcesses = self.meshProcesses
+                self.discardAllChunks()
+
     chunkCalculator = None
 
     _level = None
@@ -3368,6 +3815,8 @@ class MCRenderer(object):
         self._level = level
         self.oldPosition = None
         self.position = (0, 0, 0)
+        if self.chunkCalculator:
+            self.chunkCalculator.close()
         self.chunkCalculator = None
 
         self.invalidChunkQueue = deque()
@@ -3377,7 +3826,7 @@ class MCRenderer(object):
         self.loadableChunkMarkers.invalidate()
 
         if level:
-            self.chunkCalculator = self.calculatorClass(self.level)
+            self.chunkCalculator = self.calculatorClass(self.level, self.meshProcesses)
 
             self.oldPosition = None
             
@@ -3396,7 +3845,25 @@ class MCRenderer(object):
         else:
             d = distance
 
-        self.chunkIterator = self.iterateChunks(wx, wz, d * 2)
+        self.chunkIterator = self.prefetchAhead(self.iterateChunks(wx, wz, d * 2))
+
+    prefetchChunkCount = 32  # chunks the level reads ahead of the chunk iterator, to be parsed in the background
+
+    def prefetchAhead(self, chunkPositions):
+        """ Yields chunkPositions, having the level read the next prefetchChunkCount of them and parse them on its
+        load threads while the ones before them are worked on. """
+        chunkPositions = iter(chunkPositions)
+        batch = []
+        while True:
+            nextBatch = list(itertools.islice(chunkPositions, self.prefetchChunkCount))
+            level = self.level
+            if nextBatch and level is not None and not level.saving:
+                level.prefetchChunks([c for c in nextBatch if level.containsChunk(*c)], wait=False)
+            for c in batch:
+                yield c
+            if not nextBatch:
+                return
+            batch = nextBatch
 
     def iterateChunks(self, x, z, d):
         cx = x >> 4
@@ -3479,6 +3946,7 @@ class MCRenderer(object):
         if (cx, cz) in self.chunkRenderers:
             self.bufferUsage -= self.chunkRenderers[cx, cz].bufferSize
             self.chunkRenderers[cx, cz].forgetDisplayLists()
+            self.chunkRenderers[cx, cz].forgetVertexBuffers()
             del self.chunkRenderers[cx, cz]
 
     _fastLeaves = False
@@ -3507,6 +3975,35 @@ class MCRenderer(object):
 
         self._roughGraphics = bool(val)
 
+    _greedyMeshing = False
+
+    @property
+    def greedyMeshing(self):
+        return self._greedyMeshing
+
+    @greedyMeshing.setter
+    def greedyMeshing(self, val):
+        if self._greedyMeshing != bool(val):
+            self.discardAllChunks()
+
+        self._greedyMeshing = bool(val)
+
+    _useVertexBuffers = False
+
+    @property
+    def useVertexBuffers(self):
+        return self._useVertexBuffers
+
+    @useVertexBuffers.setter
+    def useVertexBuffers(self, val):
+        if self._useVertexBuffers != bool(val):
+            self.discardAllChunks()
+            if self.vertexBufferPool is not None:
+                self.vertexBufferPool.delete()
+                self.vertexBufferPool = None
+
+        self._useVertexBuffers = bool(val)
+
     _showHiddenOres = False
 
     @property
@@ -3525,19 +4022,20 @@ class MCRenderer(object):
         if self.showHiddenOres:
             self.discardAllChunks()
 
-    def invalidateChunk(self, cx, cz, layers=None):
+    def invalidateChunk(self, cx, cz, layers=None, sections=None):
         " marks the chunk for regenerating vertex data and display lists "
         if (cx, cz) in self.chunkRenderers:
 
-            self.chunkRenderers[(cx, cz)].invalidate(layers)
+            self.chunkRenderers[(cx, cz)].invalidate(layers, sections)
 
             self.invalidChunkQueue.append((cx, cz))  # xxx encapsulate
 
     def invalidateChunksInBox(self, box, layers=None):
         # If the box is at the edge of any chunks, expanding by 1 makes sure the neighboring chunk gets redrawn.
+        # The same goes for the sections above and below it; only the sections in the box are redrawn.
         box = box.expand(1)
 
-        self.invalidateChunks(box.chunkPositions, layers)
+        self.invalidateChunks(box.chunkPositions, layers, range(box.miny & ~0xf, box.maxy, 16))
 
     def invalidateEntitiesInBox(self, box):
         self.invalidateChunks(box.chunkPositions, [Layer.Entities])
@@ -3545,9 +4043,9 @@ class MCRenderer(object):
     def invalidateTileTicksInBox(self, box):
         self.invalidateChunks(box.chunkPositions, [Layer.TileTicks])
 
-    def invalidateChunks(self, chunks, layers=None):
+    def invalidateChunks(self, chunks, layers=None, sections=None):
         for (cx, cz) in chunks:
-            self.invalidateChunk(cx, cz, layers)
+            self.invalidateChunk(cx, cz, layers, sections)
 
         self.stopWork()
         self.discardMasterList()
@@ -3559,6 +4057,7 @@ class MCRenderer(object):
     def forgetAllDisplayLists(self):
         for cr in self.chunkRenderers.itervalues():
             cr.forgetDisplayLists()
+            cr.forgetVertexBuffers()
 
     def invalidateMasterList(self):
         self.discardMasterList()
@@ -3699,8 +4198,12 @@ class MCRenderer(object):
     else:
         def createMasterLists(self):
             if self.shouldRecreateMasterList:
+                if self.useVertexBuffers and self.vertexBufferPool is None and VertexBufferPool.supported():
+                    self.vertexBufferPool = VertexBufferPool()
+
                 lists = {}
                 chunkLists = defaultdict(list)
+                chunkRanges = defaultdict(lambda: ([], []))  # (renderstate, region, buffer) -> (firsts, counts)
                 chunksPerFrame = 80
                 shouldRecreateAgain = False
 
@@ -3716,29 +4219,58 @@ class MCRenderer(object):
                         for rs in ch.renderstateLists:
                             chunkLists[rs] += ch.renderstateLists[rs]
 
+                    cx, cz = ch.chunkPosition
+                    for br, ((index, offset), size) in ch.bufferRanges.iteritems():
+                        firsts, counts = chunkRanges[br.renderstate, cx >> 5, cz >> 5, index]
+                        firsts.append(offset / elementByteLength)
+                        counts.append(size / elementByteLength)
+
                 for rs in chunkLists:
                     if len(chunkLists[rs]):
                         lists[rs] = numpy.array(chunkLists[rs], dtype='uint32').ravel()
 
+                bufferDraws = defaultdict(list)
+                for (rs, rx, rz, index), (firsts, counts) in chunkRanges.iteritems():
+                    bufferDraws[rs].append((rx, rz, index, numpy.array(firsts, 'int32'), numpy.array(counts, 'int32')))
+
                 self.masterLists = lists
+                self.bufferDraws = bufferDraws
                 self.shouldRecreateMasterList = shouldRecreateAgain
                 self.needsImmediateRedraw = shouldRecreateAgain
 
         def callMasterLists(self):
             for renderstate in self.chunkCalculator.renderstates:
-                if renderstate not in self.masterLists:
+                if renderstate not in self.masterLists and renderstate not in self.bufferDraws:
                     continue
 
                 if self.alpha != 0xff and renderstate is not ChunkCalculator.renderstateLowDetail:
                     GL.glEnable(GL.GL_BLEND)
                 renderstate.bind()
 
-                GL.glCallLists(self.masterLists[renderstate])
+                if renderstate in self.masterLists:
+                    GL.glCallLists(self.masterLists[renderstate])
+                if renderstate in self.bufferDraws:
+                    self.drawVertexBuffers(self.bufferDraws[renderstate])
 
                 renderstate.release()
                 if self.alpha != 0xff and renderstate is not ChunkCalculator.renderstateLowDetail:
                     GL.glDisable(GL.GL_BLEND)
 
+        def drawVertexBuffers(self, draws):
+            # One multi-draw call for each region's ranges in each buffer
+            stride = elementByteLength
+            GL.glEnableClientState(GL.GL_COLOR_ARRAY)
+            for rx, rz, index, firsts, counts in draws:
+                GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.vertexBufferPool.buffers[index])
+                GL.glVertexPointer(3, GL.GL_FLOAT, stride, ctypes.c_void_p(0))
+                GL.glTexCoordPointer(2, GL.GL_FLOAT, stride, ctypes.c_void_p(12))
+                GL.glColorPointer(4, GL.GL_UNSIGNED_BYTE, stride, ctypes.c_void_p(20))
+                with gl.glPushMatrix(GL.GL_MODELVIEW):
+                    GL.glTranslate(rx << 9, 0, rz << 9)
+                    GL.glMultiDrawArrays(GL.GL_QUADS, firsts, counts, len(firsts))
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+            GL.glDisableClientState(GL.GL_COLOR_ARRAY)
+
     errorLimit = 10
 
     def draw(self):
@@ -3761,7 +4293,12 @@ class MCRenderer(object):
             GL.glEnable(GL.GL_CULL_FACE)
             GL.glEnable(GL.GL_DEPTH_TEST)
 
-            self.level.materials.terrainTexture.bind()
+            terrainTexture = self.level.materials.terrainTexture
+            if self.greedyMeshing and terrainTexture is not self.greedyTerrainTexture:
+                # The display lists of merged faces bind textures cut from the terrain texture.
+                self.greedyTerrainTexture = terrainTexture
+                self.discardAllChunks()
+            terrainTexture.bind()
             GL.glEnable(GL.GL_TEXTURE_2D)
             GL.glEnableClientState(GL.GL_TEXTURE_COORD_ARRAY)
 
@@ -3793,10 +4330,13 @@ class MCRenderer(object):
             GL.glScalef(2., 2., 2.)
 
     renderErrorHandled = False
+    greedyTerrainTexture = None
 
     def addDebugInfo(self, addDebugString):
-        addDebugString("BU: {0} MB, ".format(
+        addDebugString("BU: {0} MB{1}{2}, ".format(
             self.bufferUsage / 1000000,
+            " (greedy)" if self.greedyMeshing else "",
+            " ({0} MB in VBOs)".format(self.vertexBufferPool.usedBytes / 1000000) if self.vertexBufferPool else "",
         ))
 
         addDebugString("WQ: {0}, ".format(len(self.invalidChunkQueue)))
@@ -3810,8 +4350,10 @@ class MCRenderer(object):
 
     def makeWorkIterator(self):
         ''' does chunk face and vertex calculation work. returns a generator that can be
-        iterated over for smaller work units.'''
+        iterated over for smaller work units. several chunks are worked on in turn while
+        the chunk calculator's workers compute their geometry.'''
 
+        active = deque()  # (chunk position, work iterator)
         try:
             while True:
                 if self.level is None:
@@ -3820,40 +4362,33 @@ class MCRenderer(object):
                 if len(self.invalidChunkQueue) > 1024:
                     self.invalidChunkQueue.clear()
 
-                if len(self.invalidChunkQueue):
-                    c = self.invalidChunkQueue[0]
-                    for _ in self.workOnChunk(c):
-                        yield
-                    self.invalidChunkQueue.popleft()
-
-                elif self.chunkIterator is None:
-                    raise StopIteration
-
-                else:
-                    c = self.chunkIterator.next()
-                    if self.vertexBufferLimit:
-                        while self.bufferUsage > (0.9 * (self.vertexBufferLimit << 20)):
-                            deadChunk = None
-                            deadDistance = self.chunkDistance(c)
-                            for cr in self.chunkRenderers.itervalues():
-                                dist = self.chunkDistance(cr.chunkPosition)
-                                if dist > deadDistance:
-                                    deadChunk = cr
-                                    deadDistance = dist
-
-                            if deadChunk is not None:
-                                self.discardChunk(*deadChunk.chunkPosition)
-
-                            else:
-                                break
-
+                activeChunks = [c for c, _ in active]
+                if len(active) < self.chunkCalculator.chunksInFlight:
+                    if len(self.invalidChunkQueue):
+                        # wait for a chunk that is invalidated again while it is worked on
+                        if self.invalidChunkQueue[0] not in activeChunks:
+                            c = self.invalidChunkQueue.popleft()
+                            active.append((c, self.workOnChunk(c)))
+
+                    elif self.chunkIterator is not None:
+                        try:
+                            c = self.chunkIterator.next()
+                        except StopIteration:
+                            self.chunkIterator = None
                         else:
-                            for _ in self.workOnChunk(c):
-                                yield
+                            if c not in activeChunks and self.makeRoomForChunk(c):
+                                active.append((c, self.workOnChunk(c)))
 
-                    else:
-                        for _ in self.workOnChunk(c):
-                            yield
+                    elif not active:
+                        raise StopIteration
+
+                if active:
+                    c, work = active[0]
+                    try:
+                        work.next()
+                        active.rotate(-1)
+                    except StopIteration:
+                        active.popleft()
 
                 yield
 
@@ -3862,6 +4397,27 @@ class MCRenderer(object):
             if self.chunkIterator:
                 self.chunkIterator = None
 
+    def makeRoomForChunk(self, c):
+        ''' discards the chunks farther away than c until the vertex buffers are below
+        their limit. returns False if that is not enough to make room for c.'''
+        if self.vertexBufferLimit:
+            while self.bufferUsage > (0.9 * (self.vertexBufferLimit << 20)):
+                deadChunk = None
+                deadDistance = self.chunkDistance(c)
+                for cr in self.chunkRenderers.itervalues():
+                    dist = self.chunkDistance(cr.chunkPosition)
+                    if dist > deadDistance:
+                        deadChunk = cr
+                        deadDistance = dist
+
+                if deadChunk is not None:
+                    self.discardChunk(*deadChunk.chunkPosition)
+
+                else:
+                    return False
+
+        return True
+
     vertexBufferLimit = 384
 
     def getChunkRenderer(self, c):
@@ -3929,6 +4485,7 @@ class MCRenderer(object):
 
 class PreviewRenderer(MCRenderer):
     isPreviewer = True
+    canForkMeshProcesses = False  # previews are small and come and go with their tools
 
 
 def rendermain():
@@ -0,0 +1,213 @@
+"""
+Headless benchmark of chunk geometry generation.
+
+Computes the geometry of synthetic chunks, or of the chunks of a world, with ChunkCalculator.calcFacesForChunkRenderer
+the way MCRenderer does, but without a GL context, and reports chunks per second, vertices and bytes per chunk and the
+time spent by each block renderer class. Run it from the MCEdit folder:
+
+    python time_renderer.py [--world PATH] [--scenes flat,hills,mixed] [--chunks 64] [--repeat 3]
+                            [--processes 0] [--greedy] [--rough] [--json]
+
+Synthetic scenes are made in a temporary world: "flat" is stone with dirt and grass on top, "hills" is heightmap
+terrain with water, and "mixed" scatters every known block with random data over the flat ground. With --world, the
+chunks nearest to the origin of that world are used instead. Per-renderer times are only measured when the geometry
+is computed in this process, so they are left out with --processes.
+"""
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+import numpy
+
+import pymclevel
+from pymclevel.box import BoundingBox
+from pymclevel.heightmap_import import heightmapColumns
+from pymclevel.infiniteworld import MCInfdevOldLevel
+from renderer import ChunkCalculator, ChunkRenderer, Layer
+
+
+class BenchmarkRenderer(object):
+    """ What ChunkRenderer and ChunkCalculator use of an MCRenderer. """
+    alpha = 0xff
+    showHiddenOres = False
+
+    def __init__(self, level):
+        self.level = level
+        self.visibleLayers = set(Layer.AllLayers)
+
+    def invalidateMasterList(self):
+        pass
+
+
+def makeScene(level, scene, size, seed=0):
+    """ Fills size by size chunks of level with the named synthetic scene. """
+    materials = level.materials
+    rng = numpy.random.RandomState(seed)
+    level.createChunksInBox(BoundingBox((0, 0, 0), (size * 16, 1, size * 16)))
+
+    if scene == "hills":
+        # Smooth random heights, from a coarse grid of random values interpolated over the chunks
+        coarse = rng.randint(40, 100, (size + 2, size + 2)).astype(float)
+        steps = numpy.arange(size * 16) / 16.0
+        i, f = steps.astype(int), steps % 1
+        rows = coarse[i] * (1 - f)[:, None] + coarse[i + 1] * f[:, None]
+        heights = (rows[:, i] * (1 - f) + rows[:, i + 1] * f).astype(int)
+        blockColumns, skyColumns, topColumns = heightmapColumns(level, level.Height / 2)
+    elif scene == "mixed":
+        blockIDs = numpy.array(sorted(set(b.ID for b in materials.allBlocks if 0 < b.ID < 256)), 'uint16')
+    elif scene != "flat":
+        raise ValueError("Unknown scene {0!r}".format(scene))
+
+    for cx in xrange(size):
+        for cz in xrange(size):
+            chunk = level.getChunk(cx, cz)
+            if scene == "hills":
+                tile = heights[cx * 16:cx * 16 + 16, cz * 16:cz * 16 + 16]
+                chunk.Blocks[:] = blockColumns[tile]
+                chunk.SkyLight[:] = skyColumns[tile]
+                chunk.HeightMap[:] = topColumns[tile].T
+            else:
+                chunk.Blocks[:, :, 0] = materials.Bedrock.ID
+                chunk.Blocks[:, :, 1:59] = materials.Stone.ID
+                chunk.Blocks[:, :, 59:62] = materials.Dirt.ID
+                chunk.Blocks[:, :, 62] = materials.Grass.ID
+                chunk.SkyLight[:, :, :63] = 0
+
+            if scene == "mixed":
+                placed = rng.random_sample((16, 16, 16)) < 0.3
+                chunk.Blocks[:, :, 63:79][placed] = rng.choice(blockIDs, placed.sum())
+                chunk.Data[:, :, 63:79][placed] = rng.randint(0, 16, placed.sum())
+            chunk.chunkChanged(False)
+
+
+def nearestChunks(level, count):
+    return sorted(level.allChunks, key=lambda (cx, cz): cx * cx + cz * cz)[:count]
+
+
+def meshChunks(calculator, renderer, chunkPositions):
+    """ Computes the geometry of each chunk, working on as many chunks at once as MCRenderer would. Returns the
+    chunk renderers and the seconds it took. """
+    chunkRenderers = [ChunkRenderer(renderer, cPos) for cPos in chunkPositions]
+    pending = list(reversed(chunkRenderers))
+    active = []
+
+    start = default_timer()
+    while pending or active:
+        while pending and len(active) < calculator.chunksInFlight:
+            active.append(calculator.calcFacesForChunkRenderer(pending.pop()))
+        for work in list(active):
+            try:
+                work.next()
+            except StopIteration:
+                active.remove(work)
+    return chunkRenderers, default_timer() - start
+
+
+def benchmark(level, name, chunkPositions, options):
+    """ Meshes the chunks options.repeat times and returns the statistics of the fastest run. """
+    calculator = ChunkCalculator(level, options.processes)
+    calculator.fastLeaves = options.fastLeaves
+    calculator.roughGraphics = options.rough
+    calculator.greedyMeshing = options.greedy
+    calculator.cacheMeshes = False
+    renderer = BenchmarkRenderer(level)
+    for cPos in chunkPositions:
+        level.getChunk(*cPos)  # read from disk before timing
+
+    best = None
+    try:
+        for _ in xrange(options.repeat):
+            calculator.rendererTimes = {} if not options.processes else None
+            chunkRenderers, seconds = meshChunks(calculator, renderer, chunkPositions)
+            if best is None or seconds < best[1]:
+                best = chunkRenderers, seconds, calculator.rendererTimes
+    finally:
+        calculator.close()
+
+    chunkRenderers, seconds, rendererTimes = best
+    chunks = len(chunkRenderers)
+    renderers = {}
+    for cr in chunkRenderers:
+        for br in cr.blockRenderers:
+            stats = renderers.setdefault(type(br).__name__, {"count": 0, "vertices": 0, "bytes": 0, "seconds": None})
+            stats["count"] += 1
+            stats["vertices"] += sum(len(a) for a in br.vertexArrays) * 4
+            stats["bytes"] += br.bufferSize()
+    for className, classSeconds in (rendererTimes or {}).iteritems():
+        renderers.setdefault(className, {"count": 0, "vertices": 0, "bytes": 0})["seconds"] = classSeconds
+    # Reading the chunks and their neighbours and finding the exposed faces
+    otherSeconds = seconds - sum(rendererTimes.itervalues()) if rendererTimes is not None else None
+
+    return {
+        "scene": name,
+        "chunks": chunks,
+        "seconds": seconds,
+        "chunksPerSecond": chunks / seconds if seconds else None,
+        "verticesPerChunk": sum(r["vertices"] for r in renderers.itervalues()) / float(chunks or 1),
+        "bytesPerChunk": sum(cr.bufferSize for cr in chunkRenderers) / float(chunks or 1),
+        "otherSeconds": otherSeconds,
+        "renderers": renderers,
+    }
+
+
+def printResult(result):
+    print "{scene}: {chunks} chunks in {seconds:.2f}s ({chunksPerSecond:.1f} chunks per second), " \
+          "{verticesPerChunk:.0f} vertices and {kb:.1f} KB per chunk".format(kb=result["bytesPerChunk"] / 1024,
+                                                                            **result)
+    chunks = result["chunks"] or 1
+    if result["otherSeconds"] is not None:
+        milliseconds = result["otherSeconds"] * 1000
+        print "    {0:<28}{1:8.1f} ms {2:7.2f} ms per chunk".format("(outside of renderers)", milliseconds,
+                                                                milliseconds / chunks)
+    for className, stats in sorted(result["renderers"].iteritems(), key=lambda (n, s): -(s["seconds"] or 0)):
+        timing = "" if stats["seconds"] is None else "{0:8.1f} ms {1:7.2f} ms per chunk".format(
+            stats["seconds"] * 1000, stats["seconds"] * 1000 / chunks)
+        print "    {0:<28}{1:<32}{2:6d} renderers {3:8.0f} vertices per chunk".format(
+            className, timing, stats["count"], stats["vertices"] / float(chunks))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Times chunk geometry generation without a GL context.")
+    parser.add_argument("--world", help="use the chunks of this world instead of synthetic scenes")
+    parser.add_argument("--scenes", default="flat,hills,mixed", help="synthetic scenes to time (flat, hills, mixed)")
+    parser.add_argument("--chunks", type=int, default=64, help="chunks to mesh for each scene")
+    parser.add_argument("--repeat", type=int, default=3, help="runs for each scene; the fastest is reported")
+    parser.add_argument("--processes", type=int, default=0, help="mesh worker processes")
+    parser.add_argument("--greedy", action="store_true", help="merge plain cube faces")
+    parser.add_argument("--rough", action="store_true", help="draw all blocks as cubes")
+    parser.add_argument("--fancy-leaves", dest="fastLeaves", action="store_false", help="draw leaves transparent")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    options = parser.parse_args(argv)
+
+    results = []
+    if options.world:
+        level = pymclevel.fromFile(options.world, readonly=True)
+        try:
+            results.append(benchmark(level, options.world, nearestChunks(level, options.chunks), options))
+        finally:
+            level.close()
+    else:
+        size = max(1, int(options.chunks ** 0.5))
+        for scene in options.scenes.split(","):
+            path = tempfile.mkdtemp(prefix="time_renderer")
+            level = MCInfdevOldLevel(path, create=True)
+            try:
+                makeScene(level, scene, size)
+                results.append(benchmark(level, scene, nearestChunks(level, size * size), options))
+            finally:
+                level.close()
+                shutil.rmtree(path, True)
+
+    if options.json:
+        print json.dumps(results, indent=1, sort_keys=True)
+    else:
+        for result in results:
+            printResult(result)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])